@@ -3,31 +3,94 @@ Antibody identification routes.
 This module handles all antibody identification and patient reaction endpoints.
 """
 
-from flask import request, jsonify, render_template, current_app
-from core.enhanced_antibody_identifier import EnhancedAntibodyIdentifier
+import os
+from flask import request, jsonify, render_template, current_app, g
 from core.antibody_rule_validator import AntibodyRuleValidator
+from core.enhanced_antibody_identifier import EnhancedAntibodyIdentifier
+from core.incremental_abid import SUMMARY_FIELDS, empty_results, resolve_result_fields
+from core.inventory_snapshot import wants_archived
+from core.workup_workspaces import UnknownWorkupError, normalize_workup_id
+from core.metrics import time_phase
+from core.serialization import negotiated_response
 
 def register_antibody_routes(app, db_session):
     """Register all antibody identification routes."""
     
     # Get managers from app config
     antigram_manager = app.config['antigram_manager']
-    patient_reaction_manager = app.config['patient_reaction_manager']
+    workspace_manager = app.config['workup_workspace_manager']
+    rule_repository = app.config['rule_repository']
+
+    # Batch identification evaluates submitted panels only, never a workspace's reactions
+    batch_identifier = EnhancedAntibodyIdentifier(
+        antigram_manager, workspace_manager.default_workspace.patient_reaction_manager,
+        rule_repository=rule_repository
+    )
+    batch_max_panels = int(os.getenv("ABID_BATCH_MAX_PANELS", "10000"))
+    batch_processes = int(os.getenv("ABID_BATCH_PROCESSES", "1"))
+
+    # Endpoints whose responses carry identification results, shaped by ?detail= or ?fields=
+    abid_result_endpoints = {
+        'handle_patient_reactions', 'batch_patient_reactions', 'clear_patient_reactions',
+        'delete_patient_reaction', 'get_antibody_identification', 'get_abid'
+    }
+
+    # Endpoints that read or change a workup's patient reactions
+    workup_endpoints = abid_result_endpoints | {
+        'get_abid_antigen', 'debug_patient_reactions', 'validate_rules', 'validate_rules_summary', 'get_missing_rules'
+    }
+
+    @app.before_request
+    def resolve_workup_id():
+        """
+        Read the workup ID from the X-Workup-ID header, workup_id query parameter or JSON
+        body, and look up its workspace on this worker.
+        """
+        if request.endpoint not in workup_endpoints:
+            return None
+        workup_id = request.headers.get('X-Workup-ID') or request.args.get('workup_id')
+        if not workup_id and request.is_json:
+            body = request.get_json(silent=True)
+            if isinstance(body, dict):
+                workup_id = body.get('workup_id')
+        try:
+            g.workup_id = normalize_workup_id(workup_id)
+            g.workspace = workspace_manager.get(g.workup_id)
+        except UnknownWorkupError as e:
+            return jsonify({"error": str(e)}), 404
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    @app.before_request
+    def resolve_abid_fields():
+        """Read the identification result fields from the detail or fields query parameter."""
+        if request.endpoint not in abid_result_endpoints:
+            return None
+        try:
+            g.abid_fields = resolve_result_fields(request.args.get('detail'), request.args.get('fields'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    def include_archived():
+        """Whether the request asked for expired (archived) lots too, with ?include_archived=true."""
+        return wants_archived(request.args.get('include_archived'))
+
+    def current_workspace():
+        """Get the patient reaction workspace for the current request's workup."""
+        return g.workspace
 
     @app.route('/antibody_id')
     def antibody_id_page():
         """Render the antibody identification page."""
-        try:
-            # Clear patient reactions when the page loads
-            patient_reaction_manager.clear_reactions()
-        except Exception:
-            pass
-        
+        # Each page load starts its own workup (see antibody_id.js), so the
+        # shared reaction table is no longer cleared here
         return render_template('antibody_id.html')
 
     @app.route('/api/patient-reactions', methods=['GET', 'POST'])
     def handle_patient_reactions():
         """Handle patient reaction operations."""
+        workspace = current_workspace()
+        patient_reaction_manager = workspace.patient_reaction_manager
         if request.method == 'POST':
             try:
                 data = request.json
@@ -54,6 +117,7 @@ def register_antibody_routes(app, db_session):
                     
                     # Add all reactions
                     added_count = 0
+                    changed_cells = []
                     for reaction_data in reactions:
                         cell_number = str(reaction_data['cell_number'])
                         reaction = reaction_data['reaction']
@@ -61,18 +125,20 @@ def register_antibody_routes(app, db_session):
                         # Only add valid reactions
                         if reaction in ['+', '0']:
                             patient_reaction_manager.add_reaction(antigram_id, cell_number, reaction)
+                            changed_cells.append((antigram_id, cell_number))
                             added_count += 1
                     
                     # Commit changes after adding all reactions
                     patient_reaction_manager.commit_changes()
                     
                     # Run antibody identification and return results
-                    abid_results = antibody_identification()
+                    abid_results, abid_delta = incremental_identification(workspace, changed_cells)
                     
                     return jsonify({
                         "message": f"Added {added_count} patient reactions successfully",
                         "added_count": added_count,
-                        "abid_results": abid_results
+                        "abid_results": abid_results,
+                        "abid_delta": abid_delta
                     }), 201
                     
                 else:
@@ -98,12 +164,13 @@ def register_antibody_routes(app, db_session):
                     # Commit changes after adding reaction
                     patient_reaction_manager.commit_changes()
                     
-                    # Run antibody identification and return results
-                    abid_results = antibody_identification()
+                    # Update antibody identification for the changed cell and return results
+                    abid_results, abid_delta = incremental_identification(workspace, [(antigram_id, cell_number)])
                     
                     return jsonify({
                         "message": "Patient reaction added successfully",
-                        "abid_results": abid_results
+                        "abid_results": abid_results,
+                        "abid_delta": abid_delta
                     }), 201
 
             except Exception as e:
@@ -113,9 +180,8 @@ def register_antibody_routes(app, db_session):
             try:
                 # Get all patient reactions from pandas manager
                 all_reactions = []
-                for antigram_id in antigram_manager.antigram_matrices.keys():
+                for antigram_id, metadata in antigram_manager.snapshot(indexed=False).metadata.items():
                     reactions = patient_reaction_manager.get_reactions_for_antigram(antigram_id)
-                    metadata = antigram_manager.get_antigram_metadata(antigram_id)
                     
                     for cell_number, patient_reaction in reactions.items():
                         all_reactions.append({
@@ -137,6 +203,8 @@ def register_antibody_routes(app, db_session):
     @app.route('/api/patient-reactions/batch', methods=['POST'])
     def batch_patient_reactions():
         """Handle batch patient reaction operations across multiple antigrams."""
+        workspace = current_workspace()
+        patient_reaction_manager = workspace.patient_reaction_manager
         try:
             data = request.json
             antigram_reactions = data.get('antigram_reactions', [])
@@ -145,6 +213,7 @@ def register_antibody_routes(app, db_session):
                 return jsonify({"error": "No antigram reactions provided"}), 400
             
             total_added = 0
+            changed_cells = []
             
             for antigram_data in antigram_reactions:
                 antigram_id = antigram_data.get('antigram_id')
@@ -168,19 +237,21 @@ def register_antibody_routes(app, db_session):
                         # Only add valid reactions
                         if reaction in ['+', '0']:
                             patient_reaction_manager.add_reaction(antigram_id, cell_number, reaction)
+                            changed_cells.append((antigram_id, cell_number))
                             total_added += 1
             
             # Commit all changes
             patient_reaction_manager.commit_changes()
             
             # Run antibody identification and return results
-            abid_results = antibody_identification()
+            abid_results, abid_delta = incremental_identification(workspace, changed_cells)
             
             return jsonify({
                 "message": f"Added {total_added} patient reactions across {len(antigram_reactions)} antigrams",
                 "total_added": total_added,
                 "antigrams_processed": len(antigram_reactions),
-                "abid_results": abid_results
+                "abid_results": abid_results,
+                "abid_delta": abid_delta
             }), 201
             
         except Exception as e:
@@ -190,8 +261,9 @@ def register_antibody_routes(app, db_session):
     def clear_patient_reactions():
         """Clear all patient reactions and return antibody identification results."""
         try:
-            patient_reaction_manager.clear_reactions()
-            return antibody_identification()
+            workspace = current_workspace()
+            workspace.patient_reaction_manager.clear_reactions()
+            return antibody_identification(workspace)
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
@@ -215,17 +287,69 @@ def register_antibody_routes(app, db_session):
             # Convert cell_number to string to handle both numeric and alphabetic cell numbers
             cell_number = str(cell_number)
             
-            patient_reaction_manager.delete_reaction(antigram_id, cell_number)
-            return antibody_identification()
+            workspace = current_workspace()
+            workspace.patient_reaction_manager.delete_reaction(antigram_id, cell_number)
+            abid_results, abid_delta = incremental_identification(workspace, [(antigram_id, cell_number)])
+            abid_results["abid_delta"] = abid_delta
+            return abid_results
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
     @app.route('/api/antibody-identification', methods=['GET'])
     def get_antibody_identification():
-        """Get antibody identification results."""
+        """Get antibody identification results (JSON, or MessagePack if requested)."""
         try:
-            results = antibody_identification()
-            return jsonify(results), 200
+            results = antibody_identification(current_workspace())
+            return negotiated_response(results)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/api/abid/batch', methods=['POST'])
+    def batch_abid():
+        """
+        Identify antibodies for many patient panels in one request, without changing
+        any workup's reactions. Each panel lists its reactions in the shape accepted by
+        /api/patient-reactions/batch:
+        {"panels": [{"panel_id": ..., "antigram_reactions": [{"antigram_id": ..., "reactions":
+        [{"cell_number": ..., "reaction": "+"}]}]}], "include_details": false,
+        "include_archived": false}
+        """
+        try:
+            data = request.get_json(silent=True) or {}
+            panels = data.get('panels')
+            if not isinstance(panels, list) or not panels:
+                return jsonify({"error": "No panels provided"}), 400
+            if len(panels) > batch_max_panels:
+                return jsonify({"error": f"At most {batch_max_panels} panels per batch"}), 400
+            
+            panel_reactions = []
+            for panel in panels:
+                reactions = []
+                for antigram_data in (panel.get('antigram_reactions') or []) if isinstance(panel, dict) else []:
+                    try:
+                        antigram_id = int(antigram_data.get('antigram_id'))
+                    except (ValueError, TypeError):
+                        continue  # Skip invalid antigram_id
+                    for reaction_data in antigram_data.get('reactions') or []:
+                        if reaction_data.get('reaction') in ('+', '0') and 'cell_number' in reaction_data:
+                            reactions.append((antigram_id, str(reaction_data['cell_number']), reaction_data['reaction']))
+                panel_reactions.append(reactions)
+            
+            with time_phase('rule_load', engine='batch'):
+                rules = rule_repository.snapshot()
+            results = batch_identifier.identify_batch(
+                panel_reactions, rules.enabled_rules, rules.cache_key,
+                include_details=bool(data.get('include_details')), processes=batch_processes,
+                include_archived=wants_archived(data.get('include_archived', request.args.get('include_archived')))
+            )
+            
+            return negotiated_response({
+                "panel_count": len(results),
+                "results": [
+                    {"panel_id": panel.get('panel_id') if isinstance(panel, dict) else None, **result}
+                    for panel, result in zip(panels, results)
+                ]
+            })
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
@@ -233,44 +357,60 @@ def register_antibody_routes(app, db_session):
     def get_abid():
         """Get antibody identification results (alias for compatibility)."""
         try:
-            results = antibody_identification()
-            return jsonify(results), 200
+            results = antibody_identification(current_workspace())
+            return negotiated_response(results)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/api/abid/antigen/<antigen>', methods=['GET'])
+    def get_abid_antigen(antigen):
+        """
+        Get one antigen's status, match counters and ruling out cells, computed on
+        demand (the progress entry and ruled_out_details of ?detail=full, for one antigen).
+        """
+        try:
+            with time_phase('rule_load', engine='incremental'):
+                rules = rule_repository.snapshot()
+            result = current_workspace().abid_tracker.identify_antigen(rules.enabled_rules, antigen, rules.cache_key,
+                                                                        include_archived=include_archived())
+            if result is None:
+                return jsonify({"error": f"Unknown antigen: {antigen}"}), 404
+            return negotiated_response(result)
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
     @app.route('/api/debug/patient-reactions', methods=['GET'])
     def debug_patient_reactions():
         """Debug endpoint to check patient reactions and rules."""
+        patient_reaction_manager = current_workspace().patient_reaction_manager
         try:
             # Check patient reactions
             patient_reactions_info = {
-                "total_reactions": len(patient_reaction_manager.reactions_df),
+                "total_reactions": patient_reaction_manager.reaction_count,
                 "reactions_by_antigram": {}
             }
             
-            for antigram_id in antigram_manager.antigram_matrices.keys():
+            for antigram_id, metadata in antigram_manager.snapshot(indexed=False).metadata.items():
                 reactions = patient_reaction_manager.get_reactions_for_antigram(antigram_id)
-                metadata = antigram_manager.get_antigram_metadata(antigram_id)
                 patient_reactions_info["reactions_by_antigram"][str(antigram_id)] = {
                     "lot_number": metadata['lot_number'],
                     "reactions": reactions
                 }
             
             # Check rules
-            from models import AntibodyRule
-            rules = db_session.query(AntibodyRule).filter_by(enabled=True).all()
+            rules = rule_repository.enabled_rules()
             rules_info = {
                 "total_rules": len(rules),
                 "rules_by_type": {}
             }
             
             for rule in rules:
-                rule_type = rule.rule_type
+                rule_type = rule['rule_type']
                 if rule_type not in rules_info["rules_by_type"]:
                     rules_info["rules_by_type"][rule_type] = []
                 rules_info["rules_by_type"][rule_type].append({
-                    "target_antigen": rule.target_antigen,
-                    "description": rule.description
+                    "target_antigen": rule['target_antigen'],
+                    "description": rule['description']
                 })
             
             return jsonify({
@@ -286,7 +426,8 @@ def register_antibody_routes(app, db_session):
     def validate_rules():
         """Validate antibody rule coverage and return detailed analysis."""
         try:
-            validator = AntibodyRuleValidator(antigram_manager, patient_reaction_manager, db_session)
+            validator = AntibodyRuleValidator(antigram_manager, current_workspace().patient_reaction_manager, db_session,
+                                              rule_repository=rule_repository, include_archived=include_archived())
             validation_results = validator.validate_rule_coverage()
             
             return jsonify(validation_results), 200
@@ -298,7 +439,8 @@ def register_antibody_routes(app, db_session):
     def validate_rules_summary():
         """Get a human-readable validation summary."""
         try:
-            validator = AntibodyRuleValidator(antigram_manager, patient_reaction_manager, db_session)
+            validator = AntibodyRuleValidator(antigram_manager, current_workspace().patient_reaction_manager, db_session,
+                                              rule_repository=rule_repository, include_archived=include_archived())
             summary = validator.get_validation_summary()
             
             return jsonify({"summary": summary}), 200
@@ -310,7 +452,8 @@ def register_antibody_routes(app, db_session):
     def get_missing_rules():
         """Get list of antigens missing rules."""
         try:
-            validator = AntibodyRuleValidator(antigram_manager, patient_reaction_manager, db_session)
+            validator = AntibodyRuleValidator(antigram_manager, current_workspace().patient_reaction_manager, db_session,
+                                              rule_repository=rule_repository, include_archived=include_archived())
             validation_results = validator.validate_rule_coverage()
             
             return jsonify({
@@ -322,27 +465,62 @@ def register_antibody_routes(app, db_session):
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
-    def antibody_identification():
+    @app.route('/api/workups', methods=['GET'])
+    def list_workups():
+        """List the live patient reaction workspaces."""
+        try:
+            return jsonify({
+                "workups": workspace_manager.list_workspaces(),
+                "stats": workspace_manager.stats()
+            }), 200
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/api/workups/<workup_id>', methods=['PUT'])
+    def start_workup(workup_id):
+        """Start a workup on this worker, with an empty patient reaction workspace."""
+        try:
+            if not workspace_manager.start(workup_id):
+                return jsonify({"message": f"Workup {workup_id} already started"}), 200
+            return jsonify({"message": f"Workup {workup_id} started"}), 201
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/api/workups/<workup_id>', methods=['DELETE'])
+    def delete_workup(workup_id):
+        """Discard a workup's patient reaction workspace."""
+        try:
+            if not workspace_manager.discard(workup_id):
+                return jsonify({"error": "Workup not found"}), 404
+            return jsonify({"message": f"Workup {workup_id} discarded"}), 200
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    def antibody_identification(workspace):
         """Perform antibody identification using enhanced rule system."""
+        abid_results, _ = incremental_identification(workspace)
+        return abid_results
+
+    def incremental_identification(workspace, changed_cells=()):
+        """
+        Perform antibody identification, applying only the given reaction changes
+        to the incremental state when it is still in step with the managers. Only
+        the result fields the request asked for are built (status lists by default).
+
+        Returns:
+            Tuple of (results, delta of antigen statuses that changed)
+        """
+        fields = g.get('abid_fields', SUMMARY_FIELDS)
         try:
-            # Create enhanced antibody identifier
-            identifier = EnhancedAntibodyIdentifier(antigram_manager, patient_reaction_manager, db_session)
-            
-            # Load rules for debugging
-            from models import AntibodyRule
-            rules = db_session.query(AntibodyRule).filter_by(enabled=True).all()
-            
-            # Perform identification
-            results = identifier.identify_antibodies()
-            
-            return results
+            # Parsed rules and their compiled plan are cached per rule repository version
+            with time_phase('rule_load', engine='incremental'):
+                rules = rule_repository.snapshot()
+            return workspace.abid_tracker.identify(rules.enabled_rules, changed_cells, rules.cache_key, fields,
+                                                   include_archived=include_archived())
 
         except Exception as e:
-            return {
-                "ruled_out": [],
-                "stro": [],
-                "matches": [],
-                "progress": {},
-                "ruled_out_details": {},
-                "suspected_antibodies": []
-            } 
\ No newline at end of file
+            return {field: value for field, value in empty_results().items() if field in fields}, {}
@@ -5,6 +5,9 @@ This module handles all antigen and antibody rule management endpoints.
 
 from flask import request, jsonify, render_template, current_app
 from models import Antigen, AntibodyRule
+from core.bulk_persistence import bulk_insert
+from core.rule_repository import rule_to_dict
+from core.change_feed import record_changes, ENTITY_ANTIBODY_RULES
 import logging
 import json
 from datetime import datetime
@@ -37,6 +40,10 @@ def load_antigen_order_config():
 def register_antigen_routes(app, db_session):
     """Register all antigen and antibody rule routes."""
     
+    # Every write to the antibody_rules (or antigens) table below invalidates the rule repository
+    rule_repository = app.config['rule_repository']
+    response_cache = app.config['response_cache']
+    
     @app.route('/antigen')
     def antigen_page():
         """Render the antigen management page."""
@@ -76,7 +83,10 @@ def register_antigen_routes(app, db_session):
                 system=data['system']
             )
             db_session.add(new_antigen)
+            # Valid antigens are cached per rule set version, so treat this like a rule change
+            record_changes(db_session, ENTITY_ANTIBODY_RULES)
             db_session.commit()
+            rule_repository.invalidate()
             
             logger.info(f"Created new antigen: {data['name']}")
             return jsonify(new_antigen.to_dict()), 201
@@ -97,7 +107,9 @@ def register_antigen_routes(app, db_session):
             db_session.query(AntibodyRule).filter_by(target_antigen=antigen.name).delete()
 
             db_session.delete(antigen)
+            record_changes(db_session, ENTITY_ANTIBODY_RULES)
             db_session.commit()
+            rule_repository.invalidate()
             
             logger.info(f"Deleted antigen: {name}")
             return jsonify({"message": "Antigen deleted successfully"}), 200
@@ -166,11 +178,11 @@ def register_antigen_routes(app, db_session):
             db_session.query(Antigen).delete()
 
             # Add new antigens
-            for antigen_data in base_antigens:
-                new_antigen = Antigen(**antigen_data)
-                db_session.add(new_antigen)
+            bulk_insert(db_session, Antigen, base_antigens)
 
+            record_changes(db_session, ENTITY_ANTIBODY_RULES)
             db_session.commit()
+            rule_repository.invalidate()
             logger.info("Base antigens initialized successfully")
             return jsonify({"message": "Base antigens initialized successfully"}), 200
         except Exception as e:
@@ -250,21 +262,22 @@ def register_antigen_routes(app, db_session):
     def get_valid_antigens():
         """Get all antigens that exist in the Antigen table and have at least one enabled antibody rule."""
         try:
-            # Get all antigens
-            antigens = db_session.query(Antigen).all()
-            antigen_names = {antigen.name: antigen for antigen in antigens}
+            def build():
+                # Get all antigens
+                antigens = db_session.query(Antigen).all()
+                antigen_names = {antigen.name: antigen for antigen in antigens}
+
+                # Get the target antigens of all enabled antibody rules
+                antigens_with_rules = rule_repository.antigens_with_enabled_rules()
 
-            # Get all enabled antibody rules
-            rules = db_session.query(AntibodyRule).filter_by(enabled=True).all()
-            antigens_with_rules = set(rule.target_antigen for rule in rules)
+                # Only include antigens that have at least one enabled rule
+                valid_antigens = [antigen_names[name] for name in antigens_with_rules if name in antigen_names]
 
-            # Only include antigens that have at least one enabled rule
-            valid_antigens = [antigen_names[name] for name in antigens_with_rules if name in antigen_names]
+                # Return as list of dicts with name and system
+                return [{"name": antigen.name, "system": antigen.system} for antigen in valid_antigens]
 
-            # Return as list of dicts with name and system
-            return jsonify([
-                {"name": antigen.name, "system": antigen.system} for antigen in valid_antigens
-            ]), 200
+            # Antigen table changes also bump the rule repository version (see create_antigen)
+            return response_cache.respond('valid_antigens', rule_repository.version, build)
         except Exception as e:
             logger.error(f"Error getting valid antigens: {e}")
             return jsonify({"error": str(e)}), 500
@@ -286,10 +299,9 @@ def register_antigen_routes(app, db_session):
     # Antibody Rules Management Routes
     @app.route('/api/antibody-rules', methods=['GET'])
     def get_antibody_rules():
-        """Get all antibody rules."""
+        """Get all antibody rules (304 if the client's copy is current)."""
         try:
-            rules = db_session.query(AntibodyRule).all()
-            return jsonify([rule.to_dict() for rule in rules])
+            return response_cache.respond('antibody_rules', rule_repository.version, rule_repository.rules_as_dicts)
         except Exception as e:
             logger.error(f"Error getting antibody rules: {e}")
             return jsonify({"error": str(e)}), 500
@@ -313,7 +325,9 @@ def register_antigen_routes(app, db_session):
                 enabled=data.get('enabled', True)
             )
             db_session.add(new_rule)
+            record_changes(db_session, ENTITY_ANTIBODY_RULES)
             db_session.commit()
+            rule_repository.invalidate()
             
             logger.info(f"Created new antibody rule for: {data['target_antigen']}")
             return jsonify(new_rule.to_dict()), 201
@@ -326,10 +340,10 @@ def register_antigen_routes(app, db_session):
     def get_antibody_rule(rule_id):
         """Get a specific antibody rule."""
         try:
-            rule = db_session.query(AntibodyRule).filter_by(id=rule_id).first()
+            rule = rule_repository.get_rule(rule_id)
             if not rule:
                 return jsonify({"error": "Rule not found"}), 404
-            return jsonify(rule.to_dict())
+            return jsonify(rule_to_dict(rule))
         except Exception as e:
             logger.error(f"Error getting antibody rule: {e}")
             return jsonify({"error": str(e)}), 500
@@ -354,7 +368,9 @@ def register_antigen_routes(app, db_session):
             if data.get('enabled') is not None:
                 rule.enabled = data['enabled']
 
+            record_changes(db_session, ENTITY_ANTIBODY_RULES)
             db_session.commit()
+            rule_repository.invalidate()
             logger.info(f"Updated antibody rule: {rule_id}")
             return jsonify(rule.to_dict())
         except Exception as e:
@@ -371,7 +387,9 @@ def register_antigen_routes(app, db_session):
                 return jsonify({"error": "Rule not found"}), 404
 
             db_session.delete(rule)
+            record_changes(db_session, ENTITY_ANTIBODY_RULES)
             db_session.commit()
+            rule_repository.invalidate()
             
             logger.info(f"Deleted antibody rule: {rule_id}")
             return jsonify({"message": "Rule deleted successfully"})
@@ -385,7 +403,9 @@ def register_antigen_routes(app, db_session):
         """Delete all antibody rules."""
         try:
             db_session.query(AntibodyRule).delete()
+            record_changes(db_session, ENTITY_ANTIBODY_RULES)
             db_session.commit()
+            rule_repository.invalidate()
             
             logger.info("Deleted all antibody rules")
             return jsonify({"message": "All rules deleted successfully"})
@@ -420,16 +440,15 @@ def register_antigen_routes(app, db_session):
     def export_antibody_rules():
         """Export all antibody rules as a template."""
         try:
-            rules = db_session.query(AntibodyRule).all()
             exported_rules = []
             
-            for rule in rules:
+            for rule in rule_repository.rules_as_dicts():
                 exported_rules.append({
-                    "rule_type": rule.rule_type,
-                    "target_antigen": rule.target_antigen,
-                    "rule_data": json.loads(rule.rule_data),
-                    "description": rule.description,
-                    "enabled": rule.enabled
+                    "rule_type": rule['rule_type'],
+                    "target_antigen": rule['target_antigen'],
+                    "rule_data": rule['rule_data'],
+                    "description": rule['description'],
+                    "enabled": rule['enabled']
                 })
             
             return jsonify({
@@ -460,25 +479,26 @@ def register_antigen_routes(app, db_session):
                 db_session.query(AntibodyRule).delete()
                 logger.info("Cleared existing antibody rules")
             
-            added_count = 0
+            rule_rows = []
             for rule_data in rules_data:
                 # Validate required fields
                 if not all(key in rule_data for key in ['rule_type', 'target_antigen', 'rule_data']):
                     logger.warning(f"Skipping invalid rule: {rule_data}")
                     continue
                 
-                rule_data_json = json.dumps(rule_data['rule_data'])
-                rule = AntibodyRule(
-                    rule_type=rule_data['rule_type'],
-                    target_antigen=rule_data['target_antigen'],
-                    rule_data=rule_data_json,
-                    description=rule_data.get('description', ''),
-                    enabled=rule_data.get('enabled', True)
-                )
-                db_session.add(rule)
-                added_count += 1
+                rule_rows.append({
+                    "rule_type": rule_data['rule_type'],
+                    "target_antigen": rule_data['target_antigen'],
+                    "rule_data": json.dumps(rule_data['rule_data']),
+                    "description": rule_data.get('description', ''),
+                    "enabled": rule_data.get('enabled', True)
+                })
             
+            # Insert all rules with multi-row INSERT statements
+            added_count = bulk_insert(db_session, AntibodyRule, rule_rows)
+            record_changes(db_session, ENTITY_ANTIBODY_RULES)
             db_session.commit()
+            rule_repository.invalidate()
             logger.info(f"Imported {added_count} antibody rules")
             return jsonify({
                 "message": f"Successfully imported {added_count} antibody rules"
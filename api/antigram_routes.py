@@ -15,6 +15,8 @@ def register_antigram_routes(app, db_session):
     # Get managers from app config
     antigram_manager = app.config['antigram_manager']
     template_manager = app.config.get('template_manager')
+    rule_repository = app.config['rule_repository']
+    response_cache = app.config['response_cache']
 
     #  ---------- Template Routes ----------
     @app.route("/api/templates", methods=["POST"])
@@ -42,11 +44,9 @@ def register_antigram_routes(app, db_session):
                     return jsonify({"error": f"cell_count ({cell_count}) must match cell_range ({expected_count} cells from {cell_range[0]} to {cell_range[1]})"}), 400
 
             # --- VALIDATION: Only allow antigens that exist in Antigen table AND have at least one enabled antibody rule ---
-            from models import Antigen, AntibodyRule
+            from models import Antigen
             antigens = {a.name for a in db_session.query(Antigen).all()}
-            rules = db_session.query(AntibodyRule).filter_by(enabled=True).all()
-            antigens_with_rules = {rule.target_antigen for rule in rules}
-            valid_antigens = antigens & antigens_with_rules
+            valid_antigens = antigens & rule_repository.antigens_with_enabled_rules()
             invalid_antigens = [ag for ag in antigen_order if ag not in valid_antigens]
             if invalid_antigens:
                 return jsonify({
@@ -56,7 +56,7 @@ def register_antigram_routes(app, db_session):
             # Generate unique template ID
             template_id = int(datetime.now().timestamp() * 1000)
             
-            # Add to template manager (this will also save to database)
+            # Add to template manager (saved to the database on commit)
             template_manager.add_template(template_id, name, antigen_order, cell_count, cell_range)
             
             # Commit changes after creating template
@@ -70,9 +70,8 @@ def register_antigram_routes(app, db_session):
     
     @app.route("/api/templates", methods=["GET"])
     def get_templates():
-        """Get all templates."""
-        templates = template_manager.get_all_templates()
-        return jsonify(templates), 200
+        """Get all templates (304 if the client's copy is current)."""
+        return response_cache.respond('templates', template_manager.version, template_manager.get_all_templates)
 
     @app.route("/api/templates/<int:template_id>", methods=["GET"])
     def get_template(template_id):
@@ -106,11 +105,9 @@ def register_antigram_routes(app, db_session):
                     return jsonify({"error": f"cell_count ({cell_count}) must match cell_range ({expected_count} cells from {cell_range[0]} to {cell_range[1]})"}), 400
 
             # --- VALIDATION: Only allow antigens that exist in Antigen table AND have at least one enabled antibody rule ---
-            from models import Antigen, AntibodyRule
+            from models import Antigen
             antigens = {a.name for a in db_session.query(Antigen).all()}
-            rules = db_session.query(AntibodyRule).filter_by(enabled=True).all()
-            antigens_with_rules = {rule.target_antigen for rule in rules}
-            valid_antigens = antigens & antigens_with_rules
+            valid_antigens = antigens & rule_repository.antigens_with_enabled_rules()
             invalid_antigens = [ag for ag in antigen_order if ag not in valid_antigens]
             if invalid_antigens:
                 return jsonify({
@@ -189,65 +186,77 @@ def register_antigram_routes(app, db_session):
 
     @app.route("/api/antigrams", methods=["GET"])
     def get_all_antigrams():
-        """Fetch all antigrams or filter by lot number."""
+        """Fetch all antigrams or filter by lot number (304 if the client's copy is current)."""
         try:
             search_query = request.args.get('search', '').strip()
-            all_antigrams = antigram_manager.get_all_antigrams()
-            if search_query:
-                filtered = [a for a in all_antigrams if search_query.lower() in a['lot_number'].lower()]
-            else:
-                filtered = all_antigrams
-            return jsonify(filtered), 200
+
+            def build():
+                all_antigrams = antigram_manager.get_all_antigrams()
+                if search_query:
+                    return [a for a in all_antigrams if search_query.lower() in a['lot_number'].lower()]
+                return all_antigrams
+
+            return response_cache.respond(('antigrams', search_query.lower()), antigram_manager.version, build,
+                                          negotiate=True)
         except Exception as e:
             logger.error(f"Error getting antigrams: {e}")
             return jsonify({"error": str(e)}), 500
 
     @app.route("/api/antigrams/<int:id>", methods=["GET"])
     def get_antigram_by_id(id):
-        """Get a specific antigram by ID."""
+        """Get a specific antigram by ID (304 if the client's copy is current)."""
         try:
-            matrix = antigram_manager.get_antigram_matrix(id)
-            metadata = antigram_manager.get_antigram_metadata(id)
-            if matrix is None or metadata is None:
+            # The antigen order is taken from the antigram's template
+            version = (antigram_manager.version, template_manager.version)
+            response = response_cache.respond(('antigram', id), version, lambda: antigram_payload(id), negotiate=True)
+            if response is None:
                 return jsonify({"error": f"Antigram with ID {id} not found"}), 404
-            
-            # Format cells data - matrix has cells as index and antigens as columns
-            cells = []
-            for cell_number in matrix.index:
-                cells.append({
-                    "cell_number": str(cell_number),  # Ensure cell_number is string
-                    "reactions": matrix.loc[cell_number].to_dict()
-                })
-            
-            # Get antigen order from the template that was used to create this antigram
-            template_name = metadata["template_name"]
-            antigen_order = []
-            
-            # Try to find the template and get its antigen order
-            all_templates = template_manager.get_all_templates()
-            for template in all_templates:
-                if template["name"] == template_name:
-                    antigen_order = template.get("antigen_order", [])
-                    break
-            
-            # If template not found, fall back to metadata or extract from matrix
-            if not antigen_order:
-                antigen_order = metadata.get("antigens", [])
-                if not antigen_order and matrix is not None and not matrix.empty:
-                    antigen_order = list(matrix.columns)
-            
-            return jsonify({
-                "id": id,
-                "name": metadata["template_name"],
-                "lot_number": metadata["lot_number"],
-                "expiration_date": str(metadata["expiration_date"]),
-                "antigen_order": antigen_order,  # Use template's antigen order
-                "cells": cells
-            }), 200
+            return response
         except Exception as e:
             logger.error(f"Error getting antigram {id}: {e}")
             return jsonify({"error": str(e)}), 500
 
+    def antigram_payload(id):
+        """Body of GET /api/antigrams/<id>, or None if the antigram does not exist."""
+        matrix = antigram_manager.get_antigram_matrix(id)
+        metadata = antigram_manager.get_antigram_metadata(id)
+        if matrix is None or metadata is None:
+            return None
+        
+        # Format cells data - matrix has cells as index and antigens as columns
+        cells = []
+        for cell_number in matrix.index:
+            cells.append({
+                "cell_number": str(cell_number),  # Ensure cell_number is string
+                "reactions": matrix.loc[cell_number].to_dict()
+            })
+        
+        # Get antigen order from the template that was used to create this antigram
+        template_name = metadata["template_name"]
+        antigen_order = []
+        
+        # Try to find the template and get its antigen order
+        all_templates = template_manager.get_all_templates()
+        for template in all_templates:
+            if template["name"] == template_name:
+                antigen_order = template.get("antigen_order", [])
+                break
+        
+        # If template not found, fall back to metadata or extract from matrix
+        if not antigen_order:
+            antigen_order = metadata.get("antigens", [])
+            if not antigen_order and matrix is not None and not matrix.empty:
+                antigen_order = list(matrix.columns)
+        
+        return {
+            "id": id,
+            "name": metadata["template_name"],
+            "lot_number": metadata["lot_number"],
+            "expiration_date": str(metadata["expiration_date"]),
+            "antigen_order": antigen_order,  # Use template's antigen order
+            "cells": cells
+        }
+
     @app.route("/api/antigrams/<int:id>", methods=["PUT"])
     def update_antigram_by_id(id):
         """Update an existing antigram."""
@@ -308,8 +317,7 @@ def register_antigram_routes(app, db_session):
     def delete_all_antigrams():
         """Delete all antigrams from the pandas manager."""
         try:
-            antigram_manager.antigram_matrices.clear()
-            antigram_manager.antigram_metadata.clear()
+            antigram_manager.clear_antigrams()
             return jsonify({"message": "All antigrams have been deleted successfully."}), 200
         except Exception as e:
             logger.error(f"Error deleting all antigrams: {e}")
@@ -0,0 +1,115 @@
+"""
+Metrics routes.
+This module exposes request, identification and inventory metrics for Prometheus.
+"""
+
+from flask import Response
+from core.metrics import registry, gauge, counter_family
+from core.rule_compiler import plan_cache_stats
+
+
+def _hit_ratio(hits: int, misses: int) -> float:
+    total = hits + misses
+    return hits / total if total else 0.0
+
+
+def register_metrics_routes(app, db_session):
+    """Register the metrics endpoint and the collectors it reports."""
+
+    # Get managers from app config
+    antigram_manager = app.config['antigram_manager']
+    template_manager = app.config['template_manager']
+    rule_repository = app.config['rule_repository']
+    workspace_manager = app.config['workup_workspace_manager']
+    response_cache = app.config['response_cache']
+
+    def collect_inventory():
+        """Inventory size gauges, read at scrape time without loading any matrix."""
+        residency = antigram_manager.residency_stats()
+        workspaces = workspace_manager.stats()
+        rules = rule_repository.stats()
+        default_reaction_manager = workspace_manager.default_workspace.patient_reaction_manager
+
+        families = [
+            gauge('bbapp_antigrams', 'Antigrams known to this worker, by residency and archival state.', [
+                ({'state': 'known'}, residency['known_antigrams']),
+                ({'state': 'resident'}, residency['resident_antigrams']),
+                ({'state': 'unindexed'}, residency['unindexed_antigrams']),
+                ({'state': 'archived'}, residency['archived_antigrams']),
+            ]),
+            gauge('bbapp_antigram_cells', 'Cells across every known antigram.', [
+                ({}, sum(metadata.get('cell_count', 0) for metadata in antigram_manager.snapshot(indexed=False).metadata.values())),
+            ]),
+            gauge('bbapp_antigram_resident_bytes', 'Memory held by resident antigram matrices.', [
+                ({}, residency['resident_bytes']),
+            ]),
+            gauge('bbapp_patient_reactions', 'Patient reactions in the default workspace.', [
+                ({}, default_reaction_manager.reaction_count),
+            ]),
+            gauge('bbapp_templates', 'Antigram templates.', [
+                ({}, len(template_manager.templates)),
+            ]),
+            gauge('bbapp_workup_workspaces', 'Live per-workup patient reaction workspaces.', [
+                ({}, workspaces['workspace_count']),
+            ]),
+            gauge('bbapp_workup_workspace_bytes', 'Estimated memory held by workup workspaces.', [
+                ({}, workspaces['estimated_bytes']),
+            ]),
+        ]
+        if residency['memory_budget_bytes'] is not None:
+            families.append(gauge('bbapp_antigram_memory_budget_bytes', 'Memory budget for resident antigram matrices.', [
+                ({}, residency['memory_budget_bytes']),
+            ]))
+        change_feed = app.config.get('change_feed')
+        if change_feed is not None:
+            feed = change_feed.stats()
+            families.append(gauge('bbapp_change_feed_version', 'Last change log version applied by this worker.', [
+                ({}, feed['version']),
+            ]))
+            families.append(counter_family('bbapp_change_feed_applied_total', 'Changes from other workers applied.', [
+                ({}, feed['applied']),
+            ]))
+        if rules['rules'] is not None:
+            families.append(gauge('bbapp_antibody_rules', 'Antibody rules in the cached rule set.', [
+                ({'state': 'all'}, rules['rules']),
+                ({'state': 'enabled'}, rules['enabled_rules']),
+            ]))
+        return families
+
+    def collect_caches():
+        """Hit/miss counters and hit ratios of the in-process caches."""
+        residency = antigram_manager.residency_stats()
+        plans = plan_cache_stats()
+        rules = rule_repository.stats()
+        responses = response_cache.stats()
+        caches = {
+            'antigram_matrices': (residency['hits'], residency['misses']),
+            'compiled_rule_plans': (plans['hits'], plans['misses']),
+            'antibody_rules': (rules['hits'], rules['loads']),
+            'responses': (responses['hits'], responses['misses']),
+        }
+        return [
+            counter_family('bbapp_cache_requests_total', 'Cache lookups, by cache and result.', [
+                (labels, count)
+                for cache, (hits, misses) in caches.items()
+                for labels, count in (({'cache': cache, 'result': 'hit'}, hits), ({'cache': cache, 'result': 'miss'}, misses))
+            ]),
+            gauge('bbapp_cache_hit_ratio', 'Fraction of cache lookups served from memory since startup.', [
+                ({'cache': cache}, _hit_ratio(hits, misses)) for cache, (hits, misses) in caches.items()
+            ]),
+            counter_family('bbapp_cache_evictions_total', 'Entries evicted to stay within memory limits.', [
+                ({'cache': 'antigram_matrices'}, residency['evictions']),
+                ({'cache': 'workup_workspaces'}, workspace_manager.stats()['evicted_count']),
+            ]),
+            counter_family('bbapp_http_not_modified_total', 'Conditional GETs answered with 304 Not Modified.', [
+                ({}, responses['not_modified']),
+            ]),
+        ]
+
+    registry.register_collector(collect_inventory)
+    registry.register_collector(collect_caches)
+
+    @app.route('/api/metrics', methods=['GET'])
+    def metrics():
+        """Metrics in the Prometheus text exposition format."""
+        return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
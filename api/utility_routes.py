@@ -3,23 +3,79 @@ Utility routes for cell finding and other utility operations.
 This module handles cell finding and other utility endpoints.
 """
 
+import base64
+import binascii
+import json
+import os
+from itertools import islice
 from flask import request, jsonify, render_template, current_app
+from core.inventory_snapshot import wants_archived
+from core.serialization import ndjson_response, wants_ndjson
+
+
+def encode_cursor(match):
+    """Opaque cursor resuming a cell finder search after the given match."""
+    key = json.dumps([match['antigram_id'], str(match['cell_number'])])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(antigram_id, cell_number) of a cursor made by encode_cursor."""
+    try:
+        antigram_id, cell_number = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return int(antigram_id), str(cell_number)
+    except (AttributeError, binascii.Error, TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+def format_match(match):
+    """Cell finder result record of a match."""
+    return {
+        "antigram": {
+            "id": match['antigram_id'],
+            "name": match['template_name'],
+            "lot_number": match['lot_number'],
+            "expiration_date": str(match['expiration_date']),
+        },
+        "cell": {
+            "cell_number": match['cell_number'],
+            "reactions": match['reactions']
+        }
+    }
+
+
+def page_records(matches, limit=None):
+    """Formatted results (up to limit, if given) followed by a {"next_cursor": ...} record."""
+    last = None
+    for match in islice(matches, limit):
+        last = match
+        yield format_match(match)
+    has_more = limit is not None and last is not None and next(matches, None) is not None
+    yield {"next_cursor": encode_cursor(last) if has_more else None}
+
 
 def register_utility_routes(app, db_session):
     """Register all utility routes."""
     
     # Get managers from app config
     antigram_manager = app.config['antigram_manager']
+    max_page_size = int(os.getenv("CELL_FINDER_MAX_LIMIT", "1000"))
 
     @app.route("/cell_finder", methods=["GET", "POST"])
     def cell_finder():
-        """Cell finder page and pattern matching functionality."""
+        """
+        Cell finder page and pattern matching functionality.
+
+        POST {"antigenProfile": {...}} returns every matching cell. Optional fields:
+        "limit" returns one page and a "next_cursor" to pass back as "cursor",
+        "columns" limits each cell's reactions to the given antigens, and
+        "includeArchived" searches expired lots too. With Accept: application/x-ndjson
+        the results are streamed one per line as they are built, followed by a
+        {"next_cursor": ...} line.
+        """
         try:
-            # Get all distinct antigens from pandas matrices
-            all_antigens = set()
-            for matrix in antigram_manager.antigram_matrices.values():
-                all_antigens.update(matrix.columns)
-            antigen_list = sorted(list(all_antigens))
+            # Get all distinct antigens from antigram metadata (no matrices are loaded)
+            antigen_list = antigram_manager.get_all_antigens()
 
             if request.method == "GET":
                 return render_template("cell_finder.html", antigens=antigen_list)
@@ -28,46 +84,48 @@ def register_utility_routes(app, db_session):
                 if request.content_type != "application/json":
                     return jsonify({"error": "Unsupported Media Type: Content-Type must be 'application/json'"}), 415
 
-                antigen_profile = request.json.get("antigenProfile", {})
+                data = request.json
+                antigen_profile = data.get("antigenProfile", {})
 
                 if not antigen_profile:
                     return jsonify({"error": "Missing antigen profile in request body"}), 400
 
-                # Use pandas pattern matching
-                matching_cells = antigram_manager.find_cells_by_pattern(antigen_profile)
-
-                # Format results with all antigens, not just search pattern
-                results = []
-                for match in matching_cells:
-                    # Get all reactions for this cell from the matrix
-                    antigram_id = match['antigram_id']
-                    cell_number = match['cell_number']
-                    matrix = antigram_manager.antigram_matrices[antigram_id]
-                    
-                    # Get all reactions for this cell
-                    cell_reactions = {}
-                    if cell_number in matrix.index:
-                        cell_row = matrix.loc[cell_number]
-                        for antigen in antigen_list:
-                            cell_reactions[antigen] = cell_row.get(antigen, '-')
-                    
-                    results.append({
-                        "antigram": {
-                            "id": match['antigram_id'],
-                            "name": match['template_name'],
-                            "lot_number": match['lot_number'],
-                            "expiration_date": str(match['expiration_date']),
-                        },
-                        "cell": {
-                            "cell_number": match['cell_number'],
-                            "reactions": cell_reactions
-                        }
-                    })
+                # Expired lots are searched only on request (includeArchived or ?include_archived=true)
+                include_archived = wants_archived(data.get("includeArchived", request.args.get("include_archived")))
+
+                limit = data.get("limit")
+                if limit is not None:
+                    if isinstance(limit, bool) or not isinstance(limit, int) or limit < 1:
+                        return jsonify({"error": "limit must be a positive integer"}), 400
+                    if limit > max_page_size:
+                        return jsonify({"error": f"At most {max_page_size} results per page"}), 400
+
+                # Reactions cover all antigens, not just the search pattern, unless columns are given
+                columns = data.get("columns")
+                if columns is None:
+                    columns = antigen_list
+                elif not isinstance(columns, list) or not all(isinstance(antigen, str) for antigen in columns):
+                    return jsonify({"error": "columns must be a list of antigen names"}), 400
+
+                # Intersect the index posting lists; rows are built as the results are consumed
+                try:
+                    after = decode_cursor(data["cursor"]) if data.get("cursor") else None
+                    matches = antigram_manager.iter_cells_by_pattern(antigen_profile, reaction_antigens=columns,
+                                                                     include_archived=include_archived, after=after)
+                except ValueError as e:
+                    return jsonify({"error": str(e)}), 400
+
+                if wants_ndjson():
+                    return ndjson_response(page_records(matches, limit))
+
+                results = list(page_records(matches, limit))
+                next_cursor = results.pop()["next_cursor"]
 
                 return jsonify({
                     "results": results, 
-                    "antigens": antigen_list,
-                    "search_pattern": list(antigen_profile.keys())
+                    "antigens": columns,
+                    "search_pattern": list(antigen_profile.keys()),
+                    "next_cursor": next_cursor
                 }), 200
 
         except Exception as e:
@@ -75,12 +133,9 @@ def register_utility_routes(app, db_session):
 
     @app.route("/api/antigens", methods=["GET"])
     def get_all_antigens():
-        """Fetch all distinct antigens from the pandas matrices."""
+        """Fetch all distinct antigens from the antigram metadata."""
         try:
-            all_antigens = set()
-            for matrix in antigram_manager.antigram_matrices.values():
-                all_antigens.update(matrix.columns)
-            antigen_list = sorted(list(all_antigens))
+            antigen_list = antigram_manager.get_all_antigens()
 
             return jsonify({"antigens": antigen_list}), 200
         except Exception as e:
@@ -0,0 +1,8 @@
+"""
+Benchmarks for the antibody identification and antigram storage hot paths.
+
+    python -m benchmarks.run --output benchmarks/baseline.json
+    python -m benchmarks.compare benchmarks/baseline.json /tmp/new.json
+
+See benchmarks/generator.py for the synthetic inventory and patient panels.
+"""
@@ -0,0 +1,106 @@
+"""
+Compare two benchmark reports written by benchmarks.run.
+
+    python -m benchmarks.compare benchmarks/baseline.json /tmp/new.json --threshold 1.2
+
+Prints the median time of every operation in both reports and their ratio, marks
+regressions slower than the threshold, and exits non-zero if any result digest differs
+(the change altered results) or, with --fail-on-regression, if anything regressed.
+Operations the baseline does not cover are listed as NO BASELINE.
+
+Regenerate the baseline (python -m benchmarks.run --output benchmarks/baseline.json)
+in the commit that adds an operation or intentionally changes results.
+"""
+import argparse
+import json
+import sys
+from typing import Dict, List, Tuple
+
+
+def compare_reports(baseline: Dict, current: Dict, threshold: float = 1.2) -> Tuple[List[Dict], List[str]]:
+    """
+    Compare the timings and digests of every scale present in both reports.
+
+    Args:
+        baseline: Report to compare against
+        current: New report
+        threshold: Ratio (current / baseline median) above which an operation is a regression
+
+    Returns:
+        Tuple of (rows with scale, operation, baseline_ms, current_ms, ratio, regression;
+        descriptions of differing result digests)
+    """
+    rows = []
+    mismatches = []
+    for scale, current_scale in current["scales"].items():
+        baseline_scale = baseline["scales"].get(scale)
+        if baseline_scale is None:
+            continue
+        for operation, timing in current_scale["timings"].items():
+            baseline_timing = baseline_scale["timings"].get(operation)
+            if baseline_timing is None:
+                continue
+            baseline_ms = baseline_timing["median_ms"]
+            current_ms = timing["median_ms"]
+            ratio = current_ms / baseline_ms if baseline_ms else float("inf")
+            rows.append({
+                "scale": scale,
+                "operation": operation,
+                "baseline_ms": baseline_ms,
+                "current_ms": current_ms,
+                "ratio": ratio,
+                "regression": ratio > threshold,
+            })
+        for operation, digest in current_scale.get("digests", {}).items():
+            baseline_digest = baseline_scale.get("digests", {}).get(operation)
+            if baseline_digest is not None and baseline_digest != digest:
+                mismatches.append(f"{scale} {operation}: {baseline_digest} -> {digest}")
+    return rows, mismatches
+
+
+def missing_baselines(baseline: Dict, current: Dict) -> List[str]:
+    """Scales and operations of the current report that the baseline has no timing for."""
+    missing = []
+    for scale, current_scale in current["scales"].items():
+        baseline_timings = baseline["scales"].get(scale, {}).get("timings", {})
+        missing.extend(f"{scale} {operation}" for operation in current_scale["timings"] if operation not in baseline_timings)
+    return missing
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Compare two benchmark reports")
+    parser.add_argument("baseline", help="Baseline report (e.g. benchmarks/baseline.json)")
+    parser.add_argument("current", help="New report")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Slowdown ratio treated as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit non-zero on any regression")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    rows, mismatches = compare_reports(baseline, current, args.threshold)
+
+    print(f"baseline {baseline['meta'].get('git_commit')}  current {current['meta'].get('git_commit')}")
+    print(f"{'scale':<10} {'operation':<24} {'baseline':>12} {'current':>12} {'ratio':>8}")
+    for row in rows:
+        flag = "  REGRESSION" if row["regression"] else ""
+        print(f"{row['scale']:<10} {row['operation']:<24} {row['baseline_ms']:>10.2f}ms "
+              f"{row['current_ms']:>10.2f}ms {row['ratio']:>7.2f}x{flag}")
+
+    for mismatch in mismatches:
+        print(f"RESULT CHANGED {mismatch}")
+    # Usually a new operation: regenerate the baseline so its results are checked too
+    for missing in missing_baselines(baseline, current):
+        print(f"NO BASELINE {missing}")
+
+    if mismatches:
+        return 1
+    if args.fail_on_regression and any(row["regression"] for row in rows):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
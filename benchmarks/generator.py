@@ -0,0 +1,128 @@
+import math
+import random
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Sequence
+
+from core.pandas_models import PandasAntigramManager, PandasPatientReactionManager
+from utils.default_rules import DEFAULT_ANTIGEN_ORDER
+
+# Approximate fraction of donors typing positive for each antigen (mixed population)
+ANTIGEN_FREQUENCIES = {
+    "D": 0.85, "C": 0.68, "c": 0.80, "E": 0.29, "e": 0.98, "f": 0.64, "Cw": 0.02, "V": 0.01,
+    "K": 0.09, "k": 0.998, "Kpa": 0.02, "Kpb": 0.999, "Jsa": 0.01, "Jsb": 0.999,
+    "Fya": 0.66, "Fyb": 0.83, "Jka": 0.77, "Jkb": 0.72, "Xga": 0.89, "Lea": 0.22, "Leb": 0.72,
+    "S": 0.55, "s": 0.89, "M": 0.78, "N": 0.72, "P": 0.79, "Lua": 0.08, "Lub": 0.998,
+}
+
+# Antithetical antigens encoded by two alleles of one gene; every cell expresses at least one
+ANTITHETICAL_PAIRS = [
+    ("C", "c"), ("E", "e"), ("K", "k"), ("Kpa", "Kpb"), ("Jsa", "Jsb"),
+    ("Fya", "Fyb"), ("Jka", "Jkb"), ("S", "s"), ("M", "N"), ("Lua", "Lub"),
+]
+
+# Antibodies drawn for synthetic patients
+CLINICAL_ANTIBODIES = ["D", "C", "c", "E", "e", "K", "Fya", "Fyb", "Jka", "Jkb", "S", "s", "M", "Lea"]
+
+
+def _allele_frequency(antigen_frequency: float) -> float:
+    """Allele frequency giving the antigen frequency under Hardy-Weinberg (positive = at least one copy)."""
+    return 1 - math.sqrt(1 - antigen_frequency)
+
+
+def generate_cell_phenotype(rng: random.Random, antigens: Sequence[str] = DEFAULT_ANTIGEN_ORDER) -> Dict[str, str]:
+    """
+    Draw one donor cell phenotype.
+
+    Antithetical pairs are drawn as two alleles so every cell is positive for at least
+    one antigen of each pair; Lewis is drawn as Le(a+b-), Le(a-b+) or Le(a-b-); f is
+    expressed when c and e are both present; other antigens are independent.
+
+    Args:
+        rng: Random source
+        antigens: Antigens to type
+
+    Returns:
+        Dict of {antigen: '+' or '0'}
+    """
+    phenotype = {}
+    for first, second in ANTITHETICAL_PAIRS:
+        frequency = _allele_frequency(ANTIGEN_FREQUENCIES[first])
+        alleles = [rng.random() < frequency for _ in range(2)]
+        phenotype[first] = any(alleles)
+        phenotype[second] = not all(alleles)
+
+    lewis = rng.random()
+    phenotype["Lea"] = lewis < ANTIGEN_FREQUENCIES["Lea"]
+    phenotype["Leb"] = ANTIGEN_FREQUENCIES["Lea"] <= lewis < ANTIGEN_FREQUENCIES["Lea"] + ANTIGEN_FREQUENCIES["Leb"]
+    phenotype["f"] = phenotype["c"] and phenotype["e"] and rng.random() < 0.8
+
+    for antigen in antigens:
+        if antigen not in phenotype:
+            phenotype[antigen] = rng.random() < ANTIGEN_FREQUENCIES.get(antigen, 0.5)
+
+    return {antigen: '+' if phenotype[antigen] else '0' for antigen in antigens}
+
+
+def generate_inventory(antigram_count: int, cell_count: int, seed: int = 0,
+                       antigens: Sequence[str] = DEFAULT_ANTIGEN_ORDER,
+                       expired_fraction: float = 0.3,
+                       antigram_manager: Optional[PandasAntigramManager] = None) -> PandasAntigramManager:
+    """
+    Build an antigram inventory of antigram_count lots with cell_count cells each.
+
+    Args:
+        antigram_count: Number of antigrams (lots)
+        cell_count: Cells per antigram
+        seed: Random seed; the same arguments always produce the same inventory
+        antigens: Antigens typed on every antigram
+        expired_fraction: Fraction of lots with an expiration date in the past
+        antigram_manager: Manager to fill (a new in-memory manager by default)
+
+    Returns:
+        PandasAntigramManager: Manager holding the generated antigrams
+    """
+    rng = random.Random(seed)
+    manager = antigram_manager if antigram_manager is not None else PandasAntigramManager()
+    today = date.today()
+
+    for antigram_id in range(1, antigram_count + 1):
+        cells = [
+            {'cell_number': str(cell_number), 'reactions': generate_cell_phenotype(rng, antigens)}
+            for cell_number in range(1, cell_count + 1)
+        ]
+        offset = -rng.randint(1, 365) if rng.random() < expired_fraction else rng.randint(1, 365)
+        manager.create_antigram_matrix(
+            antigram_id, f"BENCH{antigram_id:05d}", "Benchmark Panel", list(antigens),
+            cells, today + timedelta(days=offset)
+        )
+    return manager
+
+
+def generate_patient_panel(antigram_manager: PandasAntigramManager, seed: int = 0,
+                           antibodies: Optional[List[str]] = None, panel_antigrams: int = 3,
+                           reaction_manager: Optional[PandasPatientReactionManager] = None) -> PandasPatientReactionManager:
+    """
+    Simulate a patient tested against a few antigrams of the inventory.
+
+    Args:
+        antigram_manager: Inventory to test against
+        seed: Random seed
+        antibodies: Patient antibodies; one or two random clinical antibodies by default
+        panel_antigrams: Number of antigrams whose cells are all tested
+        reaction_manager: Manager to fill (a new in-memory manager by default)
+
+    Returns:
+        PandasPatientReactionManager: Reactions '+' for cells expressing any antibody's antigen, else '0'
+    """
+    rng = random.Random(seed)
+    if antibodies is None:
+        antibodies = rng.sample(CLINICAL_ANTIBODIES, rng.choice([1, 1, 2]))
+    reactions = reaction_manager if reaction_manager is not None else PandasPatientReactionManager(cell_order=antigram_manager.cell_numbers)
+
+    antigram_ids = list(antigram_manager.antigram_metadata)
+    for antigram_id in rng.sample(antigram_ids, min(panel_antigrams, len(antigram_ids))):
+        matrix = antigram_manager.get_antigram_matrix(antigram_id)
+        for cell_number, row in matrix.iterrows():
+            positive = any(row.get(antibody) == '+' for antibody in antibodies)
+            reactions.add_reaction(antigram_id, cell_number, '+' if positive else '0')
+    return reactions
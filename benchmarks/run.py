@@ -0,0 +1,280 @@
+"""
+Time the identification, cell finder and persistence hot paths on synthetic inventories.
+
+    python -m benchmarks.run --scales 10x11 100x16 500x20 --repeat 5 --output benchmarks/baseline.json
+
+Each scale is ANTIGRAMSxCELLS. The output JSON records the median and minimum wall time
+of every operation along with a digest of its result, so two runs (e.g. before and after
+a change) can be compared for both speed and identical output with benchmarks.compare.
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Any, Callable, Dict, List, Tuple
+import logging
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from models import Base
+from connect_connector import create_sqlite_engine
+from core.pandas_models import PandasAntigramManager
+from core.enhanced_antibody_identifier import EnhancedAntibodyIdentifier
+from core.antibody_rule_evaluator import AntibodyRuleEvaluator
+from utils.default_rules import get_default_rules
+from benchmarks.generator import generate_inventory, generate_patient_panel
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCALES = ["10x11", "100x16", "500x20"]
+
+# Cell finder queries: typical antigen-negative units requested for patients with antibodies
+CELL_FINDER_PATTERNS = [
+    {"K": "0"},
+    {"D": "0", "K": "0"},
+    {"C": "0", "E": "0", "K": "0"},
+    {"Fya": "0", "Jka": "0"},
+    {"c": "0", "E": "0", "K": "0", "Jkb": "0"},
+    {"E": "0", "K": "0", "Fya": "0", "Jkb": "0", "S": "0"},
+]
+
+# Patient panels identified together by the identify_batch operation
+BATCH_PANELS = 100
+
+# Results per page of the find_cells_first_page operation
+CELL_FINDER_PAGE_SIZE = 50
+
+
+def parse_scale(scale: str) -> Tuple[int, int]:
+    """Parse 'ANTIGRAMSxCELLS' (e.g. '100x16')."""
+    antigrams, cells = scale.lower().split("x")
+    return int(antigrams), int(cells)
+
+
+def benchmark_rules() -> List[Dict]:
+    """The default rule set, shaped like rules loaded from the database."""
+    return [
+        {"id": rule_id, "enabled": True, **rule}
+        for rule_id, rule in enumerate(get_default_rules(), start=1)
+    ]
+
+
+def _canonical(value: Any) -> Any:
+    """JSON fallback: sets become sorted lists so their hash does not depend on iteration order."""
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    return str(value)
+
+
+def result_digest(result: Any) -> str:
+    """Short stable hash of a JSON-serializable result."""
+    text = json.dumps(result, sort_keys=True, default=_canonical)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def time_operation(operation: Callable[[], Any], repeat: int, warmup: int = 1) -> Tuple[Dict, Any]:
+    """
+    Run an operation warmup + repeat times and summarise the timed runs.
+
+    Args:
+        operation: Zero-argument callable
+        repeat: Number of timed runs
+        warmup: Untimed runs first (populate caches, first inserts)
+
+    Returns:
+        Tuple of ({'median_ms', 'min_ms', 'runs'}, result of the last run)
+    """
+    result = None
+    for _ in range(warmup):
+        result = operation()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = operation()
+        durations.append((time.perf_counter() - start) * 1000)
+    return {
+        "median_ms": round(statistics.median(durations), 3),
+        "min_ms": round(min(durations), 3),
+        "runs": repeat,
+    }, result
+
+
+def run_scale(antigram_count: int, cell_count: int, repeat: int, seed: int, workdir: str) -> Dict:
+    """
+    Benchmark every operation on one inventory size.
+
+    Args:
+        antigram_count: Antigrams in the inventory
+        cell_count: Cells per antigram
+        repeat: Timed runs per operation
+        seed: Random seed for the inventory and patient panel
+        workdir: Directory for the scale's SQLite database
+
+    Returns:
+        Dict with the scale, per-operation timings and result digests
+    """
+    rules = benchmark_rules()
+    inventory = generate_inventory(antigram_count, cell_count, seed=seed)
+    reactions = generate_patient_panel(inventory, seed=seed)
+
+    # Same tuned SQLite profile as the app's local database
+    engine = create_sqlite_engine(os.path.join(workdir, f'bench_{antigram_count}x{cell_count}.db'))
+    Base.metadata.create_all(engine)
+    db_session = scoped_session(sessionmaker(bind=engine))
+    inventory.db_session = db_session
+
+    timings = {}
+    digests = {}
+
+    def identify():
+        identifier = EnhancedAntibodyIdentifier(inventory, reactions)
+        return identifier.identify_antibodies(rules)
+
+    timings["identify_antibodies"], result = time_operation(identify, repeat)
+    digests["identify_antibodies"] = result_digest(result)
+    suspected = result["suspected_antibodies"]
+
+    def evaluate():
+        return AntibodyRuleEvaluator(inventory, reactions).evaluate_all_rules(rules, suspected)
+
+    timings["evaluate_all_rules"], result = time_operation(evaluate, repeat)
+    # Ruled out antigens are collected in a set, so their order varies between processes
+    digests["evaluate_all_rules"] = result_digest({**result, "ruled_out_antigens": sorted(result["ruled_out_antigens"])})
+
+    def find_cells():
+        return [inventory.find_cells_by_pattern(pattern) for pattern in CELL_FINDER_PATTERNS]
+
+    timings["find_cells_by_pattern"], result = time_operation(find_cells, repeat)
+    digests["find_cells_by_pattern"] = result_digest(result)
+
+    def find_cells_first_page():
+        # Time to the first page of results, which should not grow with the inventory
+        return [list(islice(inventory.iter_cells_by_pattern(pattern), CELL_FINDER_PAGE_SIZE))
+                for pattern in CELL_FINDER_PATTERNS]
+
+    timings["find_cells_first_page"], result = time_operation(find_cells_first_page, repeat)
+    digests["find_cells_first_page"] = result_digest(result)
+
+    panels = [
+        [(antigram_id, cell_number, reaction)
+         for (antigram_id, cell_number), reaction in
+         generate_patient_panel(inventory, seed=seed + offset).iter_reactions()]
+        for offset in range(BATCH_PANELS)
+    ]
+
+    def identify_batch():
+        return EnhancedAntibodyIdentifier(inventory, reactions).identify_batch(panels, rules)
+
+    timings["identify_batch"], result = time_operation(identify_batch, repeat)
+    digests["identify_batch"] = result_digest(result)
+
+    # The warmup run inserts every antigram; timed runs rewrite them all
+    timings["save_all_to_database"], _ = time_operation(inventory.save_all_to_database, repeat)
+
+    def load():
+        db_session.remove()
+        manager = PandasAntigramManager()
+        manager.load_from_database(db_session)
+        return manager
+
+    timings["load_from_database"], manager = time_operation(load, repeat)
+    # Expiration dates are generated relative to today, so leave them out of the digest
+    digests["load_from_database"] = result_digest([
+        (antigram_id, {key: value for key, value in metadata.items() if key != "expiration_date"})
+        for antigram_id, metadata in sorted(manager.antigram_metadata.items())
+    ])
+
+    def load_and_index():
+        # Cold start: metadata load, then every matrix fetched and indexed for the first ABID
+        manager = load()
+        manager.expression_index
+        return manager
+
+    timings["load_and_index"], manager = time_operation(load_and_index, repeat)
+    digests["load_and_index"] = result_digest(
+        {antigram_id: manager.get_antigram_matrix(antigram_id).to_dict() for antigram_id in manager.antigram_metadata}
+    )
+
+    db_session.remove()
+    engine.dispose()
+    return {
+        "antigrams": antigram_count,
+        "cells_per_antigram": cell_count,
+        "patient_reactions": reactions.reaction_count,
+        "timings": timings,
+        "digests": digests,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(scales: List[str], repeat: int, seed: int) -> Dict:
+    """Benchmark every scale and return the JSON-serializable report."""
+    report = {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "sqlalchemy": sqlalchemy.__version__,
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "seed": seed,
+        },
+        "scales": {},
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for scale in scales:
+            antigram_count, cell_count = parse_scale(scale)
+            logger.info(f"Benchmarking {antigram_count} antigrams x {cell_count} cells")
+            report["scales"][scale] = run_scale(antigram_count, cell_count, repeat, seed, workdir)
+    return report
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark antibody identification and antigram storage")
+    parser.add_argument("--scales", nargs="+", default=DEFAULT_SCALES, help="Inventory sizes as ANTIGRAMSxCELLS")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per operation")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for the synthetic data")
+    parser.add_argument("--output", help="Write the JSON report here (default: stdout)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    report = run(args.scales, args.repeat, args.seed)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    for scale, result in report["scales"].items():
+        summary = ", ".join(f"{name} {timing['median_ms']:.1f}ms" for name, timing in result["timings"].items())
+        print(f"{scale}: {summary}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,92 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 
-def connect_with_connector():
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+def create_sqlite_engine(path: str = "local.db") -> Engine:
+    """
+    Create an engine for a SQLite database file, tuned for a threaded server.
+
+    Every pooled connection is set up with:
+      - journal_mode=WAL: readers keep reading while a writer commits
+      - busy_timeout (SQLITE_BUSY_TIMEOUT_MS, default 5000): writers wait for the
+        write lock instead of failing with "database is locked"
+      - synchronous (SQLITE_SYNCHRONOUS, default NORMAL): safe with WAL, one fsync per checkpoint
+      - cache_size (SQLITE_CACHE_SIZE_KB, default 65536) and mmap_size
+        (SQLITE_MMAP_SIZE_MB, default 256): page cache and memory-mapped reads
+
+    Args:
+        path: Database file path
+
+    Returns:
+        Engine: Pooled engine (SQLITE_POOL_SIZE connections, default 5)
+    """
+    busy_timeout_ms = _env_int("SQLITE_BUSY_TIMEOUT_MS", 5000)
+    synchronous = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+    if synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+        raise ValueError(f"Invalid SQLITE_SYNCHRONOUS: {synchronous}")
+    cache_size_kb = _env_int("SQLITE_CACHE_SIZE_KB", 65536)
+    mmap_size = _env_int("SQLITE_MMAP_SIZE_MB", 256) * 1024 * 1024
+
+    engine = create_engine(
+        f"sqlite:///{path}",
+        connect_args={"timeout": busy_timeout_ms / 1000},
+        pool_size=_env_int("SQLITE_POOL_SIZE", 5),
+        max_overflow=_env_int("SQLITE_MAX_OVERFLOW", 10),
+        echo=False
+    )
+
+    @event.listens_for(engine, "connect")
+    def configure_connection(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute(f"PRAGMA busy_timeout={busy_timeout_ms}")
+            cursor.execute(f"PRAGMA synchronous={synchronous}")
+            # Negative sizes are in KiB rather than pages
+            cursor.execute(f"PRAGMA cache_size=-{cache_size_kb}")
+            cursor.execute(f"PRAGMA mmap_size={mmap_size}")
+        finally:
+            cursor.close()
+
+    return engine
+
+
+def create_mysql_engine(creator) -> Engine:
+    """
+    Create a pooled MySQL engine.
+
+    Pool sizing comes from DB_POOL_SIZE (default 10), DB_MAX_OVERFLOW (5),
+    DB_POOL_TIMEOUT (seconds, 60) and DB_POOL_RECYCLE (seconds, 3600); size the
+    pool to the server's threads per worker so requests do not queue for a connection.
+
+    Args:
+        creator: Returns a new DBAPI connection (e.g. from the Cloud SQL connector)
+    """
+    return create_engine(
+        "mysql+pymysql://",
+        creator=creator,
+        pool_size=_env_int("DB_POOL_SIZE", 10),
+        max_overflow=_env_int("DB_MAX_OVERFLOW", 5),
+        pool_timeout=_env_int("DB_POOL_TIMEOUT", 60),
+        pool_recycle=_env_int("DB_POOL_RECYCLE", 3600),
+        pool_pre_ping=True,  # Enable connection health checks
+        echo=False
+    )
+
+
+def connect_with_connector() -> Engine:
+    """
+    Create the application's engine: SQLite (local.db) when USE_LOCAL_DB is true,
+    otherwise Google Cloud SQL for MySQL.
+    """
     # Use SQLite for local development
     if os.getenv("USE_LOCAL_DB", "false").lower() == "true":
-        engine = create_engine("sqlite:///local.db", echo=False)
+        engine = create_sqlite_engine("local.db")
         print("Using local SQLite database")
         return engine
 
@@ -29,16 +111,7 @@ def connect_with_connector():
         )
         return conn
 
-    engine = create_engine(
-        "mysql+pymysql://",
-        creator=getconn,
-        pool_size=10,  # Increased pool size
-        max_overflow=5,  # Increased overflow
-        pool_timeout=60,  # Increased timeout
-        pool_recycle=3600,  # Increased recycle time
-        pool_pre_ping=True,  # Enable connection health checks
-        echo=False
-    )
+    engine = create_mysql_engine(getconn)
     print("Using Google Cloud SQL database")
     return engine
 
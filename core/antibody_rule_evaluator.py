@@ -1,58 +1,78 @@
 import pandas as pd
 import numpy as np
 from typing import Dict, List, Set, Tuple, Optional, Any
+from core.inventory_snapshot import InventorySnapshot
 from core.pandas_models import PandasAntigramManager, PandasPatientReactionManager
+from core.rule_compiler import CompiledRulePlan, get_compiled_plan
 import json
 
 class AntibodyRuleEvaluator:
     """
     Evaluates antibody rules against patient reaction data.
     Supports all rule types: ABSpecificRO, Homo, Hetero, SingleAG, LowF
-    Now optimized with set operations for improved performance.
+    Rules are compiled into a cached vectorized plan (see core.rule_compiler) and
+    evaluated against bit-packed antigen expression bitmaps.
+    
+    Every bitmap is read from one inventory snapshot, pinned on first use (or given),
+    so antigrams changed meanwhile by other requests never mix into an evaluation.
     """
     
     def __init__(self, antigram_manager: PandasAntigramManager, 
-                 patient_reaction_manager: PandasPatientReactionManager):
+                 patient_reaction_manager: PandasPatientReactionManager,
+                 snapshot: Optional[InventorySnapshot] = None):
         self.antigram_manager = antigram_manager
         self.patient_reaction_manager = patient_reaction_manager
+        self._snapshot = snapshot
         
-        # Cache for set-based operations
-        self._antigen_cell_sets = {}
-        self._patient_reaction_sets = {}
+        # Cache for bitmap-based operations
+        self._negative_cells = None
         self._sets_initialized = False
     
+    @property
+    def snapshot(self) -> InventorySnapshot:
+        """The inventory snapshot every evaluation reads, pinned on first use."""
+        if self._snapshot is None:
+            self._snapshot = self.antigram_manager.snapshot()
+        return self._snapshot
+    
+    @property
+    def expression_index(self):
+        """The expression index of the pinned inventory snapshot (built on first use)."""
+        return self.snapshot.index
+    
     def _initialize_set_cache(self):
-        """Initialize set-based cache for faster rule evaluation."""
+        """Build the bitmap of cells with negative patient reactions."""
         if self._sets_initialized:
             return
         
-        # Build antigen cell sets
-        self._antigen_cell_sets = {}
-        for antigram_id, matrix in self.antigram_manager.antigram_matrices.items():
-            for antigen in matrix.columns:
-                if antigen not in self._antigen_cell_sets:
-                    self._antigen_cell_sets[antigen] = {}
-                
-                # Get cells expressing this antigen
-                antigen_positive = matrix[antigen] == '+'
-                positive_cells = set(antigen_positive[antigen_positive].index)
-                
-                self._antigen_cell_sets[antigen][antigram_id] = positive_cells
-        
-        # Build patient reaction sets
-        self._patient_reaction_sets = {}
-        for antigram_id in self.antigram_manager.antigram_matrices.keys():
-            patient_reactions = self.patient_reaction_manager.get_reactions_for_antigram(antigram_id)
-            
-            negative_cells = set()
-            for cell_number, reaction in patient_reactions.items():
-                if reaction == '0':
-                    negative_cells.add(cell_number)
-            
-            self._patient_reaction_sets[antigram_id] = negative_cells
+        self._negative_cells = self.expression_index.encode(
+            cell for cell, reaction in self.patient_reaction_manager.iter_reactions() if reaction == '0'
+        )
         
         self._sets_initialized = True
     
+    def _collect_ruling_out_cells(self, ruling_out_bitmap: np.ndarray, details: Dict) -> List[Dict]:
+        """
+        Expand a bitmap of ruling out cells into detail records.
+        
+        Args:
+            ruling_out_bitmap: Bitmap of cells that satisfy the rule
+            details: Rule-specific fields added to every record
+            
+        Returns:
+            List of ruling out cell records
+        """
+        ruling_out_cells = []
+        for antigram_id, cell_number in self.expression_index.decode(ruling_out_bitmap):
+            metadata = self.snapshot.metadata[antigram_id]
+            ruling_out_cells.append({
+                'cell_number': cell_number,
+                'lot_number': metadata['lot_number'],
+                'antigram_id': antigram_id,
+                **details
+            })
+        return ruling_out_cells
+    
     def evaluate_rule(self, rule: Dict, suspected_antibody: str = None) -> Tuple[bool, List[Dict]]:
         """
         Evaluate a single antibody rule.
@@ -67,293 +87,33 @@ class AntibodyRuleEvaluator:
         # Initialize set cache if needed
         self._initialize_set_cache()
         
-        rule_type = rule['rule_type']
-        target_antigen = rule['target_antigen']
-        rule_data = rule['rule_data']
-        
-        if rule_type == 'abspecific':
-            return self._evaluate_abspecific_rule(target_antigen, rule_data, suspected_antibody)
-        elif rule_type == 'homo':
-            return self._evaluate_homo_rule(target_antigen, rule_data)
-        elif rule_type == 'hetero':
-            return self._evaluate_hetero_rule(target_antigen, rule_data)
-        elif rule_type == 'single':
-            return self._evaluate_single_rule_optimized(target_antigen, rule_data)
-        elif rule_type == 'lowf':
-            return self._evaluate_lowf_rule(target_antigen, rule_data)
-        else:
+        # A one-rule plan is cheap to compile; keeping it out of the shared plan cache
+        # means looping over rules cannot evict the full rule set's plan
+        plan = CompiledRulePlan([{**rule, 'enabled': True}])
+        if not plan.rules:
             return False, []
-    
-    def _evaluate_single_rule_optimized(self, target_antigen: str, rule_data: Dict) -> Tuple[bool, List[Dict]]:
-        """
-        Evaluate SingleAG([A,B,C,...]) rule using set operations for better performance.
-        Antigens in the SingleAG() category are ruled out when patient is 0 and cell has expression of +.
-        """
-        antigens = rule_data.get('antigens', [])
-        
-        if target_antigen not in antigens:
-            return False, []
-        
-        ruling_out_cells = []
         
-        # Use set operations for faster evaluation
-        if target_antigen in self._antigen_cell_sets:
-            for antigram_id, expressing_cells in self._antigen_cell_sets[target_antigen].items():
-                if antigram_id in self._patient_reaction_sets:
-                    negative_cells = self._patient_reaction_sets[antigram_id]
-                    
-                    # Find cells that express the antigen AND have negative patient reactions
-                    ruling_out_cell_set = expressing_cells & negative_cells
-                    
-                    if ruling_out_cell_set:
-                        metadata = self.antigram_manager.get_antigram_metadata(antigram_id)
-                        for cell_number in ruling_out_cell_set:
-                            ruling_out_cells.append({
-                                'cell_number': cell_number,
-                                'lot_number': metadata['lot_number'],
-                                'antigram_id': antigram_id,
-                                'rule_type': 'single',
-                                'antigen': target_antigen
-                            })
-        
-        is_satisfied = len(ruling_out_cells) >= 1  # At least one cell needed
-        
-        return is_satisfied, ruling_out_cells
+        return plan.evaluate_single(0, self.expression_index, self._negative_cells, suspected_antibody,
+                                    collect_cells=self._collect_ruling_out_cells)
     
-    def _evaluate_abspecific_rule(self, target_antigen: str, rule_data: Dict, suspected_antibody: str) -> Tuple[bool, List[Dict]]:
-        """
-        Evaluate ABSpecificRO(A,B,C,X) rule.
-        Rule out B antigen when patient is 0 for cells with expression B=+, C=+.
-        Must have minimum of X number of occurrences for B antigen to be ruled out.
+    def evaluate_all_rules(self, rules: List[Dict], suspected_antibodies: List[str] = None,
+                           rule_set_version=None) -> Dict[str, Any]:
         """
-        if not suspected_antibody:
-            return False, []
-        
-        antibody = rule_data.get('antibody')
-        antigen1 = rule_data.get('antigen1')  # B in the rule
-        antigen2 = rule_data.get('antigen2')  # C in the rule
-        required_count = rule_data.get('required_count', 1)
-        
-        if antibody != suspected_antibody:
-            return False, []
-        
-        ruling_out_cells = []
-        
-        # Find cells where both antigen1=+ and antigen2=+
-        for antigram_id, matrix in self.antigram_manager.antigram_matrices.items():
-            if antigen1 not in matrix.columns or antigen2 not in matrix.columns:
-                continue
-            
-            # Get patient reactions for this antigram
-            patient_reactions = self.patient_reaction_manager.get_reactions_for_antigram(antigram_id)
-            
-            # Find cells where both antigens are positive
-            antigen1_positive = matrix[antigen1] == '+'
-            antigen2_positive = matrix[antigen2] == '+'
-            both_positive = antigen1_positive & antigen2_positive
-            
-            # Check patient reactions for these cells
-            for cell_number in both_positive[both_positive].index:
-                patient_reaction = patient_reactions.get(cell_number)
-                if patient_reaction == '0':  # Patient is negative
-                    metadata = self.antigram_manager.get_antigram_metadata(antigram_id)
-                    ruling_out_cells.append({
-                        'cell_number': cell_number,
-                        'lot_number': metadata['lot_number'],
-                        'antigram_id': antigram_id,
-                        'rule_type': 'abspecific',
-                        'antigen1': antigen1,
-                        'antigen2': antigen2
-                    })
-        
-        is_satisfied = len(ruling_out_cells) >= required_count
-        
-        return is_satisfied, ruling_out_cells
-    
-    def _evaluate_homo_rule(self, target_antigen: str, rule_data: Dict) -> Tuple[bool, List[Dict]]:
-        """
-        Evaluate Homo[(A,B),] rule.
-        A antigen will be ruled out when patient is 0 for cells with expression A=+, B=0.
-        """
-        antigen_pairs = rule_data.get('antigen_pairs', [])
-        ruling_out_cells = []
-        
-        for antigen_a, antigen_b in antigen_pairs:
-            if antigen_a == target_antigen:
-                # Find cells where A=+ and B=0
-                for antigram_id, matrix in self.antigram_manager.antigram_matrices.items():
-                    if antigen_a not in matrix.columns or antigen_b not in matrix.columns:
-                        continue
-                    
-                    # Get patient reactions for this antigram
-                    patient_reactions = self.patient_reaction_manager.get_reactions_for_antigram(antigram_id)
-                    
-                    # Find cells where A=+ and B=0
-                    antigen_a_positive = matrix[antigen_a] == '+'
-                    antigen_b_negative = matrix[antigen_b] == '0'
-                    matching_cells = antigen_a_positive & antigen_b_negative
-                    
-                    # Check patient reactions for these cells
-                    for cell_number in matching_cells[matching_cells].index:
-                        patient_reaction = patient_reactions.get(cell_number)
-                        if patient_reaction == '0':  # Patient is negative
-                            metadata = self.antigram_manager.get_antigram_metadata(antigram_id)
-                            ruling_out_cells.append({
-                                'cell_number': cell_number,
-                                'lot_number': metadata['lot_number'],
-                                'antigram_id': antigram_id,
-                                'rule_type': 'homozygous',
-                                'antigen_a': antigen_a,
-                                'antigen_b': antigen_b
-                            })
-        
-        is_satisfied = len(ruling_out_cells) >= 1  # At least one cell needed
-        
-        return is_satisfied, ruling_out_cells
-    
-    def _evaluate_hetero_rule(self, target_antigen: str, rule_data: Dict) -> Tuple[bool, List[Dict]]:
-        """
-        Evaluate Hetero(A,B,X) rule.
-        Can rule out A antigen when patient is 0 for cells with expression A=+, B=+.
-        Must have X number of cells/occurrence to successfully rule out A antigen.
-        """
-        antigen_a = rule_data.get('antigen_a')
-        antigen_b = rule_data.get('antigen_b')
-        required_count = rule_data.get('required_count', 3)
-        
-        if antigen_a != target_antigen:
-            return False, []
-        
-        ruling_out_cells = []
-        
-        # Find cells where both A=+ and B=+
-        for antigram_id, matrix in self.antigram_manager.antigram_matrices.items():
-            if antigen_a not in matrix.columns or antigen_b not in matrix.columns:
-                continue
-            
-            # Get patient reactions for this antigram
-            patient_reactions = self.patient_reaction_manager.get_reactions_for_antigram(antigram_id)
-            
-            # Find cells where both antigens are positive
-            antigen_a_positive = matrix[antigen_a] == '+'
-            antigen_b_positive = matrix[antigen_b] == '+'
-            both_positive = antigen_a_positive & antigen_b_positive
-            
-            # Check patient reactions for these cells
-            for cell_number in both_positive[both_positive].index:
-                patient_reaction = patient_reactions.get(cell_number)
-                if patient_reaction == '0':  # Patient is negative
-                    metadata = self.antigram_manager.get_antigram_metadata(antigram_id)
-                    ruling_out_cells.append({
-                        'cell_number': cell_number,
-                        'lot_number': metadata['lot_number'],
-                        'antigram_id': antigram_id,
-                        'rule_type': 'heterozygous',
-                        'antigen_a': antigen_a,
-                        'antigen_b': antigen_b
-                    })
-        
-        is_satisfied = len(ruling_out_cells) >= required_count
-        
-        return is_satisfied, ruling_out_cells
-    
-    def _evaluate_single_rule(self, target_antigen: str, rule_data: Dict) -> Tuple[bool, List[Dict]]:
-        """
-        Evaluate SingleAG([A,B,C,...]) rule.
-        Antigens in the SingleAG() category are ruled out when patient is 0 and cell has expression of +.
-        """
-        antigens = rule_data.get('antigens', [])
-        
-        if target_antigen not in antigens:
-            return False, []
-        
-        ruling_out_cells = []
-        
-        # Find cells where target antigen is positive
-        for antigram_id, matrix in self.antigram_manager.antigram_matrices.items():
-            if target_antigen not in matrix.columns:
-                continue
-            
-            # Get patient reactions for this antigram
-            patient_reactions = self.patient_reaction_manager.get_reactions_for_antigram(antigram_id)
-            
-            # Find cells where target antigen is positive
-            antigen_positive = matrix[target_antigen] == '+'
-            
-            # Check patient reactions for these cells
-            for cell_number in antigen_positive[antigen_positive].index:
-                patient_reaction = patient_reactions.get(cell_number)
-                if patient_reaction == '0':  # Patient is negative
-                    metadata = self.antigram_manager.get_antigram_metadata(antigram_id)
-                    ruling_out_cells.append({
-                        'cell_number': cell_number,
-                        'lot_number': metadata['lot_number'],
-                        'antigram_id': antigram_id,
-                        'rule_type': 'single',
-                        'antigen': target_antigen
-                    })
-        
-        is_satisfied = len(ruling_out_cells) >= 1  # At least one cell needed
-        
-        return is_satisfied, ruling_out_cells
-    
-    def _evaluate_lowf_rule(self, target_antigen: str, rule_data: Dict) -> Tuple[bool, List[Dict]]:
-        """
-        Evaluate LowF([A,B,C,…]) rule.
-        Antigens in the LowF() category are automatically ruled out due to low prevalence.
-        """
-        antigens = rule_data.get('antigens', [])
-        
-        if target_antigen in antigens:
-            # Low frequency antigens are automatically ruled out
-            return True, [{'rule_type': 'lowf', 'antigen': target_antigen, 'reason': 'low_prevalence'}]
-        
-        return False, []
-    
-    def evaluate_all_rules(self, rules: List[Dict], suspected_antibodies: List[str] = None) -> Dict[str, Any]:
-        """
-        Evaluate all rules for all antigens.
+        Evaluate all rules for all antigens using the compiled rule plan.
         
         Args:
             rules: List of rule dictionaries
             suspected_antibodies: List of suspected antibodies (for ABSpecificRO rules)
+            rule_set_version: Optional version key for the compiled plan cache
             
         Returns:
             Dict with ruled_out antigens and their ruling out details
         """
-        ruled_out_antigens = set()
-        ruling_out_details = {}
-        
-        for rule in rules:
-            if not rule.get('enabled', True):
-                continue
-            
-            target_antigen = rule['target_antigen']
-            
-            # For ABSpecificRO rules, try with each suspected antibody
-            if rule['rule_type'] == 'abspecific':
-                if suspected_antibodies:
-                    for suspected_antibody in suspected_antibodies:
-                        is_satisfied, ruling_out_cells = self.evaluate_rule(rule, suspected_antibody)
-                        if is_satisfied:
-                            ruled_out_antigens.add(target_antigen)
-                            if target_antigen not in ruling_out_details:
-                                ruling_out_details[target_antigen] = []
-                            ruling_out_details[target_antigen].extend(ruling_out_cells)
-                            break  # Only need one satisfied rule per antigen
-            else:
-                # For other rule types, evaluate normally
-                is_satisfied, ruling_out_cells = self.evaluate_rule(rule)
-                if is_satisfied:
-                    ruled_out_antigens.add(target_antigen)
-                    if target_antigen not in ruling_out_details:
-                        ruling_out_details[target_antigen] = []
-                    ruling_out_details[target_antigen].extend(ruling_out_cells)
+        self._initialize_set_cache()
         
-        return {
-            'ruled_out_antigens': list(ruled_out_antigens),
-            'ruling_out_details': ruling_out_details
-        }
+        plan = get_compiled_plan(rules, rule_set_version)
+        return plan.evaluate(self.expression_index, self._negative_cells, suspected_antibodies,
+                             collect_cells=self._collect_ruling_out_cells)
 
 
 class AntibodyRuleValidator:
@@ -1,18 +1,31 @@
+import numpy as np
 import pandas as pd
 from typing import Dict, List, Set, Tuple, Optional
+from core.inventory_snapshot import InventorySnapshot
 from core.pandas_models import PandasAntigramManager, PandasPatientReactionManager
 
 class AntibodyRuleValidator:
     """
     Comprehensive validator for antibody rules that ensures all antigens have proper rule coverage.
+    Only active lots are validated unless include_archived is set.
     """
     
     def __init__(self, antigram_manager: PandasAntigramManager, 
                  patient_reaction_manager: PandasPatientReactionManager,
-                 db_session=None):
+                 db_session=None, rule_repository=None, include_archived: bool = False):
         self.antigram_manager = antigram_manager
         self.patient_reaction_manager = patient_reaction_manager
         self.db_session = db_session
+        self.rule_repository = rule_repository
+        self.include_archived = include_archived
+        self._snapshot: Optional[InventorySnapshot] = None
+    
+    @property
+    def snapshot(self) -> InventorySnapshot:
+        """The inventory snapshot the validation reads, pinned on first use."""
+        if self._snapshot is None:
+            self._snapshot = self.antigram_manager.snapshot(include_archived=self.include_archived)
+        return self._snapshot
     
     def validate_rule_coverage(self, rules: List[Dict] = None) -> Dict[str, any]:
         """
@@ -48,7 +61,7 @@ class AntibodyRuleValidator:
         
         return {
             'validation_passed': len(missing_antigens) == 0,
-            'total_antigrams_analyzed': len(self.antigram_manager.antigram_matrices),
+            'total_antigrams_analyzed': len(self.snapshot.visible_antigram_ids),
             'total_antigens_in_antigrams': len(antigram_antigens),
             'antigens_with_rules': len(ruled_antigens),
             'missing_antigens': sorted(list(missing_antigens)),
@@ -61,7 +74,9 @@ class AntibodyRuleValidator:
         }
     
     def _load_rules_from_database(self) -> List[Dict]:
-        """Load antibody rules from database."""
+        """Load enabled antibody rules from the rule repository, or the database without one."""
+        if self.rule_repository is not None:
+            return self.rule_repository.rules_as_dicts(enabled_only=True)
         if not self.db_session:
             return []
         
@@ -73,11 +88,8 @@ class AntibodyRuleValidator:
             return []
     
     def _get_all_antigram_antigens(self) -> Set[str]:
-        """Get all unique antigens present in all antigrams."""
-        all_antigens = set()
-        for matrix in self.antigram_manager.antigram_matrices.values():
-            all_antigens.update(matrix.columns)
-        return all_antigens
+        """Get all unique antigens present in all antigrams (from the expression index)."""
+        return set(self.snapshot.index.antigens)
     
     def _get_ruled_antigens(self, rules: List[Dict]) -> Set[str]:
         """Get all antigens that have rules targeting them."""
@@ -88,24 +100,16 @@ class AntibodyRuleValidator:
         return ruled_antigens
     
     def _get_antigens_with_patient_reactions(self) -> Set[str]:
-        """Get antigens that have patient reactions recorded."""
-        antigens_with_reactions = set()
-        
-        for antigram_id, matrix in self.antigram_manager.antigram_matrices.items():
-            patient_reactions = self.patient_reaction_manager.get_reactions_for_antigram(antigram_id)
-            
-            if not patient_reactions:
-                continue
-            
-            # Find antigens that are expressed in cells with patient reactions
-            for cell_number, patient_reaction in patient_reactions.items():
-                if cell_number in matrix.index:
-                    cell_data = matrix.loc[cell_number]
-                    for antigen, cell_reaction in cell_data.items():
-                        if cell_reaction == '+':  # Cell expresses this antigen
-                            antigens_with_reactions.add(antigen)
+        """Get antigens expressed by at least one cell with a patient reaction recorded."""
+        if not self.patient_reaction_manager.reaction_count:
+            return set()
         
-        return antigens_with_reactions
+        index = self.snapshot.index
+        reacted_cells = index.encode(cell for cell, _ in self.patient_reaction_manager.iter_reactions())
+        antigens = index.antigens
+        expressing_cells = index.bitmaps(index.antigen_ids(antigens), '+')
+        expressed = (expressing_cells & reacted_cells).any(axis=1)
+        return {antigens[row] for row in np.flatnonzero(expressed).tolist()}
     
     def _analyze_rule_distribution(self, rules: List[Dict]) -> Dict[str, any]:
         """Analyze the distribution of rule types and target antigens."""
@@ -196,13 +200,14 @@ class AntibodyRuleValidator:
         """Get detailed information about antigens in each antigram."""
         antigram_details = {}
         
-        for antigram_id, matrix in self.antigram_manager.antigram_matrices.items():
-            metadata = self.antigram_manager.get_antigram_metadata(antigram_id)
+        snapshot = self.snapshot
+        for antigram_id in snapshot.visible_antigram_ids:
+            metadata = snapshot.metadata[antigram_id]
             antigram_details[str(antigram_id)] = {
                 'lot_number': metadata.get('lot_number', 'Unknown'),
                 'template_name': metadata.get('name', 'Unknown'),
-                'antigens': sorted(list(matrix.columns)),
-                'cell_count': len(matrix.index)
+                'antigens': sorted(snapshot.index.antigram_antigens(antigram_id)),
+                'cell_count': len(snapshot.index.antigram_cells(antigram_id))
             }
         
         return antigram_details
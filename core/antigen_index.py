@@ -0,0 +1,481 @@
+import numpy as np
+import pandas as pd
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import logging
+import threading
+
+from core.id_registry import IdRegistry
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# A condition is the set of (antigen, reaction value) atoms a cell must satisfy
+Condition = Tuple[Tuple[str, str], ...]
+
+# Number of set bits for every possible byte value, used to popcount packed bitmaps
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(bitmap: np.ndarray) -> int:
+    """Count the set bits in a packed bitmap."""
+    return int(_POPCOUNT_TABLE[bitmap].sum())
+
+
+def popcount_rows(bitmaps: np.ndarray) -> np.ndarray:
+    """Count the set bits in every row of a stacked 2-D array of packed bitmaps."""
+    if bitmaps.size == 0:
+        return np.zeros(len(bitmaps), dtype=np.int64)
+    return _POPCOUNT_TABLE[bitmaps].sum(axis=1, dtype=np.int64)
+
+
+def _set_bits(bitmap: np.ndarray, slots: np.ndarray):
+    """Set the bits for the given slots in a packed bitmap (in place)."""
+    if slots.size:
+        np.bitwise_or.at(bitmap, slots >> 3, (1 << (slots & 7)).astype(np.uint8))
+
+
+def _grow_rows(bitmaps: np.ndarray, rows: int, capacity_bytes: int) -> np.ndarray:
+    """A copy of stacked bitmaps padded with zeros to the given rows and bytes."""
+    grown = np.zeros((rows, capacity_bytes), dtype=np.uint8)
+    grown[:bitmaps.shape[0], :bitmaps.shape[1]] = bitmaps
+    return grown
+
+
+def _remap_rows(bitmaps: np.ndarray, live_slots: np.ndarray, slot_count: int, capacity_bytes: int) -> np.ndarray:
+    """Stacked bitmaps with the bits of live_slots moved to slots 0..len(live_slots)-1."""
+    bits = np.unpackbits(bitmaps, axis=1, bitorder='little')[:, :slot_count]
+    compacted = np.zeros((len(bitmaps), capacity_bytes * 8), dtype=np.uint8)
+    compacted[:, :len(live_slots)] = bits[:, live_slots]
+    return np.packbits(compacted, axis=1, bitorder='little')
+
+
+class AntigenExpressionIndex:
+    """
+    Persistent bit-packed index of antigen expression across the whole antigram inventory.
+
+    Every cell of every antigram is assigned a slot, its dense integer ID, and every
+    antigen a stable integer ID from the index's antigen registry. For each antigen
+    the index keeps one packed bitmap per reaction value (a posting list of the cells
+    typed '+', '0', '-', ...); the bitmaps of a value are the rows of one array, one
+    row per antigen ID. Identification and pattern searches can therefore use
+    word-wide AND/OR and popcount over whole antigen x cell arrays instead of
+    per-antigen or per-cell Python loops, and translate IDs back to names last.
+    The index is maintained by PandasAntigramManager whenever an antigram is created,
+    updated or deleted, on a copy (see copy) once the index is published in an
+    inventory snapshot.
+
+    Rule conditions (e.g. A=+,B=0) registered with condition_bitmaps are materialized
+    too: their bitmaps are computed once from the posting lists, then kept up to date
+    as antigrams are indexed or removed, so identification only intersects them with
+    the patient's reactions.
+    """
+
+    # Values always present in the index (identification relies on them)
+    EXPRESSION_VALUES = ('+', '0')
+
+    def __init__(self):
+        self.version = 0
+        # Antigen IDs outlive clear() so arrays indexed by them stay meaningful
+        self._antigen_ids: IdRegistry[str] = IdRegistry()
+        # Registered rule conditions; their bitmaps are rows of _condition_bitmaps
+        self._conditions: List[Condition] = []
+        self._condition_rows: Dict[Condition, int] = {}
+        self._condition_lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        """Drop every slot and bitmap."""
+        self._capacity_bytes = 0
+        self._slot_count = 0          # High-water mark of allocated slots
+        self._dead_slots = 0          # Slots freed by deleted/updated antigrams
+        self._cell_keys: List[Optional[Tuple[int, Any]]] = []
+        self._slot_lookup: Dict[Tuple[int, str], int] = {}
+        self._antigram_slots: Dict[int, np.ndarray] = {}
+        self._antigram_antigens: Dict[int, List[str]] = {}
+        self._antigen_refcount: Dict[str, int] = {}
+        # Posting lists of each reaction value, one row per antigen ID
+        self._postings: Dict[str, np.ndarray] = {
+            value: np.zeros((len(self._antigen_ids), 0), dtype=np.uint8) for value in self.EXPRESSION_VALUES
+        }
+        self._condition_bitmaps = np.zeros((len(self._conditions), 0), dtype=np.uint8)
+
+    # ---------- Maintenance ----------
+
+    def add_antigram(self, antigram_id: int, matrix: pd.DataFrame):
+        """
+        Index (or re-index) an antigram matrix.
+
+        Args:
+            antigram_id: Unique identifier for the antigram
+            matrix: Matrix with cells as index and antigens as columns
+        """
+        if antigram_id in self._antigram_slots:
+            self._release_antigram(antigram_id)
+
+        cell_count = len(matrix.index)
+        slots = np.arange(self._slot_count, self._slot_count + cell_count, dtype=np.int64)
+        self._ensure_capacity(self._slot_count + cell_count)
+        self._slot_count += cell_count
+
+        for slot, cell_number in zip(slots.tolist(), matrix.index):
+            self._cell_keys.append((antigram_id, cell_number))
+            self._slot_lookup[(antigram_id, str(cell_number))] = slot
+
+        antigens = list(dict.fromkeys(matrix.columns))
+        for antigen in antigens:
+            antigen_id = self._antigen_ids.intern(antigen)
+            column = matrix[antigen].to_numpy(dtype=object)
+            for value in set(column.tolist()):
+                if isinstance(value, str):
+                    _set_bits(self._posting_rows(value)[antigen_id], slots[column == value])
+            self._antigen_refcount[antigen] = self._antigen_refcount.get(antigen, 0) + 1
+        self._set_condition_bits(matrix, slots)
+
+        self._antigram_slots[antigram_id] = slots
+        self._antigram_antigens[antigram_id] = antigens
+        self.version += 1
+
+    def remove_antigram(self, antigram_id: int) -> bool:
+        """Remove an antigram's cells from the index."""
+        if antigram_id not in self._antigram_slots:
+            return False
+        self._release_antigram(antigram_id)
+        if self._dead_slots > 64 and self._dead_slots > self._slot_count // 2:
+            self._compact()
+        self.version += 1
+        return True
+
+    def clear(self):
+        """Remove every cell from the index."""
+        self._reset()
+        self.version += 1
+
+    def copy(self) -> 'AntigenExpressionIndex':
+        """
+        An independent copy to change while readers keep using this index.
+
+        Bitmaps, slot tables and materialized conditions are copied; the antigen ID
+        registry is shared, so antigen IDs stay the same in every copy.
+        """
+        clone = AntigenExpressionIndex.__new__(AntigenExpressionIndex)
+        clone.version = self.version
+        clone._antigen_ids = self._antigen_ids
+        clone._condition_lock = threading.Lock()
+        with self._condition_lock:
+            clone._conditions = list(self._conditions)
+            clone._condition_rows = dict(self._condition_rows)
+            clone._condition_bitmaps = self._condition_bitmaps.copy()
+        clone._capacity_bytes = self._capacity_bytes
+        clone._slot_count = self._slot_count
+        clone._dead_slots = self._dead_slots
+        clone._cell_keys = list(self._cell_keys)
+        clone._slot_lookup = dict(self._slot_lookup)
+        clone._antigram_slots = dict(self._antigram_slots)
+        clone._antigram_antigens = dict(self._antigram_antigens)
+        clone._antigen_refcount = dict(self._antigen_refcount)
+        clone._postings = {value: postings.copy() for value, postings in self._postings.items()}
+        return clone
+
+    def rebuild(self, antigram_matrices: Dict[int, pd.DataFrame]):
+        """Rebuild the index from scratch for the given matrices."""
+        self.clear()
+        for antigram_id, matrix in antigram_matrices.items():
+            self.add_antigram(antigram_id, matrix)
+
+    def _release_antigram(self, antigram_id: int):
+        """Clear every bit owned by an antigram and free its slots."""
+        slots = self._antigram_slots.pop(antigram_id)
+        antigens = self._antigram_antigens.pop(antigram_id)
+
+        if slots.size:
+            released = np.zeros(self._capacity_bytes, dtype=np.uint8)
+            _set_bits(released, slots)
+            antigen_ids = self._antigen_ids.ids(antigens)
+            for postings in self._postings.values():
+                rows = antigen_ids[antigen_ids < len(postings)]
+                postings[rows] &= ~released
+            if self._conditions:
+                self._condition_bitmaps &= ~released
+
+        for antigen in antigens:
+            self._antigen_refcount[antigen] -= 1
+            if self._antigen_refcount[antigen] == 0:
+                del self._antigen_refcount[antigen]
+
+        for slot in slots.tolist():
+            antigram, cell_number = self._cell_keys[slot]
+            self._slot_lookup.pop((antigram, str(cell_number)), None)
+            self._cell_keys[slot] = None
+        self._dead_slots += len(slots)
+
+    def _compact(self):
+        """Drop freed slots so bitmaps stay proportional to the live inventory."""
+        live_slots = np.array([slot for slot, key in enumerate(self._cell_keys) if key is not None], dtype=np.int64)
+        remap = np.full(self._slot_count, -1, dtype=np.int64)
+        remap[live_slots] = np.arange(len(live_slots), dtype=np.int64)
+        new_capacity = max((len(live_slots) + 7) // 8, 1)
+
+        for value, postings in self._postings.items():
+            self._postings[value] = _remap_rows(postings, live_slots, self._slot_count, new_capacity)
+        self._condition_bitmaps = _remap_rows(self._condition_bitmaps, live_slots, self._slot_count, new_capacity)
+
+        self._cell_keys = [self._cell_keys[slot] for slot in live_slots.tolist()]
+        self._slot_lookup = {
+            (antigram_id, str(cell_number)): slot
+            for slot, (antigram_id, cell_number) in enumerate(self._cell_keys)
+        }
+        self._antigram_slots = {
+            antigram_id: remap[slots] for antigram_id, slots in self._antigram_slots.items()
+        }
+        self._slot_count = len(live_slots)
+        self._capacity_bytes = new_capacity
+        self._dead_slots = 0
+        logger.debug(f"Compacted antigen expression index to {self._slot_count} slots")
+
+    def _ensure_capacity(self, slot_count: int):
+        """Grow every bitmap so it can address at least slot_count slots."""
+        needed = (slot_count + 7) // 8
+        if needed <= self._capacity_bytes:
+            return
+        new_capacity = max(needed, self._capacity_bytes * 2, 8)
+        for value, postings in self._postings.items():
+            self._postings[value] = _grow_rows(postings, len(postings), new_capacity)
+        self._condition_bitmaps = _grow_rows(self._condition_bitmaps, len(self._conditions), new_capacity)
+        self._capacity_bytes = new_capacity
+
+    def _posting_rows(self, value: str) -> np.ndarray:
+        """Get the mutable posting lists of a value, with a row for every registered antigen."""
+        postings = self._postings.get(value)
+        if postings is None or len(postings) < len(self._antigen_ids):
+            postings = _grow_rows(postings if postings is not None else np.zeros((0, 0), dtype=np.uint8),
+                                  len(self._antigen_ids), self._capacity_bytes)
+            self._postings[value] = postings
+        return postings
+
+    # ---------- Materialized rule conditions ----------
+
+    def _set_condition_bits(self, matrix: pd.DataFrame, slots: np.ndarray):
+        """Set the bits of a newly indexed antigram's cells in every registered condition."""
+        columns: Dict[str, np.ndarray] = {}
+        for row, condition in enumerate(self._conditions):
+            qualifies = np.ones(len(slots), dtype=bool)
+            for antigen, value in condition:
+                if antigen not in matrix.columns:
+                    qualifies[:] = False
+                    break
+                if antigen not in columns:
+                    columns[antigen] = matrix[antigen].to_numpy(dtype=object)
+                qualifies &= columns[antigen] == value
+            _set_bits(self._condition_bitmaps[row], slots[qualifies])
+
+    def _register_condition(self, condition: Condition) -> int:
+        """Materialize a new condition from the posting lists of its atoms."""
+        bitmap = self.bitmap(*condition[0]).copy()
+        for antigen, value in condition[1:]:
+            bitmap &= self.bitmap(antigen, value)
+        self._condition_bitmaps = np.vstack([self._condition_bitmaps, bitmap[np.newaxis, :]])
+        self._condition_rows[condition] = len(self._conditions)
+        self._conditions.append(condition)
+        return self._condition_rows[condition]
+
+    def condition_bitmaps(self, conditions: Sequence[Condition]) -> np.ndarray:
+        """
+        Bitmaps of the cells satisfying each condition, as one stacked array.
+        Conditions seen for the first time are materialized and then maintained on
+        every later add or remove.
+
+        Args:
+            conditions: Conditions, each a tuple of (antigen, reaction value) atoms
+
+        Returns:
+            numpy.ndarray: Array of shape (len(conditions), bitmap bytes) (a new array)
+        """
+        rows = [self._condition_rows.get(condition) for condition in conditions]
+        if None in rows:
+            with self._condition_lock:
+                rows = [
+                    self._condition_rows[condition] if condition in self._condition_rows
+                    else self._register_condition(condition)
+                    for condition in conditions
+                ]
+        return self._condition_bitmaps[np.array(rows, dtype=np.int64)]
+
+    # ---------- Queries ----------
+
+    @property
+    def antigens(self) -> List[str]:
+        """All antigens present in at least one indexed antigram."""
+        return list(self._antigen_refcount.keys())
+
+    @property
+    def cell_count(self) -> int:
+        """Number of live cells in the index."""
+        return self._slot_count - self._dead_slots
+
+    @property
+    def slot_count(self) -> int:
+        """Number of allocated slots, live or freed; every set bit is below this."""
+        return self._slot_count
+
+    def empty(self) -> np.ndarray:
+        """A new all-zero bitmap sized for the current inventory."""
+        return np.zeros(self._capacity_bytes, dtype=np.uint8)
+
+    def bitmap(self, antigen: str, value: str = '+') -> np.ndarray:
+        """
+        Get the bitmap of cells with the given reaction value for an antigen.
+        The returned array is owned by the index and must not be modified.
+        """
+        antigen_id = self._antigen_ids.id_of(antigen)
+        postings = self._postings.get(value)
+        if antigen_id is None or postings is None or antigen_id >= len(postings):
+            return self.empty()
+        return postings[antigen_id]
+
+    def antigen_ids(self, antigens: Iterable[str]) -> np.ndarray:
+        """Integer IDs of the given antigens (-1 for antigens never indexed)."""
+        return self._antigen_ids.ids(antigens)
+
+    def antigen_names(self, antigen_ids: Iterable[int]) -> List[str]:
+        """Antigen names of the given integer IDs."""
+        return self._antigen_ids.keys(antigen_ids)
+
+    def bitmaps(self, antigen_ids: np.ndarray, value: str = '+') -> np.ndarray:
+        """
+        Stacked bitmaps of the cells with the given reaction value, one row per antigen ID.
+
+        Args:
+            antigen_ids: Antigen IDs (see antigen_ids); unknown IDs (-1) get empty rows
+            value: Reaction value
+
+        Returns:
+            numpy.ndarray: Array of shape (len(antigen_ids), bitmap bytes) (a new array)
+        """
+        antigen_ids = np.asarray(antigen_ids, dtype=np.int64)
+        postings = self._postings.get(value)
+        rows = np.zeros((len(antigen_ids), self._capacity_bytes), dtype=np.uint8)
+        if postings is not None:
+            known = (antigen_ids >= 0) & (antigen_ids < len(postings))
+            rows[known] = postings[antigen_ids[known]]
+        return rows
+
+    def slot_of(self, antigram_id: int, cell_number) -> Optional[int]:
+        """Get the slot of a cell, or None if the cell is not indexed."""
+        return self._slot_lookup.get((antigram_id, str(cell_number)))
+
+    def encode(self, cells: Iterable[Tuple[int, Any]]) -> np.ndarray:
+        """
+        Build a bitmap from (antigram_id, cell_number) pairs.
+        Cells that are not in the index are ignored.
+        """
+        slots = self.cell_slots(cells)
+        bitmap = self.empty()
+        _set_bits(bitmap, slots[slots >= 0])
+        return bitmap
+
+    def cell_slots(self, cells: Iterable[Tuple[int, Any]]) -> np.ndarray:
+        """Slots (integer cell IDs) of (antigram_id, cell_number) pairs as an int64 array (-1 if not indexed)."""
+        lookup = self._slot_lookup.get
+        return np.fromiter(
+            (lookup((antigram_id, str(cell_number)), -1) for antigram_id, cell_number in cells),
+            dtype=np.int64
+        )
+
+    def decode(self, bitmap: np.ndarray) -> List[Tuple[int, Any]]:
+        """Convert a bitmap back to (antigram_id, cell_number) pairs in slot order."""
+        return [self._cell_keys[slot] for slot in self.slots(bitmap).tolist()]
+
+    def slots(self, bitmap: np.ndarray) -> np.ndarray:
+        """Slots of the set bits in a bitmap, in ascending order."""
+        bits = np.unpackbits(bitmap, bitorder='little')[:self._slot_count]
+        return np.flatnonzero(bits)
+
+    def cell_key(self, slot: int) -> Tuple[int, Any]:
+        """(antigram_id, cell_number) of a live slot."""
+        return self._cell_keys[slot]
+
+    def cell_keys(self) -> List[Optional[Tuple[int, Any]]]:
+        """(antigram_id, cell_number) of every slot (None for freed slots), as a new list."""
+        return list(self._cell_keys)
+
+    def antigram_cells(self, antigram_id: int) -> List[Any]:
+        """Cell numbers of an indexed antigram, in matrix order."""
+        slots = self._antigram_slots.get(antigram_id)
+        if slots is None:
+            return []
+        return [self._cell_keys[slot][1] for slot in slots.tolist()]
+
+    def antigram_slots(self, antigram_id: int) -> np.ndarray:
+        """Slots of an indexed antigram's cells, in matrix order (empty if it is not indexed)."""
+        slots = self._antigram_slots.get(antigram_id)
+        return slots if slots is not None else np.empty(0, dtype=np.int64)
+
+    def antigram_antigens(self, antigram_id: int) -> List[str]:
+        """Antigens (matrix columns) of an indexed antigram."""
+        return self._antigram_antigens.get(antigram_id, [])
+
+    def values(self) -> List[str]:
+        """Every reaction value indexed so far."""
+        return list(self._postings.keys())
+
+    def match(self, pattern: Dict[str, str]) -> np.ndarray:
+        """
+        Bitmap of the cells whose reactions match every (antigen, value) pair of a pattern,
+        computed as a k-way intersection of posting lists (rarest first).
+        Cells of antigrams without one of the antigens never match.
+
+        Args:
+            pattern: Dict of {antigen: reaction_value}
+
+        Returns:
+            numpy.ndarray: Packed bitmap of matching cells (a new array)
+        """
+        if not pattern:
+            bitmap = self.empty()
+            for slots in self._antigram_slots.values():
+                _set_bits(bitmap, slots)
+            return bitmap
+
+        postings = []
+        for antigen, value in pattern.items():
+            antigen_id = self._antigen_ids.id_of(antigen)
+            rows = self._postings.get(value) if isinstance(value, str) else None
+            if antigen_id is None or rows is None or antigen_id >= len(rows):
+                return self.empty()
+            postings.append(rows[antigen_id])
+
+        postings.sort(key=popcount)
+        result = postings[0].copy()
+        for posting in postings[1:]:
+            np.bitwise_and(result, posting, out=result)
+            if not result.any():
+                break
+        return result
+
+    def materialize(self, slots: np.ndarray, antigens: List[str], default: str = '-') -> np.ndarray:
+        """
+        Reaction values of the given cells, one row per slot and one column per antigen.
+
+        Args:
+            slots: Cell slots (e.g. from slots(match(...)))
+            antigens: Column antigens
+            default: Value for cells without a posting for an antigen
+
+        Returns:
+            numpy.ndarray: Object array of shape (len(slots), len(antigens))
+        """
+        rows = np.full((len(slots), len(antigens)), default, dtype=object)
+        if not len(slots):
+            return rows
+        byte_positions = slots >> 3
+        bit_masks = (1 << (slots & 7)).astype(np.uint8)
+        antigen_ids = self._antigen_ids.ids(antigens)
+        for value, postings in self._postings.items():
+            columns = np.flatnonzero((antigen_ids >= 0) & (antigen_ids < len(postings)))
+            if not columns.size:
+                continue
+            # Cells x antigens flags of the value for the requested columns
+            has_value = (postings[antigen_ids[columns]][:, byte_positions] & bit_masks).T != 0
+            cell_rows, column_positions = np.nonzero(has_value)
+            rows[cell_rows, columns[column_positions]] = value
+        return rows
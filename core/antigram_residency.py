@@ -0,0 +1,199 @@
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+import pandas as pd
+import logging
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def matrix_nbytes(matrix: pd.DataFrame) -> int:
+    """Approximate memory held by an antigram matrix."""
+    return int(matrix.memory_usage(index=True, deep=True).sum())
+
+
+class AntigramResidencyCache(MutableMapping):
+    """
+    Mapping of antigram ID -> matrix over every known antigram, of which only some
+    are resident in memory.
+
+    Known antigrams are registered without their matrix (e.g. from a metadata-only
+    startup load). Reading a known antigram that is not resident fetches it through
+    ``loader``; resident matrices beyond ``memory_budget_bytes`` are evicted, expired
+    lots first and then least recently used. Antigrams for which ``can_evict``
+    returns False (e.g. unsaved changes) stay resident regardless of the budget.
+
+    Iteration, ``len`` and ``in`` cover every known antigram and never load a matrix;
+    ``items()`` and ``values()`` load each matrix in turn.
+    """
+
+    def __init__(self, loader: Optional[Callable[[List[int]], Dict[int, pd.DataFrame]]] = None,
+                 memory_budget_bytes: Optional[int] = None,
+                 is_expired: Optional[Callable[[int], bool]] = None,
+                 can_evict: Optional[Callable[[int], bool]] = None):
+        self.loader = loader
+        self.memory_budget_bytes = memory_budget_bytes
+        self.is_expired = is_expired or (lambda antigram_id: False)
+        self.can_evict = can_evict or (lambda antigram_id: True)
+
+        self._known: Dict[int, None] = {}  # Insertion-ordered set of known antigram IDs
+        self._resident: 'OrderedDict[int, pd.DataFrame]' = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self._resident_bytes = 0
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ---------- Mapping interface ----------
+
+    def __getitem__(self, antigram_id: int) -> pd.DataFrame:
+        with self._lock:
+            matrix = self._resident.get(antigram_id)
+            if matrix is not None:
+                self._resident.move_to_end(antigram_id)
+                self.hits += 1
+                return matrix
+            if antigram_id not in self._known:
+                raise KeyError(antigram_id)
+
+        matrix = self.load_many([antigram_id]).get(antigram_id)
+        if matrix is None:
+            raise KeyError(antigram_id)
+        return matrix
+
+    def __setitem__(self, antigram_id: int, matrix: pd.DataFrame):
+        with self._lock:
+            self._known[antigram_id] = None
+            self._make_resident(antigram_id, matrix)
+            self._enforce_budget(keep={antigram_id})
+
+    def __delitem__(self, antigram_id: int):
+        with self._lock:
+            if antigram_id not in self._known:
+                raise KeyError(antigram_id)
+            del self._known[antigram_id]
+            self._drop_resident(antigram_id)
+
+    def __iter__(self) -> Iterator[int]:
+        with self._lock:
+            return iter(list(self._known))
+
+    def __len__(self) -> int:
+        return len(self._known)
+
+    def __contains__(self, antigram_id) -> bool:
+        return antigram_id in self._known
+
+    def clear(self):
+        """Forget every antigram without loading any matrix."""
+        with self._lock:
+            self._known.clear()
+            self._resident.clear()
+            self._sizes.clear()
+            self._resident_bytes = 0
+
+    # ---------- Residency ----------
+
+    def register(self, antigram_id: int):
+        """Record a known antigram whose matrix is loaded on first use."""
+        with self._lock:
+            self._known[antigram_id] = None
+
+    def is_resident(self, antigram_id: int) -> bool:
+        return antigram_id in self._resident
+
+    def load_many(self, antigram_ids: Iterable[int]) -> Dict[int, pd.DataFrame]:
+        """
+        Get several matrices, fetching the non-resident ones with one loader call.
+
+        Args:
+            antigram_ids: Known antigram IDs
+
+        Returns:
+            Dict of {antigram_id: matrix} for the IDs that could be loaded
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            for antigram_id in antigram_ids:
+                matrix = self._resident.get(antigram_id)
+                if matrix is not None:
+                    self._resident.move_to_end(antigram_id)
+                    self.hits += 1
+                    found[antigram_id] = matrix
+                elif antigram_id in self._known:
+                    missing.append(antigram_id)
+
+        if missing and self.loader is not None:
+            loaded = self.loader(missing)
+            with self._lock:
+                self.misses += len(missing)
+                for antigram_id, matrix in loaded.items():
+                    # Skip antigrams deleted while the loader ran
+                    if antigram_id in self._known:
+                        self._make_resident(antigram_id, matrix)
+                        found[antigram_id] = matrix
+                self._enforce_budget(keep=set(loaded))
+        return found
+
+    def evict(self, antigram_id: int) -> bool:
+        """Drop a resident matrix (it stays known and is reloaded on next use)."""
+        with self._lock:
+            if antigram_id not in self._resident or self.loader is None:
+                return False
+            self._drop_resident(antigram_id)
+            self.evictions += 1
+            return True
+
+    def _make_resident(self, antigram_id: int, matrix: pd.DataFrame):
+        self._drop_resident(antigram_id)
+        size = matrix_nbytes(matrix)
+        self._resident[antigram_id] = matrix
+        self._sizes[antigram_id] = size
+        self._resident_bytes += size
+
+    def _drop_resident(self, antigram_id: int):
+        if self._resident.pop(antigram_id, None) is not None:
+            self._resident_bytes -= self._sizes.pop(antigram_id)
+
+    def _enforce_budget(self, keep: Iterable[int] = ()) -> int:
+        """Evict expired, then least recently used, matrices until within budget."""
+        if self.memory_budget_bytes is None or self.loader is None:
+            return 0
+        if self._resident_bytes <= self.memory_budget_bytes:
+            return 0
+
+        keep = set(keep)
+        candidates = [antigram_id for antigram_id in self._resident
+                      if antigram_id not in keep and self.can_evict(antigram_id)]
+        expired = [antigram_id for antigram_id in candidates if self.is_expired(antigram_id)]
+        expired_set = set(expired)
+        order = expired + [antigram_id for antigram_id in candidates if antigram_id not in expired_set]
+
+        evicted = 0
+        for antigram_id in order:
+            if self._resident_bytes <= self.memory_budget_bytes:
+                break
+            self._drop_resident(antigram_id)
+            evicted += 1
+        if evicted:
+            self.evictions += evicted
+            logger.debug(f"Evicted {evicted} antigram matrices to stay within the memory budget")
+        return evicted
+
+    def stats(self) -> Dict:
+        """Residency counts, memory use and hit/miss counters."""
+        with self._lock:
+            return {
+                'known_antigrams': len(self._known),
+                'resident_antigrams': len(self._resident),
+                'resident_bytes': self._resident_bytes,
+                'memory_budget_bytes': self.memory_budget_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
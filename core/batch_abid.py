@@ -0,0 +1,272 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+import logging
+
+from core.rule_compiler import get_compiled_plan
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# A panel is a patient's (antigram_id, cell_number, reaction) triples
+Panel = Iterable[Tuple[int, Any, str]]
+
+# Patients evaluated together are capped so the dense patient x cell matrices stay
+# around this many bytes
+_CHUNK_BYTES = 32 * 1024 * 1024
+_MAX_CHUNK_PANELS = 1024
+
+
+def empty_result() -> Dict:
+    """Identification result of a panel without reactions."""
+    return {
+        "ruled_out": [],
+        "stro": [],
+        "matches": [],
+        "progress": {},
+        "ruled_out_details": {},
+        "suspected_antibodies": []
+    }
+
+
+def _unpack(bitmaps: np.ndarray, slot_count: int) -> np.ndarray:
+    """Stacked packed bitmaps as a dense 0/1 float32 matrix, one column per row of bitmaps."""
+    if not len(bitmaps):
+        return np.zeros((slot_count, 0), dtype=np.float32)
+    return np.unpackbits(bitmaps, axis=1, bitorder='little')[:, :slot_count].T.astype(np.float32)
+
+
+def encode_panel(index, panel: Panel) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Slots of a panel's positive and negative cells, or None for a panel without reactions.
+    Later reactions for the same cell replace earlier ones; cells not in the index are ignored.
+    """
+    reactions = {}
+    for antigram_id, cell_number, reaction in panel:
+        reactions[(antigram_id, str(cell_number))] = reaction
+    if not reactions:
+        return None
+    positive, negative = [], []
+    for (antigram_id, cell_number), reaction in reactions.items():
+        slot = index.slot_of(antigram_id, cell_number)
+        if slot is None:
+            continue
+        if reaction == '+':
+            positive.append(slot)
+        elif reaction == '0':
+            negative.append(slot)
+    return np.array(positive, dtype=np.int64), np.array(negative, dtype=np.int64)
+
+
+class BatchIdentificationContext:
+    """
+    Inventory and rule set arrays shared by every panel of a batch.
+
+    Antigen expression and rule conditions are held as dense cells x antigens and
+    cells x conditions matrices, so a chunk of panels (a patients x cells reaction
+    matrix) is identified with a handful of matrix products: match counts per
+    antigen, rule hit counts per condition and, through a conditions x rules term
+    matrix, hit counts per rule. Results are identical to identify_antibodies run
+    on each panel in turn.
+
+    The context holds only numpy arrays and plain data, so it can be sent to the
+    processes of a pool.
+    """
+
+    def __init__(self, index, plan, antigram_metadata: Dict[int, Dict]):
+        self.slot_count = index.slot_count
+        self.antigens = sorted(index.antigens)
+        self._cell_keys = index.cell_keys()
+        self._lot_numbers = {antigram_id: metadata['lot_number'] for antigram_id, metadata in antigram_metadata.items()}
+
+        antigen_ids = index.antigen_ids(self.antigens)
+        expressing = index.bitmaps(antigen_ids, '+')
+        non_expressing = index.bitmaps(antigen_ids, '0')
+        self._expressing = _unpack(expressing, self.slot_count)
+        self._non_expressing = _unpack(non_expressing, self.slot_count)
+        self._conditions = _unpack(plan.condition_masks(index), self.slot_count)
+
+        # Inventory-only totals shared by every panel
+        self._expressing_total = self._expressing.sum(axis=0).astype(np.int64)
+        self._non_expressing_total = self._non_expressing.sum(axis=0).astype(np.int64)
+        self._total_cells = np.maximum(self._expressing, self._non_expressing).sum(axis=0).astype(np.int64)
+
+        # Rule tables: conditions x rules term matrix, per-rule thresholds and gates
+        antigen_columns = {antigen: column for column, antigen in enumerate(self.antigens)}
+        self._rules = plan.rules
+        self._targets = sorted({rule.target_antigen for rule in plan.rules})
+        target_columns = {antigen: column for column, antigen in enumerate(self._targets)}
+        self._terms = np.zeros((len(plan.conditions), len(plan.rules)), dtype=np.float32)
+        self._rule_targets = np.zeros((len(plan.rules), len(self._targets)), dtype=np.float32)
+        self._required = np.zeros(len(plan.rules), dtype=np.int64)
+        self._fixed = np.zeros(len(plan.rules), dtype=bool)
+        # Column of the antigen gating an ABSpecificRO rule; -1 ungated, -2 never suspected
+        self._gates = np.full(len(plan.rules), -1, dtype=np.int64)
+        for rule_index, rule in enumerate(plan.rules):
+            for condition, _ in rule.terms:
+                self._terms[condition, rule_index] += 1
+            self._rule_targets[rule_index, target_columns[rule.target_antigen]] = 1
+            self._required[rule_index] = rule.required_count
+            self._fixed[rule_index] = rule.fixed_details is not None
+            if rule.rule_type == 'abspecific':
+                self._gates[rule_index] = antigen_columns.get(rule.antibody, -2)
+
+    @property
+    def chunk_size(self) -> int:
+        """Panels per chunk, keeping the dense reaction matrices near _CHUNK_BYTES."""
+        return max(1, min(_MAX_CHUNK_PANELS, _CHUNK_BYTES // (8 * max(self.slot_count, 1))))
+
+    def identify(self, encoded_panels: List[Optional[Tuple[np.ndarray, np.ndarray]]],
+                 include_details: bool = False) -> List[Dict]:
+        """
+        Identify a chunk of encoded panels in one vectorized pass.
+
+        Args:
+            encoded_panels: Positive and negative slots of each panel (see encode_panel)
+            include_details: Add progress and ruled_out_details as identify_antibodies does
+
+        Returns:
+            List of results in panel order
+        """
+        present = [position for position, encoded in enumerate(encoded_panels) if encoded is not None]
+        results: List[Dict] = [empty_result() for _ in encoded_panels]
+        if not present:
+            return results
+
+        positive = np.zeros((len(present), self.slot_count), dtype=np.float32)
+        negative = np.zeros((len(present), self.slot_count), dtype=np.float32)
+        for row, position in enumerate(present):
+            positive_slots, negative_slots = encoded_panels[position]
+            positive[row, positive_slots] = 1
+            negative[row, negative_slots] = 1
+
+        # Products of 0/1 matrices are exact cell counts in float32 up to 2**24 cells
+        positive_matches = np.rint(positive @ self._expressing).astype(np.int64)
+        negative_matches = np.rint(negative @ self._non_expressing).astype(np.int64)
+        mismatches = np.rint(negative @ self._expressing + positive @ self._non_expressing).astype(np.int64)
+        suspected = positive_matches > 0
+        meets_criteria = ((positive_matches == self._expressing_total)
+                          & (negative_matches == self._non_expressing_total))
+
+        condition_hits = negative @ self._conditions
+        satisfied = np.rint(condition_hits @ self._terms).astype(np.int64) >= self._required
+        satisfied[:, self._fixed] = True
+        for rule_index in np.flatnonzero(self._gates != -1).tolist():
+            gate = self._gates[rule_index]
+            satisfied[:, rule_index] &= suspected[:, gate] if gate >= 0 else False
+        ruled_out = (satisfied.astype(np.float32) @ self._rule_targets) > 0
+
+        for row, position in enumerate(present):
+            ruled_out_antigens = [self._targets[column] for column in np.flatnonzero(ruled_out[row]).tolist()]
+            ruled_out_set = set(ruled_out_antigens)
+            result = {
+                "ruled_out": ruled_out_antigens,
+                "stro": [a for column, a in enumerate(self.antigens)
+                         if a not in ruled_out_set and not meets_criteria[row, column]],
+                "matches": [a for column, a in enumerate(self.antigens)
+                            if a not in ruled_out_set and meets_criteria[row, column]],
+                "suspected_antibodies": [self.antigens[column] for column in np.flatnonzero(suspected[row]).tolist()],
+            }
+            if include_details:
+                details = self._ruling_out_details(satisfied[row], negative[row])
+                result["progress"] = self._progress(row, positive_matches, negative_matches, mismatches,
+                                                    meets_criteria, details)
+                result["ruled_out_details"] = details
+            else:
+                result["progress"] = {}
+                result["ruled_out_details"] = {}
+            results[position] = result
+        return results
+
+    def _ruling_out_details(self, satisfied: np.ndarray, negative: np.ndarray) -> Dict[str, List[Dict]]:
+        """Ruling out cells of every satisfied rule, in rule order (as CompiledRulePlan.evaluate)."""
+        details: Dict[str, List[Dict]] = {}
+        for rule_index in np.flatnonzero(satisfied).tolist():
+            rule = self._rules[rule_index]
+            if rule.fixed_details is not None:
+                cells = list(rule.fixed_details)
+            else:
+                cells = []
+                for condition, term_details in rule.terms:
+                    for slot in np.flatnonzero(self._conditions[:, condition] * negative).tolist():
+                        antigram_id, cell_number = self._cell_keys[slot]
+                        cells.append({
+                            'cell_number': cell_number,
+                            'lot_number': self._lot_numbers[antigram_id],
+                            'antigram_id': antigram_id,
+                            **term_details
+                        })
+            details.setdefault(rule.target_antigen, []).extend(cells)
+        return details
+
+    def _progress(self, row: int, positive_matches: np.ndarray, negative_matches: np.ndarray,
+                  mismatches: np.ndarray, meets_criteria: np.ndarray, details: Dict) -> Dict:
+        """Per-antigen progress of one panel (as identify_antibodies reports it)."""
+        progress = {}
+        for column, antigen in enumerate(self.antigens):
+            total_cells = int(self._total_cells[column])
+            positive = int(positive_matches[row, column])
+            negative = int(negative_matches[row, column])
+            progress[antigen] = {
+                "total_cells": total_cells,
+                "positive_matches": positive,
+                "negative_matches": negative,
+                "mismatches": int(mismatches[row, column]),
+                "match_percentage": ((positive + negative) / total_cells * 100) if total_cells > 0 else 0,
+                "ruling_out_cells": details.get(antigen, []),
+                "can_be_ruled_out": antigen in details,
+                "meets_match_criteria": bool(meets_criteria[row, column])
+            }
+        return progress
+
+
+# ---------- Process pool workers ----------
+
+_worker_context: Optional[BatchIdentificationContext] = None
+
+
+def _init_worker(context: BatchIdentificationContext):
+    global _worker_context
+    _worker_context = context
+
+
+def _identify_chunk(encoded_panels, include_details: bool) -> List[Dict]:
+    return _worker_context.identify(encoded_panels, include_details)
+
+
+def identify_panels(antigram_manager, panels: List[Panel], rules: List[Dict],
+                    rule_set_key: Hashable = None, include_details: bool = False,
+                    processes: int = None, include_archived: bool = False) -> List[Dict]:
+    """
+    Identify antibodies for many patient panels against the current inventory.
+
+    Args:
+        antigram_manager: Inventory whose expression index the panels refer to
+        panels: Each panel's (antigram_id, cell_number, reaction) triples
+        rules: Enabled antibody rules
+        rule_set_key: Version key for the compiled plan cache
+        include_details: Add per-antigen progress and ruling out cells to every result
+        processes: Spread chunks over this many worker processes (None or 1: in process)
+        include_archived: Identify against the archived (expired) lots too
+
+    Returns:
+        List of results in panel order, shaped like identify_antibodies results
+    """
+    snapshot = antigram_manager.snapshot(include_archived=include_archived)
+    index = snapshot.index
+    plan = get_compiled_plan(rules, rule_set_key)
+    context = BatchIdentificationContext(index, plan, snapshot.metadata)
+
+    encoded = [encode_panel(index, panel) for panel in panels]
+    chunk_size = context.chunk_size
+    chunks = [encoded[start:start + chunk_size] for start in range(0, len(encoded), chunk_size)]
+
+    if processes and processes > 1 and len(chunks) > 1:
+        processes = min(processes, len(chunks))
+        logger.info(f"Identifying {len(panels)} panels in {len(chunks)} chunks on {processes} processes")
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(context,)) as pool:
+            chunk_results = list(pool.map(_identify_chunk, chunks, [include_details] * len(chunks)))
+    else:
+        chunk_results = [context.identify(chunk, include_details) for chunk in chunks]
+
+    return [result for chunk in chunk_results for result in chunk]
@@ -0,0 +1,241 @@
+"""
+Bulk persistence helpers for the pandas managers.
+
+Writes changed rows with one multi-row statement per chunk instead of a
+SELECT ... first() round trip per record:
+
+- SQLite / PostgreSQL: INSERT ... ON CONFLICT (key) DO UPDATE
+- MySQL: INSERT ... ON DUPLICATE KEY UPDATE
+
+Native upserts need a unique index on the key columns. Databases created
+before that index existed (e.g. an old SQLite file built with create_all)
+fall back to one SELECT of the existing keys per chunk followed by a bulk
+UPDATE by primary key and a bulk INSERT.
+"""
+
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy import insert, tuple_, update
+import logging
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 500
+
+# Columns that keep the value from the first insert when a row is upserted
+INSERT_ONLY_COLUMNS = ('created_at',)
+
+# Bound parameters per statement (SQLite builds before 3.32 allow only 999)
+_MAX_PARAMETERS = {'sqlite': 999}
+_DEFAULT_MAX_PARAMETERS = 30000
+
+_unique_key_cache: Dict[Tuple[str, str, Tuple[str, ...]], bool] = {}
+_unique_key_lock = threading.Lock()
+
+
+def _dialect_name(session) -> str:
+    return session.get_bind().dialect.name
+
+
+def _chunks(items: Sequence, size: int) -> Iterable[Sequence]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _chunk_size(session, column_count: int, chunk_size: int) -> int:
+    """Rows per statement that stay under the dialect's bound parameter limit."""
+    max_parameters = _MAX_PARAMETERS.get(_dialect_name(session), _DEFAULT_MAX_PARAMETERS)
+    return max(1, min(chunk_size, max_parameters // max(1, column_count)))
+
+
+def has_unique_key(session, model, key_columns: Sequence[str]) -> bool:
+    """
+    Check whether the database table has a primary key, unique constraint or
+    unique index on exactly the given columns. Results are cached per engine.
+
+    Args:
+        session: SQLAlchemy session
+        model: Mapped model class
+        key_columns: Column names of the key
+
+    Returns:
+        bool: True if a native upsert can use the key
+    """
+    bind = session.get_bind()
+    table_name = model.__table__.name
+    wanted = tuple(sorted(key_columns))
+    cache_key = (str(bind.url), table_name, wanted)
+
+    with _unique_key_lock:
+        if cache_key in _unique_key_cache:
+            return _unique_key_cache[cache_key]
+
+    try:
+        inspector = sa.inspect(session.connection())
+        candidates = [inspector.get_pk_constraint(table_name).get('constrained_columns') or []]
+        candidates.extend(constraint['column_names'] for constraint in inspector.get_unique_constraints(table_name))
+        candidates.extend(index['column_names'] for index in inspector.get_indexes(table_name) if index.get('unique'))
+        found = any(tuple(sorted(columns)) == wanted for columns in candidates)
+    except Exception as e:
+        logger.warning(f"Could not inspect unique keys of {table_name}: {e}")
+        found = False
+
+    if not found:
+        logger.info(f"No unique key on {table_name}({', '.join(wanted)}); using select-then-write upserts")
+    with _unique_key_lock:
+        _unique_key_cache[cache_key] = found
+    return found
+
+
+def _native_upsert_statement(dialect: str, model, chunk: List[Dict], key_columns: Sequence[str],
+                             update_columns: Sequence[str]):
+    """Build a multi-row upsert for the dialect, or None if it has no native upsert."""
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        stmt = dialect_insert(model).values(chunk)
+        if not update_columns:
+            return stmt.on_conflict_do_nothing(index_elements=list(key_columns))
+        return stmt.on_conflict_do_update(
+            index_elements=list(key_columns),
+            set_={column: stmt.excluded[column] for column in update_columns}
+        )
+    if dialect in ('mysql', 'mariadb'):
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+        stmt = dialect_insert(model).values(chunk)
+        # A no-op assignment keeps existing rows untouched when there is nothing to update
+        columns = update_columns or [key_columns[0]]
+        return stmt.on_duplicate_key_update({column: stmt.inserted[column] for column in columns})
+    return None
+
+
+def _key_filter(model, key_columns: Sequence[str], keys: Sequence[Tuple]):
+    if len(key_columns) == 1:
+        return getattr(model, key_columns[0]).in_([key[0] for key in keys])
+    return tuple_(*(getattr(model, column) for column in key_columns)).in_(keys)
+
+
+def _select_then_write(session, model, chunk: List[Dict], key_columns: Sequence[str],
+                       update_columns: Sequence[str]):
+    """Upsert a chunk of unique keys with one SELECT, one bulk UPDATE and one bulk INSERT."""
+    primary_key = model.__table__.primary_key.columns.values()[0].name
+    keys = [tuple(row[column] for column in key_columns) for row in chunk]
+    key_attributes = [getattr(model, column) for column in key_columns]
+    existing = {
+        tuple(found[:-1]): found[-1]
+        for found in session.execute(
+            sa.select(*key_attributes, getattr(model, primary_key)).where(_key_filter(model, key_columns, keys))
+        )
+    }
+
+    updates, inserts = [], []
+    for key, row in zip(keys, chunk):
+        if key not in existing:
+            inserts.append(row)
+        elif update_columns:
+            values = {column: row[column] for column in update_columns}
+            values[primary_key] = existing[key]
+            updates.append(values)
+
+    if updates:
+        session.execute(update(model), updates)
+    if inserts:
+        session.execute(insert(model), inserts)
+
+
+def bulk_upsert(session, model, rows: List[Dict], key_columns: Sequence[str],
+                update_columns: Optional[Sequence[str]] = None,
+                chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    Insert or update many rows keyed on a natural key.
+
+    Args:
+        session: SQLAlchemy session (the statements join its transaction; the caller commits)
+        model: Mapped model class
+        rows: Column values per row; every row must have the same keys
+        key_columns: Columns identifying a row (must be unique in the table)
+        update_columns: Columns to overwrite on existing rows. Defaults to every
+            column in the rows except the key and INSERT_ONLY_COLUMNS.
+        chunk_size: Maximum rows per statement
+
+    Returns:
+        int: Number of rows written
+    """
+    if not rows:
+        return 0
+
+    key_columns = list(key_columns)
+    if update_columns is None:
+        update_columns = [column for column in rows[0]
+                          if column not in key_columns and column not in INSERT_ONLY_COLUMNS]
+
+    # A key may only appear once per multi-row upsert; the last value wins
+    deduplicated = {}
+    for row in rows:
+        deduplicated[tuple(row[column] for column in key_columns)] = row
+    rows = list(deduplicated.values())
+
+    dialect = _dialect_name(session)
+    native = dialect in ('sqlite', 'postgresql', 'mysql', 'mariadb') and has_unique_key(session, model, key_columns)
+    size = _chunk_size(session, len(rows[0]), chunk_size)
+
+    for chunk in _chunks(rows, size):
+        chunk = list(chunk)
+        if native:
+            session.execute(_native_upsert_statement(dialect, model, chunk, key_columns, update_columns))
+        else:
+            _select_then_write(session, model, chunk, key_columns, update_columns)
+
+    logger.debug(f"Upserted {len(rows)} rows into {model.__table__.name} "
+                 f"({'native' if native else 'select-then-write'})")
+    return len(rows)
+
+
+def bulk_insert(session, model, rows: List[Dict], chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    Insert many new rows with multi-row INSERT statements.
+
+    Args:
+        session: SQLAlchemy session (the caller commits)
+        model: Mapped model class
+        rows: Column values per row
+        chunk_size: Maximum rows per statement
+
+    Returns:
+        int: Number of rows inserted
+    """
+    if not rows:
+        return 0
+    for chunk in _chunks(rows, _chunk_size(session, len(rows[0]), chunk_size)):
+        session.execute(insert(model), list(chunk))
+    return len(rows)
+
+
+def bulk_delete(session, model, key_columns: Sequence[str], keys: Iterable[Tuple],
+                chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    Delete rows by key with one DELETE ... WHERE key IN (...) per chunk.
+
+    Args:
+        session: SQLAlchemy session (the caller commits)
+        model: Mapped model class
+        key_columns: Columns identifying a row
+        keys: Key value tuples, in key_columns order
+        chunk_size: Maximum keys per statement
+
+    Returns:
+        int: Number of rows deleted
+    """
+    keys = [tuple(key) for key in keys]
+    if not keys:
+        return 0
+    deleted = 0
+    for chunk in _chunks(keys, _chunk_size(session, len(key_columns), chunk_size)):
+        result = session.execute(sa.delete(model).where(_key_filter(model, key_columns, list(chunk))))
+        deleted += result.rowcount or 0
+    return deleted
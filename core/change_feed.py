@@ -0,0 +1,240 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+import logging
+
+from sqlalchemy import func, or_
+
+from models import ChangeLog
+from core.bulk_persistence import bulk_insert
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Entities whose changes are published to other workers
+ENTITY_ANTIGRAM = 'antigram'
+ENTITY_PATIENT_REACTION = 'patient_reaction'
+ENTITY_TEMPLATE = 'template'
+ENTITY_ANTIBODY_RULES = 'antibody_rules'
+
+OP_UPSERT = 'upsert'
+OP_DELETE = 'delete'
+OP_DELETE_ALL = 'delete_all'
+
+# Skipped versions re-checked per jump in the ID sequence
+MAX_TRACKED_GAPS = 1000
+
+# Identifies this process's own change log rows, which it never needs to apply
+WORKER_ID = f"{socket.gethostname()[:32]}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class Change(NamedTuple):
+    """One change log row as seen by a subscriber."""
+    version: int
+    operation: str
+    key: Optional[str]
+
+
+def reaction_key(antigram_id: int, cell_number) -> str:
+    """Change log key of a patient reaction."""
+    return f"{antigram_id}:{cell_number}"
+
+
+def parse_reaction_key(key: str):
+    """Inverse of reaction_key: (antigram_id, cell_number)."""
+    antigram_id, cell_number = key.split(':', 1)
+    return int(antigram_id), cell_number
+
+
+def record_changes(db_session, entity: str, operation: str = OP_UPSERT, keys: Iterable = (None,)) -> int:
+    """
+    Stage change log rows in the session, to be committed with the change itself.
+
+    Args:
+        db_session: Session holding the uncommitted change
+        entity: One of the ENTITY_* names
+        operation: OP_UPSERT, OP_DELETE or OP_DELETE_ALL
+        keys: Keys of the changed entities (None for whole-entity changes)
+
+    Returns:
+        int: Number of rows staged
+    """
+    now = datetime.now()
+    rows = [
+        {'entity': entity, 'entity_key': None if key is None else str(key), 'operation': operation,
+         'worker_id': WORKER_ID, 'created_at': now}
+        for key in keys
+    ]
+    return bulk_insert(db_session, ChangeLog, rows)
+
+
+class ChangeFeed:
+    """
+    Keeps this worker's in-memory state in step with changes other workers commit.
+
+    Every persisted change appends a row to the change_log table (see record_changes);
+    its auto-increment ID is the version. Before serving a request the worker reads
+    the rows after the last version it applied and hands them, grouped by entity, to
+    the subscribed managers, which reload only the affected records.
+
+    IDs are allocated when a transaction inserts its rows but become visible when it
+    commits, so a later ID can appear before an earlier one. IDs skipped over are
+    re-checked until gap_timeout_seconds has passed (after which the transaction is
+    assumed rolled back). If the rows after our version were pruned, subscribers are
+    asked to resync from scratch. The version only moves past rows once every
+    handler has run, so changes a failing handler missed are retried by the next poll.
+    """
+
+    def __init__(self, db_session, gap_timeout_seconds: float = 60.0,
+                 retention: timedelta = timedelta(hours=24), prune_interval_seconds: float = 3600.0):
+        self.db_session = db_session
+        self.gap_timeout_seconds = gap_timeout_seconds
+        self.retention = retention
+        self.prune_interval_seconds = prune_interval_seconds
+        self._version = 0
+        self._gaps: Dict[int, float] = {}  # Missing version -> monotonic time first noticed
+        self._apply: Dict[str, Callable[[List[Change]], None]] = {}
+        self._resync: Dict[str, Callable[[], None]] = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.monotonic()
+        self.applied = 0
+        self.resyncs = 0
+
+    @property
+    def version(self) -> int:
+        """Highest change log version applied (or skipped as our own) by this worker."""
+        return self._version
+
+    def subscribe(self, entity: str, apply_changes: Callable[[List[Change]], None],
+                  resync: Callable[[], None]):
+        """
+        Register the handlers for one entity.
+
+        Args:
+            entity: ENTITY_* name
+            apply_changes: Called with the entity's changes in version order
+            resync: Called to reload the entity entirely when changes were missed
+        """
+        self._apply[entity] = apply_changes
+        self._resync[entity] = resync
+
+    def start(self):
+        """
+        Start from the current version. Call before loading state from the database,
+        so changes committed during the load are applied (again) by the first poll.
+        """
+        with self._lock:
+            self._version = self.db_session.query(func.max(ChangeLog.id)).scalar() or 0
+            self.db_session.commit()
+        logger.info(f"Change feed starting at version {self._version} (worker {WORKER_ID})")
+
+    def poll(self) -> int:
+        """
+        Apply every change committed by other workers since the last poll.
+
+        Returns:
+            int: Number of change log rows applied
+        """
+        with self._lock:
+            try:
+                applied = self._poll()
+                self._prune_if_due()
+                # End the read transaction so the next poll sees newly committed rows
+                self.db_session.commit()
+                return applied
+            except Exception as e:
+                self.db_session.rollback()
+                logger.error(f"Error applying change feed: {e}")
+                return 0
+
+    def _poll(self) -> int:
+        now = time.monotonic()
+        for missing, noticed in list(self._gaps.items()):
+            if now - noticed > self.gap_timeout_seconds:
+                del self._gaps[missing]
+
+        condition = ChangeLog.id > self._version
+        if self._gaps:
+            condition = or_(condition, ChangeLog.id.in_(list(self._gaps)))
+        rows = self.db_session.query(
+            ChangeLog.id, ChangeLog.entity, ChangeLog.entity_key, ChangeLog.operation, ChangeLog.worker_id
+        ).filter(condition).order_by(ChangeLog.id).all()
+        if not rows:
+            return 0
+
+        first_new = next((row.id for row in rows if row.id > self._version), None)
+        if first_new is not None and first_new > self._version + 1 and self._history_pruned():
+            self._resync_all(max(row.id for row in rows))
+            return len(rows)
+
+        # The new version and gaps are kept aside until every handler has succeeded; if
+        # one raises, the next poll reads (and re-applies) the same rows again
+        version = self._version
+        gaps = dict(self._gaps)
+        changes: Dict[str, List[Change]] = {}
+        for row in rows:
+            gaps.pop(row.id, None)
+            if row.id > version:
+                for missing in range(max(version + 1, row.id - MAX_TRACKED_GAPS), row.id):
+                    gaps.setdefault(missing, now)
+                version = row.id
+            if row.worker_id != WORKER_ID:
+                changes.setdefault(row.entity, []).append(Change(row.id, row.operation, row.entity_key))
+
+        applied = 0
+        for entity, entity_changes in changes.items():
+            apply_changes = self._apply.get(entity)
+            if apply_changes is not None:
+                apply_changes(entity_changes)
+                applied += len(entity_changes)
+
+        self._version = version
+        self._gaps = gaps
+        if applied:
+            self.applied += applied
+            logger.info(f"Applied {applied} changes from other workers (version {self._version})")
+        return applied
+
+    def _history_pruned(self) -> bool:
+        """Whether change log rows right after our version no longer exist."""
+        oldest = self.db_session.query(func.min(ChangeLog.id)).scalar()
+        return oldest is not None and oldest > self._version + 1
+
+    def _resync_all(self, version: int):
+        logger.warning(f"Change log pruned past version {self._version}; reloading all state")
+        for resync in self._resync.values():
+            resync()
+        self._version = version
+        self._gaps.clear()
+        self.resyncs += 1
+
+    def _prune_if_due(self):
+        """Delete rows older than the retention period, at most once per prune interval."""
+        now = time.monotonic()
+        if now - self._last_prune < self.prune_interval_seconds:
+            return
+        self._last_prune = now
+        cutoff = datetime.now() - self.retention
+        # Keep the newest row so the ID sequence cannot restart on databases that reuse IDs
+        newest = self.db_session.query(func.max(ChangeLog.id)).scalar()
+        if newest is None:
+            return
+        deleted = self.db_session.query(ChangeLog).filter(
+            ChangeLog.created_at < cutoff, ChangeLog.id < newest
+        ).delete(synchronize_session=False)
+        if deleted:
+            logger.info(f"Pruned {deleted} change log rows older than {cutoff}")
+
+    def stats(self) -> Dict:
+        """Version, pending gaps and apply counters."""
+        return {
+            'version': self._version,
+            'gaps': len(self._gaps),
+            'applied': self.applied,
+            'resyncs': self.resyncs,
+            'worker_id': WORKER_ID,
+        }
@@ -0,0 +1,125 @@
+import gzip
+import os
+from typing import Optional
+import logging
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+from core.metrics import registry
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+COMPRESSION_BYTES = registry.counter(
+    'bbapp_response_compression_bytes_total',
+    'Bytes of compressed response bodies, before (stage="in") and after (stage="out") compression.',
+    ('encoding', 'stage')
+)
+
+# Bodies worth compressing; images, fonts and the like are already compressed
+COMPRESSIBLE_MIMETYPES = frozenset({
+    'application/json',
+    'application/msgpack',
+    'application/x-msgpack',
+    'application/javascript',
+    'text/javascript',
+    'text/css',
+    'text/html',
+    'text/plain',
+})
+
+
+class ResponseCompressor:
+    """
+    Compresses response bodies with the best encoding the client accepts.
+
+    Brotli is preferred when the brotli package is installed and the client
+    accepts it equally, then gzip. Small bodies, already-encoded bodies,
+    streamed or file responses and non-text types are sent as they are.
+
+    Args:
+        min_bytes: Bodies shorter than this are not compressed
+        gzip_level: gzip compression level (1-9)
+        brotli_quality: Brotli quality (0-11); low values favour speed
+    """
+
+    def __init__(self, min_bytes: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.min_bytes = min_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+    @classmethod
+    def from_env(cls) -> 'ResponseCompressor':
+        """Configure from COMPRESS_MIN_BYTES, COMPRESS_GZIP_LEVEL and COMPRESS_BROTLI_QUALITY."""
+        return cls(
+            min_bytes=int(os.getenv('COMPRESS_MIN_BYTES', '1024')),
+            gzip_level=int(os.getenv('COMPRESS_GZIP_LEVEL', '6')),
+            brotli_quality=int(os.getenv('COMPRESS_BROTLI_QUALITY', '4'))
+        )
+
+    def choose_encoding(self, accept_encodings) -> Optional[str]:
+        """
+        Pick a content coding from a parsed Accept-Encoding header.
+
+        Args:
+            accept_encodings: werkzeug Accept object (request.accept_encodings)
+
+        Returns:
+            str: 'br' or 'gzip', or None to send the body uncompressed
+        """
+        best, best_quality = None, 0
+        for encoding in self.encodings:
+            quality = accept_encodings.quality(encoding)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def _compress(self, data: bytes, encoding: str) -> bytes:
+        if encoding == 'br':
+            return brotli.compress(data, quality=self.brotli_quality)
+        # mtime=0 keeps the output identical for identical bodies
+        return gzip.compress(data, compresslevel=self.gzip_level, mtime=0)
+
+    def compress_response(self, response: Response, accept_encodings) -> Response:
+        """
+        Compress a response in place if it and the client allow it.
+
+        Args:
+            response: Response about to be sent
+            accept_encodings: werkzeug Accept object (request.accept_encodings)
+
+        Returns:
+            Response: The same response
+        """
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+
+        # Caches must key this response by the client's encodings even when sent uncompressed
+        response.vary.add('Accept-Encoding')
+        encoding = self.choose_encoding(accept_encodings)
+        if encoding is None:
+            return response
+        data = response.get_data()
+        if len(data) < self.min_bytes:
+            return response
+
+        compressed = self._compress(data, encoding)
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        # The compressed bytes are a different representation, so a strong validator
+        # becomes weak (If-None-Match compares weakly, so 304s still work)
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        COMPRESSION_BYTES.inc(len(data), encoding=encoding, stage='in')
+        COMPRESSION_BYTES.inc(len(compressed), encoding=encoding, stage='out')
+        return response
@@ -3,20 +3,24 @@ import numpy as np
 from typing import Dict, List, Set, Tuple, Optional, Any
 from core.pandas_models import PandasAntigramManager, PandasPatientReactionManager
 from core.antibody_rule_evaluator import AntibodyRuleEvaluator, AntibodyRuleValidator
+from core.antigen_index import popcount_rows
+from core.batch_abid import Panel, identify_panels
+from core.metrics import time_phase
 
 class EnhancedAntibodyIdentifier:
     """
     Enhanced antibody identification using the new rule evaluation system.
     Replaces the old PandasAntibodyIdentifier with more sophisticated rule-based logic.
-    Now optimized with set theory operations for improved performance.
+    Now optimized with bit-packed antigen expression bitmaps for improved performance.
     """
     
     def __init__(self, antigram_manager: PandasAntigramManager, 
                  patient_reaction_manager: PandasPatientReactionManager,
-                 db_session=None):
+                 db_session=None, rule_repository=None):
         self.antigram_manager = antigram_manager
         self.patient_reaction_manager = patient_reaction_manager
         self.db_session = db_session
+        self.rule_repository = rule_repository
         self.rule_evaluator = AntibodyRuleEvaluator(antigram_manager, patient_reaction_manager)
         self.rule_validator = AntibodyRuleValidator(db_session) if db_session else None
         
@@ -24,15 +28,19 @@ class EnhancedAntibodyIdentifier:
         self._antigen_reactions_cache = {}
         self._all_antigens_cache = None
         
-        # Set-based data structures for Phase 2 optimization
-        self._antigen_sets = {}
+        # Patient reaction bitmaps aligned with the antigen expression index
         self._patient_reaction_sets = {}
         self._sets_initialized = False
     
+    @property
+    def expression_index(self):
+        """The expression index of the inventory snapshot pinned by the rule evaluator."""
+        return self.rule_evaluator.expression_index
+    
     def identify_antibodies(self, rules: List[Dict] = None) -> Dict:
         """
         Main antibody identification algorithm using the enhanced rule system.
-        Now optimized with set theory operations.
+        Now optimized with bit-packed expression bitmaps.
         
         Args:
             rules: List of antibody rules. If None, loads from database.
@@ -41,7 +49,7 @@ class EnhancedAntibodyIdentifier:
             Dict: Results with ruled_out, stro, matches, and detailed information
         """
         # Get all patient reactions
-        if self.patient_reaction_manager.reactions_df.empty:
+        if not self.patient_reaction_manager.reaction_count:
             return {
                 "ruled_out": [],
                 "stro": [],
@@ -52,20 +60,28 @@ class EnhancedAntibodyIdentifier:
             }
         
         # Load rules from database if not provided
-        if rules is None:
-            rules = self._load_rules_from_database()
-        
-        # Get all unique antigens from matrices (cached)
-        all_antigens = self._get_all_antigens()
+        with time_phase('rule_load'):
+            if rules is None:
+                rules = self._load_rules_from_database()
         
-        # Initialize set-based data structures
-        self._initialize_set_structures()
+        with time_phase('set_build'):
+            # Get all unique antigens from matrices (cached)
+            all_antigens = self._get_all_antigens()
+            
+            # Initialize set-based data structures
+            self._initialize_set_structures()
+            
+            # Per-antigen counters, computed over antigen IDs; names only index the rows
+            antigen_order = sorted(all_antigens)
+            statistics = self._compute_antigen_statistics(antigen_order)
         
         # First pass: identify potential antibodies using sets
-        potential_antibodies = self._identify_potential_antibodies_set_based()
+        with time_phase('suspected_antibodies'):
+            potential_antibodies = self._identify_potential_antibodies_set_based(antigen_order, statistics)
         
         # Second pass: evaluate rules to determine ruled out antigens
-        rule_results = self.rule_evaluator.evaluate_all_rules(rules, potential_antibodies)
+        with time_phase('rule_evaluation'):
+            rule_results = self.rule_evaluator.evaluate_all_rules(rules, potential_antibodies)
         ruled_out_antigens = set(rule_results['ruled_out_antigens'])
         ruling_out_details = rule_results['ruling_out_details']
         
@@ -73,18 +89,20 @@ class EnhancedAntibodyIdentifier:
         stro_antigens = set()
         match_antigens = set()
         
-        for antigen in all_antigens:
-            if antigen in ruled_out_antigens:
-                continue
-            
-            # Use set-based match criteria check
-            if self._check_match_criteria_set_based(antigen):
-                match_antigens.add(antigen)
-            else:
-                stro_antigens.add(antigen)
+        with time_phase('match_check'):
+            meets_match_criteria = statistics['meets_match_criteria'].tolist()
+            for row, antigen in enumerate(antigen_order):
+                if antigen in ruled_out_antigens:
+                    continue
+                
+                if meets_match_criteria[row]:
+                    match_antigens.add(antigen)
+                else:
+                    stro_antigens.add(antigen)
         
         # Create progress tracking (optimized)
-        progress = self._create_progress_tracking_set_based(all_antigens, ruling_out_details)
+        with time_phase('progress'):
+            progress = self._create_progress_tracking_set_based(antigen_order, statistics, ruling_out_details)
         
         return {
             "ruled_out": sorted(list(ruled_out_antigens)),
@@ -95,86 +113,58 @@ class EnhancedAntibodyIdentifier:
             "suspected_antibodies": potential_antibodies
         }
     
+    def identify_batch(self, panels: List[Panel], rules: List[Dict] = None, rule_set_version=None,
+                       include_details: bool = False, processes: int = None,
+                       include_archived: bool = False) -> List[Dict]:
+        """
+        Identify antibodies for many patient panels at once, without touching the
+        patient reaction manager. Panels are evaluated as a patients x cells reaction
+        matrix against the inventory (see core.batch_abid).
+        
+        Args:
+            panels: Each panel's (antigram_id, cell_number, reaction) triples
+            rules: List of antibody rules. If None, loads from database.
+            rule_set_version: Optional version key for the compiled plan cache
+            include_details: Add progress and ruled_out_details to every result
+            processes: Spread large batches over this many worker processes
+            include_archived: Identify against the archived (expired) lots too
+            
+        Returns:
+            List of results in panel order, shaped like identify_antibodies results
+            (progress and ruled_out_details are empty unless include_details is set)
+        """
+        if rules is None:
+            rules = self._load_rules_from_database()
+        
+        with time_phase('batch_evaluation', engine='batch'):
+            return identify_panels(self.antigram_manager, panels, rules, rule_set_version,
+                                   include_details=include_details, processes=processes,
+                                   include_archived=include_archived)
+    
     def _initialize_set_structures(self):
-        """Initialize set-based data structures for optimized operations."""
+        """Build patient reaction bitmaps aligned with the antigen expression index."""
         if self._sets_initialized:
             return
         
-        # Initialize patient reaction sets
-        self._patient_reaction_sets = {
-            'positive_cells': set(),  # Cells with positive patient reactions
-            'negative_cells': set(),  # Cells with negative patient reactions
-            'by_antigram': {}         # Patient reactions grouped by antigram
-        }
+        positive_cells = []
+        negative_cells = []
+        for cell, patient_reaction in self.patient_reaction_manager.iter_reactions():
+            if patient_reaction == '+':
+                positive_cells.append(cell)
+            elif patient_reaction == '0':
+                negative_cells.append(cell)
         
-        # Initialize antigen expression sets
-        self._antigen_sets = {
-            'expressing_cells': {},    # antigen -> set of cells expressing it
-            'non_expressing_cells': {} # antigen -> set of cells not expressing it
+        self._patient_reaction_sets = {
+            'positive_cells': self.expression_index.encode(positive_cells),  # Cells with positive patient reactions
+            'negative_cells': self.expression_index.encode(negative_cells)   # Cells with negative patient reactions
         }
         
-        # Build patient reaction sets
-        for antigram_id, matrix in self.antigram_manager.antigram_matrices.items():
-            patient_reactions = self.patient_reaction_manager.get_reactions_for_antigram(antigram_id)
-            antigram_cells = set()
-            
-            for cell_number, patient_reaction in patient_reactions.items():
-                cell_key = f"{antigram_id}_{cell_number}"
-                antigram_cells.add(cell_key)
-                
-                if patient_reaction == '+':
-                    self._patient_reaction_sets['positive_cells'].add(cell_key)
-                elif patient_reaction == '0':
-                    self._patient_reaction_sets['negative_cells'].add(cell_key)
-            
-            self._patient_reaction_sets['by_antigram'][antigram_id] = antigram_cells
-        
-        # Build antigen expression sets
-        all_antigens = self._get_all_antigens()
-        for antigen in all_antigens:
-            expressing_cells = set()
-            non_expressing_cells = set()
-            
-            for antigram_id, matrix in self.antigram_manager.antigram_matrices.items():
-                if antigen not in matrix.columns:
-                    continue
-                
-                # Get cells that express this antigen
-                antigen_positive = matrix[antigen] == '+'
-                antigen_negative = matrix[antigen] == '0'
-                
-                for cell_number in antigen_positive[antigen_positive].index:
-                    cell_key = f"{antigram_id}_{cell_number}"
-                    expressing_cells.add(cell_key)
-                
-                for cell_number in antigen_negative[antigen_negative].index:
-                    cell_key = f"{antigram_id}_{cell_number}"
-                    non_expressing_cells.add(cell_key)
-            
-            self._antigen_sets['expressing_cells'][antigen] = expressing_cells
-            self._antigen_sets['non_expressing_cells'][antigen] = non_expressing_cells
-        
         self._sets_initialized = True
     
-    def _identify_potential_antibodies_set_based(self) -> List[str]:
-        """
-        Identify potential antibodies using set operations.
-        These are antigens that have positive patient reactions and will be used
-        for ABSpecificRO rule evaluation.
+    def _compute_antigen_statistics(self, antigens: List[str]) -> Dict[str, np.ndarray]:
         """
-        potential_antibodies = set()
-        positive_cells = self._patient_reaction_sets['positive_cells']
-        
-        for antigen, expressing_cells in self._antigen_sets['expressing_cells'].items():
-            # If any cell expressing this antigen has a positive patient reaction
-            if expressing_cells & positive_cells:
-                potential_antibodies.add(antigen)
-        
-        return sorted(list(potential_antibodies))
-    
-    def _check_match_criteria_set_based(self, antigen: str) -> bool:
-        """
-        Check if antigen meets the 100% match criteria using set operations.
+        Compute the match counters of the given antigens with bitmap operations over
+        the expression index's stacked posting lists (looked up by antigen ID).
         
         For an antigen to be considered a 100% match, it needs:
         - All expressing cells must have positive patient reactions
@@ -182,29 +172,43 @@ class EnhancedAntibodyIdentifier:
         - NO mismatches allowed
         
         Args:
-            antigen: Antigen name
+            antigens: Antigen names, one result row each
             
         Returns:
-            bool: True if criteria are met (100% perfect match)
+            Dict of arrays with one entry per antigen: positive_matches, negative_matches,
+            mismatches, total_cells and meets_match_criteria
         """
-        expressing_cells = self._antigen_sets['expressing_cells'].get(antigen, set())
-        non_expressing_cells = self._antigen_sets['non_expressing_cells'].get(antigen, set())
+        antigen_ids = self.expression_index.antigen_ids(antigens)
+        expressing_cells = self.expression_index.bitmaps(antigen_ids, '+')
+        non_expressing_cells = self.expression_index.bitmaps(antigen_ids, '0')
         positive_cells = self._patient_reaction_sets['positive_cells']
         negative_cells = self._patient_reaction_sets['negative_cells']
         
-        # All expressing cells must be positive AND all non-expressing cells must be negative
-        expressing_positive = expressing_cells <= positive_cells
-        non_expressing_negative = non_expressing_cells <= negative_cells
+        return {
+            'positive_matches': popcount_rows(expressing_cells & positive_cells),
+            'negative_matches': popcount_rows(non_expressing_cells & negative_cells),
+            'mismatches': popcount_rows(expressing_cells & negative_cells) + popcount_rows(non_expressing_cells & positive_cells),
+            'total_cells': popcount_rows(expressing_cells | non_expressing_cells),
+            # All expressing cells positive AND all non-expressing cells negative
+            'meets_match_criteria': (~(expressing_cells & ~positive_cells).any(axis=1)
+                                     & ~(non_expressing_cells & ~negative_cells).any(axis=1)),
+        }
+    
+    def _identify_potential_antibodies_set_based(self, antigens: List[str], statistics: Dict[str, np.ndarray]) -> List[str]:
+        """
+        Identify potential antibodies: antigens expressed by at least one cell with a
+        positive patient reaction. These are used for ABSpecificRO rule evaluation.
         
-        return expressing_positive and non_expressing_negative
+        Args:
+            antigens: Antigen names in sorted order, as passed to _compute_antigen_statistics
+            statistics: Counters from _compute_antigen_statistics
+        """
+        return [antigens[row] for row in np.flatnonzero(statistics['positive_matches'] > 0).tolist()]
     
     def _get_all_antigens(self) -> Set[str]:
-        """Get all unique antigens from matrices (cached)."""
+        """Get all unique antigens from the expression index (cached)."""
         if self._all_antigens_cache is None:
-            all_antigens = set()
-            for matrix in self.antigram_manager.antigram_matrices.values():
-                all_antigens.update(matrix.columns)
-            self._all_antigens_cache = all_antigens
+            self._all_antigens_cache = set(self.expression_index.antigens)
         return self._all_antigens_cache
     
     def _precompute_antigen_reactions(self, all_antigens: Set[str]):
@@ -212,16 +216,18 @@ class EnhancedAntibodyIdentifier:
         self._antigen_reactions_cache.clear()
         
         # Get all patient reactions once
+        snapshot = self.rule_evaluator.snapshot
         patient_reactions_by_antigram = {}
-        for antigram_id in self.antigram_manager.antigram_matrices.keys():
+        for antigram_id in snapshot.antigram_ids:
             patient_reactions_by_antigram[antigram_id] = self.patient_reaction_manager.get_reactions_for_antigram(antigram_id)
         
         # Pre-compute for each antigen
         for antigen in all_antigens:
             antigen_reactions = []
             
-            for antigram_id, matrix in self.antigram_manager.antigram_matrices.items():
-                if antigen not in matrix.columns:
+            for antigram_id in snapshot.antigram_ids:
+                matrix = self.antigram_manager.get_antigram_matrix(antigram_id)
+                if matrix is None or antigen not in matrix.columns:
                     continue
                 
                 # Get cell reactions for this antigen
@@ -232,7 +238,7 @@ class EnhancedAntibodyIdentifier:
                 for cell_number, cell_reaction in cell_reactions.items():
                     patient_reaction = patient_reactions.get(cell_number)
                     if patient_reaction is not None:
-                        metadata = self.antigram_manager.get_antigram_metadata(antigram_id)
+                        metadata = snapshot.metadata[antigram_id]
                         antigen_reactions.append({
                             'antigram_id': antigram_id,
                             'lot_number': metadata['lot_number'],
@@ -244,7 +250,9 @@ class EnhancedAntibodyIdentifier:
             self._antigen_reactions_cache[antigen] = antigen_reactions
     
     def _load_rules_from_database(self) -> List[Dict]:
-        """Load antibody rules from database."""
+        """Load enabled antibody rules from the rule repository, or the database without one."""
+        if self.rule_repository is not None:
+            return self.rule_repository.rules_as_dicts(enabled_only=True)
         if not self.db_session:
             return []
         
@@ -264,7 +272,10 @@ class EnhancedAntibodyIdentifier:
         potential_antibodies = set()
         
         # Get all patient reactions
-        for antigram_id, matrix in self.antigram_manager.antigram_matrices.items():
+        for antigram_id in self.antigram_manager.snapshot(indexed=False).antigram_ids:
+            matrix = self.antigram_manager.get_antigram_matrix(antigram_id)
+            if matrix is None:
+                continue
             patient_reactions = self.patient_reaction_manager.get_reactions_for_antigram(antigram_id)
             
             for cell_number, patient_reaction in patient_reactions.items():
@@ -325,22 +336,15 @@ class EnhancedAntibodyIdentifier:
         # If we get here, all cells match perfectly
         return True
     
-    def _create_progress_tracking_set_based(self, all_antigens: Set[str], ruling_out_details: Dict) -> Dict:
-        """Create progress tracking information for each antigen using set operations."""
+    def _create_progress_tracking_set_based(self, antigens: List[str], statistics: Dict[str, np.ndarray],
+                                            ruling_out_details: Dict) -> Dict:
+        """Create progress tracking information for each antigen from the bitmap counters."""
         progress = {}
+        counters = zip(statistics['total_cells'].tolist(), statistics['positive_matches'].tolist(),
+                       statistics['negative_matches'].tolist(), statistics['mismatches'].tolist(),
+                       statistics['meets_match_criteria'].tolist())
         
-        for antigen in all_antigens:
-            expressing_cells = self._antigen_sets['expressing_cells'].get(antigen, set())
-            non_expressing_cells = self._antigen_sets['non_expressing_cells'].get(antigen, set())
-            positive_cells = self._patient_reaction_sets['positive_cells']
-            negative_cells = self._patient_reaction_sets['negative_cells']
-            
-            # Calculate match statistics using set operations
-            positive_matches = len(expressing_cells & positive_cells)
-            negative_matches = len(non_expressing_cells & negative_cells)
-            mismatches = len(expressing_cells & negative_cells) + len(non_expressing_cells & positive_cells)
-            total_cells = len(expressing_cells | non_expressing_cells)
-            
+        for antigen, (total_cells, positive_matches, negative_matches, mismatches, meets_criteria) in zip(antigens, counters):
             progress[antigen] = {
                 "total_cells": total_cells,
                 "positive_matches": positive_matches,
@@ -349,7 +353,7 @@ class EnhancedAntibodyIdentifier:
                 "match_percentage": ((positive_matches + negative_matches) / total_cells * 100) if total_cells > 0 else 0,
                 "ruling_out_cells": ruling_out_details.get(antigen, []),
                 "can_be_ruled_out": antigen in ruling_out_details,
-                "meets_match_criteria": self._check_match_criteria_set_based(antigen)
+                "meets_match_criteria": meets_criteria
             }
         
         return progress
@@ -0,0 +1,56 @@
+import numpy as np
+from typing import Dict, Generic, Hashable, Iterable, List, Optional, TypeVar
+import logging
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+K = TypeVar('K', bound=Hashable)
+
+
+class IdRegistry(Generic[K]):
+    """
+    Dense integer IDs for hashable keys (antigen names, cell keys...).
+
+    IDs are assigned in order of first registration, starting at 0, and never
+    change or get reused, so they can index rows and columns of numpy arrays.
+    Hot paths work on IDs and arrays; keys are only looked up when results are
+    translated back for the API.
+    """
+
+    def __init__(self):
+        self._keys: List[K] = []
+        self._ids: Dict[K, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._ids
+
+    def intern(self, key: K) -> int:
+        """Get the ID of a key, assigning the next free ID if it is new."""
+        key_id = self._ids.get(key)
+        if key_id is None:
+            key_id = len(self._keys)
+            self._ids[key] = key_id
+            self._keys.append(key)
+        return key_id
+
+    def id_of(self, key: K) -> Optional[int]:
+        """Get the ID of a key, or None if it was never registered."""
+        return self._ids.get(key)
+
+    def ids(self, keys: Iterable[K]) -> np.ndarray:
+        """IDs of the given keys as an int64 array (-1 for unregistered keys)."""
+        lookup = self._ids.get
+        return np.fromiter((lookup(key, -1) for key in keys), dtype=np.int64)
+
+    def key_of(self, key_id: int) -> K:
+        """Get the key registered under an ID."""
+        return self._keys[key_id]
+
+    def keys(self, key_ids: Iterable[int]) -> List[K]:
+        """Keys registered under the given IDs, in order."""
+        keys = self._keys
+        return [keys[key_id] for key_id in key_ids]
@@ -0,0 +1,493 @@
+import numpy as np
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+import logging
+import threading
+
+from core.antibody_rule_evaluator import AntibodyRuleEvaluator
+from core.antigen_index import popcount_rows
+from core.metrics import time_phase
+from core.rule_compiler import get_compiled_plan, rule_set_version
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+STATUS_RULED_OUT = 'ruled_out'
+STATUS_STRO = 'stro'
+STATUS_MATCH = 'match'
+
+# Status lists returned by default; the per-antigen fields repeat the ruling out cells
+# of every antigen and are only built when asked for
+SUMMARY_FIELDS = ('ruled_out', 'stro', 'matches', 'suspected_antibodies')
+RESULT_FIELDS = SUMMARY_FIELDS + ('ruled_out_details', 'progress')
+DETAIL_LEVELS = {
+    'summary': SUMMARY_FIELDS,
+    'rules': SUMMARY_FIELDS + ('ruled_out_details',),
+    'full': RESULT_FIELDS,
+}
+
+
+def empty_results() -> Dict:
+    """Identification results of a workup without reactions."""
+    return {
+        "ruled_out": [],
+        "stro": [],
+        "matches": [],
+        "progress": {},
+        "ruled_out_details": {},
+        "suspected_antibodies": []
+    }
+
+
+def resolve_result_fields(detail: Optional[str] = None, fields: Optional[str] = None) -> Tuple[str, ...]:
+    """
+    Result fields selected by a request's detail level or explicit field list.
+
+    Args:
+        detail: 'summary' (default), 'rules' (adds ruled_out_details) or 'full'
+        fields: Comma-separated result fields; takes precedence over detail
+
+    Returns:
+        Tuple of result field names
+
+    Raises:
+        ValueError: For an unknown detail level or field
+    """
+    if fields:
+        requested = tuple(field.strip() for field in fields.split(',') if field.strip())
+        unknown = [field for field in requested if field not in RESULT_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown result fields: {', '.join(unknown)}. Valid fields: {', '.join(RESULT_FIELDS)}")
+        return requested
+    detail = (detail or 'summary').lower()
+    if detail not in DETAIL_LEVELS:
+        raise ValueError(f"Unknown detail level: {detail}. Valid levels: {', '.join(DETAIL_LEVELS)}")
+    return DETAIL_LEVELS[detail]
+
+
+class IncrementalABIDState:
+    """
+    Antibody identification state that is updated one patient reaction at a time.
+
+    Holds per-antigen match counters and per-condition rule hit counts derived from
+    the antigen expression index and the compiled rule plan. Adding, changing or
+    removing a single cell reaction only touches the counters of the antigens that
+    cell is typed for and the rule conditions it belongs to, so interactive entry
+    does not recompute every antigen from scratch.
+
+    The state is built from one inventory snapshot and is rebuilt once the manager
+    publishes a newer one. It covers the active lots only unless include_archived is set.
+    """
+
+    def __init__(self, antigram_manager, patient_reaction_manager, rules: List[Dict],
+                 rule_set_key: Hashable = None, include_archived: bool = False):
+        self.antigram_manager = antigram_manager
+        self.patient_reaction_manager = patient_reaction_manager
+        self.include_archived = include_archived
+        self.snapshot = antigram_manager.snapshot(include_archived=include_archived)
+        self.index = self.snapshot.index
+        # Ruling out cells are expanded into the same records as the rule evaluator produces
+        self.collect_cells = AntibodyRuleEvaluator(antigram_manager, patient_reaction_manager,
+                                                   self.snapshot)._collect_ruling_out_cells
+        self.rule_set_version = rule_set_key if rule_set_key is not None else rule_set_version(rules)
+        self.plan = get_compiled_plan(rules, self.rule_set_version)
+
+        # Stacked per-antigen expression bitmaps, one row per antigen (in name order)
+        self.antigens = sorted(self.index.antigens)
+        self._antigen_rows = {antigen: row for row, antigen in enumerate(self.antigens)}
+        antigen_ids = self.index.antigen_ids(self.antigens)
+        self._expressing = self.index.bitmaps(antigen_ids, '+')
+        self._non_expressing = self.index.bitmaps(antigen_ids, '0')
+        self._condition_masks = self.plan.condition_masks(self.index)
+
+        # Inventory-only totals never change for the life of the state
+        self._expressing_total = popcount_rows(self._expressing)
+        self._non_expressing_total = popcount_rows(self._non_expressing)
+        self._total_cells = popcount_rows(self._expressing | self._non_expressing)
+
+        # Rule lookups used to find the statuses a reaction can affect. ABSpecificRO gates
+        # are antigen rows: -1 ungated, -2 for an antibody no cell is typed for
+        self._rules_by_target: Dict[str, List[int]] = {}
+        self._rules_by_antibody: Dict[int, List[int]] = {}
+        self._rules_by_condition: List[List[int]] = [[] for _ in self.plan.conditions]
+        self._rule_gates: List[int] = [-1] * len(self.plan.rules)
+        for rule_index, rule in enumerate(self.plan.rules):
+            self._rules_by_target.setdefault(rule.target_antigen, []).append(rule_index)
+            if rule.rule_type == 'abspecific':
+                gate = self._antigen_rows.get(rule.antibody, -2)
+                self._rule_gates[rule_index] = gate
+                if gate >= 0:
+                    self._rules_by_antibody.setdefault(gate, []).append(rule_index)
+            for condition, _ in rule.terms:
+                self._rules_by_condition[condition].append(rule_index)
+
+        self._load_reactions()
+
+    # ---------- Building ----------
+
+    def _load_reactions(self):
+        """Compute every counter from the current patient reactions."""
+        self._reactions: Dict[int, str] = {}
+        for (antigram_id, cell_number), reaction in self.patient_reaction_manager.iter_reactions():
+            slot = self.index.slot_of(antigram_id, cell_number)
+            if slot is not None:
+                self._reactions[slot] = reaction
+        self.reactions_version = self.patient_reaction_manager.version
+
+        self.positive_cells = self.index.empty()
+        self.negative_cells = self.index.empty()
+        for slot, reaction in self._reactions.items():
+            if reaction == '+':
+                self.positive_cells[slot >> 3] |= np.uint8(1 << (slot & 7))
+            elif reaction == '0':
+                self.negative_cells[slot >> 3] |= np.uint8(1 << (slot & 7))
+
+        self._positive_matches = popcount_rows(self._expressing & self.positive_cells)
+        self._negative_matches = popcount_rows(self._non_expressing & self.negative_cells)
+        self._expressing_negative = popcount_rows(self._expressing & self.negative_cells)
+        self._non_expressing_positive = popcount_rows(self._non_expressing & self.positive_cells)
+        self._condition_hits = popcount_rows(self._condition_masks & self.negative_cells)
+
+        self.statuses: Dict[str, Optional[str]] = {}
+        self._refresh(set(self.antigens) | set(self._rules_by_target))
+
+    def is_current(self, rule_set_key: Hashable, pending_changes: int = 0) -> bool:
+        """
+        Check whether the state still reflects the inventory, rule set and reactions.
+
+        Args:
+            rule_set_key: Version of the currently enabled rule set
+            pending_changes: Reaction mutations made since the state was last updated
+                that the caller is about to apply
+        """
+        return (self.antigram_manager.version == self.snapshot.version
+                and rule_set_key == self.rule_set_version
+                and self.patient_reaction_manager.version == self.reactions_version + pending_changes)
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the state's bitmaps and counters."""
+        arrays = (self._expressing, self._non_expressing, self._condition_masks,
+                  self.positive_cells, self.negative_cells, self._positive_matches,
+                  self._negative_matches, self._expressing_negative, self._non_expressing_positive,
+                  self._condition_hits, self._expressing_total, self._non_expressing_total, self._total_cells)
+        return sum(array.nbytes for array in arrays) + 64 * len(self._reactions)
+
+    # ---------- Incremental updates ----------
+
+    def apply_reaction(self, antigram_id: int, cell_number, reaction: Optional[str]) -> Dict[str, Optional[str]]:
+        """
+        Apply a single added, changed or removed cell reaction.
+
+        Args:
+            antigram_id: Antigram the cell belongs to
+            cell_number: Cell number within the antigram
+            reaction: New patient reaction, or None if the reaction was removed
+
+        Returns:
+            Dict of {antigen: new_status} for statuses that changed
+        """
+        slot = self.index.slot_of(antigram_id, cell_number)
+        if slot is None:
+            return {}
+        previous = self._reactions.get(slot)
+        if previous == reaction:
+            return {}
+
+        byte, bit = slot >> 3, slot & 7
+        expressing = ((self._expressing[:, byte] >> bit) & 1).astype(np.int64)
+        non_expressing = ((self._non_expressing[:, byte] >> bit) & 1).astype(np.int64)
+        in_condition = ((self._condition_masks[:, byte] >> bit) & 1).astype(np.int64)
+        was_suspected = self._positive_matches > 0
+
+        self._shift(previous, byte, bit, expressing, non_expressing, in_condition, -1)
+        self._shift(reaction, byte, bit, expressing, non_expressing, in_condition, 1)
+        if reaction is None:
+            self._reactions.pop(slot, None)
+        else:
+            self._reactions[slot] = reaction
+
+        # Antigens the cell is typed for, targets of rules whose conditions include the cell,
+        # and ABSpecificRO targets whose antibody gained or lost suspicion
+        affected = {self.antigens[row] for row in np.flatnonzero(expressing | non_expressing).tolist()}
+        if '0' in (previous, reaction):
+            for condition in np.flatnonzero(in_condition).tolist():
+                affected.update(self.plan.rules[r].target_antigen for r in self._rules_by_condition[condition])
+        for row in np.flatnonzero(was_suspected != (self._positive_matches > 0)).tolist():
+            affected.update(self.plan.rules[r].target_antigen for r in self._rules_by_antibody.get(row, []))
+
+        return self._refresh(affected)
+
+    def _shift(self, reaction: Optional[str], byte: int, bit: int, expressing: np.ndarray,
+               non_expressing: np.ndarray, in_condition: np.ndarray, step: int):
+        """Add (step=1) or remove (step=-1) one cell reaction from the counters and bitmaps."""
+        mask = np.uint8(1 << bit)
+        if reaction == '+':
+            self._positive_matches += step * expressing
+            self._non_expressing_positive += step * non_expressing
+            if step > 0:
+                self.positive_cells[byte] |= mask
+            else:
+                self.positive_cells[byte] &= ~mask
+        elif reaction == '0':
+            self._negative_matches += step * non_expressing
+            self._expressing_negative += step * expressing
+            self._condition_hits += step * in_condition
+            if step > 0:
+                self.negative_cells[byte] |= mask
+            else:
+                self.negative_cells[byte] &= ~mask
+
+    # ---------- Status ----------
+
+    def _rule_satisfied(self, rule_index: int) -> bool:
+        """Check whether a compiled rule currently rules out its target."""
+        gate = self._rule_gates[rule_index]
+        if gate != -1 and (gate < 0 or self._positive_matches[gate] == 0):
+            return False
+        rule = self.plan.rules[rule_index]
+        if rule.fixed_details is not None:
+            return True
+        return int(sum(self._condition_hits[condition] for condition, _ in rule.terms)) >= rule.required_count
+
+    def _status(self, antigen: str) -> Optional[str]:
+        """Compute the current status of an antigen."""
+        if any(self._rule_satisfied(r) for r in self._rules_by_target.get(antigen, [])):
+            return STATUS_RULED_OUT
+        row = self._antigen_rows.get(antigen)
+        if row is None:
+            return None
+        if (self._positive_matches[row] == self._expressing_total[row]
+                and self._negative_matches[row] == self._non_expressing_total[row]):
+            return STATUS_MATCH
+        return STATUS_STRO
+
+    def _refresh(self, antigens: Iterable[str]) -> Dict[str, Optional[str]]:
+        """Recompute the status of the given antigens and return the ones that changed."""
+        changed = {}
+        for antigen in antigens:
+            status = self._status(antigen)
+            if status != self.statuses.get(antigen):
+                changed[antigen] = status
+            self.statuses[antigen] = status
+        return changed
+
+    def diff(self, previous_statuses: Dict[str, Optional[str]]) -> Dict[str, Optional[str]]:
+        """Get the statuses that differ from an earlier snapshot of statuses."""
+        antigens = set(previous_statuses) | set(self.statuses)
+        return {
+            antigen: self.statuses.get(antigen)
+            for antigen in antigens
+            if self.statuses.get(antigen) != previous_statuses.get(antigen)
+        }
+
+    # ---------- Results ----------
+
+    def suspected_antibodies(self) -> List[str]:
+        """Antigens expressed by at least one cell with a positive patient reaction."""
+        return [self.antigens[row] for row in np.flatnonzero(self._positive_matches > 0).tolist()]
+
+    def _rule_cells(self, rule_index: int, collect_cells: Callable[[np.ndarray, Dict], List[Dict]]) -> List[Dict]:
+        """Expand the ruling out cells of a satisfied rule."""
+        rule = self.plan.rules[rule_index]
+        if rule.fixed_details is not None:
+            return list(rule.fixed_details)
+        ruling_out_cells = []
+        for condition, details in rule.terms:
+            ruling_out_cells.extend(collect_cells(self._condition_masks[condition] & self.negative_cells, details))
+        return ruling_out_cells
+
+    def _ruling_out_details(self, collect_cells: Callable[[np.ndarray, Dict], List[Dict]]) -> Dict[str, List[Dict]]:
+        """Expand the ruling out cells of every satisfied rule."""
+        ruling_out_details = {}
+        for rule_index, rule in enumerate(self.plan.rules):
+            if self._rule_satisfied(rule_index):
+                ruling_out_details.setdefault(rule.target_antigen, []).extend(self._rule_cells(rule_index, collect_cells))
+        return ruling_out_details
+
+    def _progress_entry(self, row: int, ruling_out_cells: Optional[List[Dict]]) -> Dict:
+        """Match counters of one antigen, with its ruling out cells (None: not ruled out)."""
+        total_cells = int(self._total_cells[row])
+        positive_matches = int(self._positive_matches[row])
+        negative_matches = int(self._negative_matches[row])
+        return {
+            "total_cells": total_cells,
+            "positive_matches": positive_matches,
+            "negative_matches": negative_matches,
+            "mismatches": int(self._expressing_negative[row] + self._non_expressing_positive[row]),
+            "match_percentage": ((positive_matches + negative_matches) / total_cells * 100) if total_cells > 0 else 0,
+            "ruling_out_cells": ruling_out_cells or [],
+            "can_be_ruled_out": ruling_out_cells is not None,
+            "meets_match_criteria": bool(self._positive_matches[row] == self._expressing_total[row]
+                                         and self._negative_matches[row] == self._non_expressing_total[row])
+        }
+
+    def results(self, collect_cells: Callable[[np.ndarray, Dict], List[Dict]],
+                fields: Iterable[str] = RESULT_FIELDS) -> Dict:
+        """
+        Build the antibody identification results from the current counters.
+
+        Args:
+            collect_cells: Callback expanding a ruling out bitmap into detail records
+            fields: Result fields to build (see RESULT_FIELDS); ruling out cells are only
+                expanded when ruled_out_details or progress is requested
+
+        Returns:
+            Dict: Results with the requested fields
+        """
+        fields = set(fields)
+        if not self.patient_reaction_manager.reaction_count:
+            return {field: value for field, value in empty_results().items() if field in fields}
+
+        results = {}
+        if 'ruled_out' in fields:
+            results["ruled_out"] = sorted(a for a, s in self.statuses.items() if s == STATUS_RULED_OUT)
+        if 'stro' in fields:
+            results["stro"] = sorted(a for a, s in self.statuses.items() if s == STATUS_STRO)
+        if 'matches' in fields:
+            results["matches"] = sorted(a for a, s in self.statuses.items() if s == STATUS_MATCH)
+        if fields & {'progress', 'ruled_out_details'}:
+            ruling_out_details = self._ruling_out_details(collect_cells)
+            if 'progress' in fields:
+                results["progress"] = {
+                    antigen: self._progress_entry(row, ruling_out_details.get(antigen))
+                    for row, antigen in enumerate(self.antigens)
+                }
+            if 'ruled_out_details' in fields:
+                results["ruled_out_details"] = ruling_out_details
+        if 'suspected_antibodies' in fields:
+            results["suspected_antibodies"] = self.suspected_antibodies()
+        return results
+
+    def antigen_results(self, antigen: str, collect_cells: Callable[[np.ndarray, Dict], List[Dict]]) -> Optional[Dict]:
+        """
+        Build the status and provenance of a single antigen, expanding only the
+        ruling out cells of the rules that target it.
+
+        Args:
+            antigen: Antigen name
+            collect_cells: Callback expanding a ruling out bitmap into detail records
+
+        Returns:
+            Dict: Status, match counters and ruling out cells (as the antigen's progress
+            entry in the full results), or None if the antigen is neither typed in the
+            inventory nor targeted by a rule
+        """
+        row = self._antigen_rows.get(antigen)
+        rule_indexes = self._rules_by_target.get(antigen, [])
+        if row is None and not rule_indexes:
+            return None
+
+        # Without reactions nothing is ruled out (as in results)
+        has_reactions = self.patient_reaction_manager.reaction_count > 0
+        ruling_out_cells = None
+        for rule_index in rule_indexes:
+            if has_reactions and self._rule_satisfied(rule_index):
+                ruling_out_cells = (ruling_out_cells or []) + self._rule_cells(rule_index, collect_cells)
+
+        antigen_results = {
+            "antigen": antigen,
+            "status": self.statuses.get(antigen) if has_reactions else None,
+            "suspected": bool(row is not None and self._positive_matches[row] > 0),
+        }
+        if row is not None:
+            antigen_results.update(self._progress_entry(row, ruling_out_cells))
+        else:
+            antigen_results.update({
+                "ruling_out_cells": ruling_out_cells or [],
+                "can_be_ruled_out": ruling_out_cells is not None,
+            })
+        return antigen_results
+
+
+class IncrementalABIDTracker:
+    """
+    Keeps an IncrementalABIDState in step with a pair of antigram/patient reaction managers.
+
+    Reaction changes made through the API are applied to the existing state; any change
+    the state did not see (inventory edits, rule edits, cleared reactions) triggers a rebuild.
+    Identification over archived lots too keeps a separate state, built on first use.
+    """
+
+    def __init__(self, antigram_manager, patient_reaction_manager):
+        self.antigram_manager = antigram_manager
+        self.patient_reaction_manager = patient_reaction_manager
+        self.state: Optional[IncrementalABIDState] = None
+        self.historical_state: Optional[IncrementalABIDState] = None
+        self._lock = threading.Lock()
+
+    def _current_state(self, rules: List[Dict], changed_cells: List[Tuple[int, str]],
+                       rule_set_key: Hashable,
+                       include_archived: bool = False) -> Tuple[IncrementalABIDState, Dict[str, Optional[str]]]:
+        """Apply the changes to the state, or rebuild it if it missed any. Call with the lock held."""
+        state = self.historical_state if include_archived else self.state
+        if state is not None and state.is_current(rule_set_key, len(changed_cells)):
+            with time_phase('apply_reactions', engine='incremental'):
+                previous_statuses = dict(state.statuses)
+                for antigram_id, cell_number in changed_cells:
+                    reaction = self.patient_reaction_manager.get_reaction(antigram_id, cell_number)
+                    state.apply_reaction(antigram_id, cell_number, reaction)
+                state.reactions_version = self.patient_reaction_manager.version
+                delta = state.diff(previous_statuses)
+        else:
+            with time_phase('state_build', engine='incremental'):
+                previous_statuses = state.statuses if state is not None else {}
+                state = IncrementalABIDState(self.antigram_manager, self.patient_reaction_manager, rules,
+                                             rule_set_key, include_archived)
+                if include_archived:
+                    self.historical_state = state
+                else:
+                    self.state = state
+                delta = state.diff(previous_statuses)
+            logger.debug(f"Rebuilt incremental ABID state for {len(state.antigens)} antigens")
+        return state, delta
+
+    def identify(self, rules: List[Dict], changed_cells: Iterable[Tuple[int, str]] = (),
+                 rule_set_key: Hashable = None, fields: Iterable[str] = RESULT_FIELDS,
+                 include_archived: bool = False) -> Tuple[Dict, Dict[str, Optional[str]]]:
+        """
+        Get the identification results after the given reaction changes.
+
+        Args:
+            rules: Enabled antibody rules
+            changed_cells: (antigram_id, cell_number) of every reaction added, updated
+                or deleted since the last call, one entry per manager mutation
+            rule_set_key: Version key of the rule set (e.g. RuleSnapshot.cache_key).
+                If None, a fingerprint of the rules is used.
+            fields: Result fields to build (see resolve_result_fields)
+            include_archived: Identify against the archived (expired) lots too
+
+        Returns:
+            Tuple of (results, delta) where delta maps antigens to their new status
+            for every status that changed
+        """
+        changed_cells = list(changed_cells)
+        if rule_set_key is None:
+            rule_set_key = rule_set_version(rules)
+
+        with self._lock:
+            state, delta = self._current_state(rules, changed_cells, rule_set_key, include_archived)
+            with time_phase('results', engine='incremental'):
+                results = state.results(state.collect_cells, fields)
+            return results, delta
+
+    def identify_antigen(self, rules: List[Dict], antigen: str, rule_set_key: Hashable = None,
+                         include_archived: bool = False) -> Optional[Dict]:
+        """
+        Get the status and ruling out cells of one antigen (see IncrementalABIDState.antigen_results).
+
+        Args:
+            rules: Enabled antibody rules
+            antigen: Antigen name
+            rule_set_key: Version key of the rule set; if None, a fingerprint of the rules is used
+            include_archived: Identify against the archived (expired) lots too
+
+        Returns:
+            Dict of the antigen's results, or None for an unknown antigen
+        """
+        if rule_set_key is None:
+            rule_set_key = rule_set_version(rules)
+
+        with self._lock:
+            state, _ = self._current_state(rules, [], rule_set_key, include_archived)
+            with time_phase('results', engine='incremental'):
+                return state.antigen_results(antigen, state.collect_cells)
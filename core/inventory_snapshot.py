@@ -0,0 +1,109 @@
+from types import MappingProxyType
+from typing import Dict, FrozenSet, List, Mapping, Optional, Tuple
+import logging
+
+import numpy as np
+
+from core.antigen_index import AntigenExpressionIndex
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class InventorySnapshot:
+    """
+    Immutable view of the antigram inventory at one version.
+
+    PandasAntigramManager publishes a new snapshot after every change instead of
+    changing the published one: writers copy the expression index and metadata,
+    apply their change to the copies and swap the new snapshot in with a single
+    attribute assignment. A reader takes the current snapshot once, without a lock,
+    and sees one consistent inventory for as long as it holds it, whatever other
+    request threads change meanwhile.
+
+    The inventory is partitioned by expiration date: metadata covers every lot, but
+    archived (expired) lots are left out of the index unless the snapshot was taken
+    with include_archived, so identification and searches only see active lots.
+
+    Args:
+        version: Inventory version (PandasAntigramManager.version) the snapshot shows
+        index: Expression index of the snapshot's antigrams; never changed once published
+            (rule conditions may still be materialized on it)
+        metadata: {antigram_id: metadata} in inventory order; owned by the snapshot
+        indexed: Whether every antigram the index should cover is in it
+        archived: IDs of the archived lots
+        include_archived: Whether the index covers the archived lots too
+    """
+
+    __slots__ = ('version', 'index', 'metadata', 'indexed', 'archived', 'include_archived', '_cell_order_keys')
+
+    def __init__(self, version: int, index: AntigenExpressionIndex, metadata: Mapping[int, Dict],
+                 indexed: bool = True, archived: FrozenSet[int] = frozenset(), include_archived: bool = False):
+        self.version = version
+        self.index = index
+        self.metadata: Mapping[int, Dict] = (metadata if isinstance(metadata, MappingProxyType)
+                                             else MappingProxyType(metadata))
+        self.indexed = indexed
+        self.archived = archived
+        self.include_archived = include_archived
+        self._cell_order_keys: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    def __len__(self) -> int:
+        return len(self.metadata)
+
+    def __contains__(self, antigram_id: int) -> bool:
+        return antigram_id in self.metadata
+
+    @property
+    def antigram_ids(self) -> List[int]:
+        """IDs of every antigram, in inventory order."""
+        return list(self.metadata)
+
+    @property
+    def active_antigram_ids(self) -> List[int]:
+        """IDs of the antigrams that are not archived, in inventory order."""
+        return [antigram_id for antigram_id in self.metadata if antigram_id not in self.archived]
+
+    @property
+    def visible_antigram_ids(self) -> List[int]:
+        """IDs of the antigrams searches of this snapshot see (archived ones only if include_archived), in inventory order."""
+        if self.include_archived:
+            return self.antigram_ids
+        return self.active_antigram_ids
+
+    def cell_order_keys(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Antigram ID and position in its antigram (matrix order) of every index slot
+        (-1 for free slots), computed once per snapshot. Sorting slots by these keys
+        lists cells the way the cell finder returns them, and the keys stay comparable
+        after the antigram of a key has been deleted or archived.
+        """
+        keys = self._cell_order_keys
+        if keys is None:
+            antigram_ids = np.full(self.index.slot_count, -1, dtype=np.int64)
+            positions = np.full(self.index.slot_count, -1, dtype=np.int64)
+            for antigram_id in self.metadata:
+                slots = self.index.antigram_slots(antigram_id)
+                antigram_ids[slots] = antigram_id
+                positions[slots] = np.arange(len(slots))
+            keys = self._cell_order_keys = (antigram_ids, positions)
+        return keys
+
+    def get_metadata(self, antigram_id: int) -> Optional[Dict]:
+        """Metadata of an antigram, or None if it is not in the snapshot."""
+        return self.metadata.get(antigram_id)
+
+
+def wants_archived(value) -> bool:
+    """
+    Read an include_archived request flag (a JSON boolean or a query string value).
+
+    Args:
+        value: The flag as given, e.g. True, "true", "1" or None
+
+    Returns:
+        Whether archived lots were asked for
+    """
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
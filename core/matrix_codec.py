@@ -0,0 +1,214 @@
+"""
+Compact binary encoding for antigram matrices stored in AntigramMatrixStorage.matrix_data.
+
+Layout (all integers little-endian)::
+
+    header      magic b'ABMX', u8 version, u8 flags, u16 antigen count, u16 cell count,
+                u32 escape count
+    antigens    u16 per column: index into ANTIGEN_DICTIONARY, or
+                len(ANTIGEN_DICTIONARY) + n for the n-th extra antigen
+    extras      u16 extra count, then u8 length + UTF-8 name per extra antigen
+    cells       u8 length + UTF-8 cell ID per cell (omitted when FLAG_SEQUENTIAL_CELLS)
+    codes       2-bit reaction code per cell x antigen, row-major, packed little-endian
+    escapes     u32 position + u8 length + UTF-8 value per escaped reaction
+                (length 0xFF encodes a missing value)
+
+Reactions '-', '+' and '0' take 2 bits each; anything else (e.g. 'w+') is
+stored in the escape table. ANTIGEN_DICTIONARY is part of the format and must
+never be reordered; new antigens are stored as extras until a new version is added.
+"""
+
+import json
+import struct
+import numpy as np
+import pandas as pd
+from typing import Union
+import logging
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+MAGIC = b'ABMX'
+FORMAT_VERSION = 1
+
+FLAG_SEQUENTIAL_CELLS = 0x01  # Cell IDs are '1'..'n' and are not stored
+
+# Version 1 antigen dictionary (Panocell order followed by common low/high prevalence antigens)
+ANTIGEN_DICTIONARY = (
+    "D", "C", "c", "E", "e", "f", "Cw", "V", "K", "k", "Kpa", "Kpb", "Jsa", "Jsb",
+    "Fya", "Fyb", "Jka", "Jkb", "Xga", "Lea", "Leb", "S", "s", "M", "N", "P", "Lua", "Lub",
+    "P1", "Wra", "Dia", "Dib", "Coa", "Cob", "Yta", "Ytb", "Mia", "Bga",
+)
+_ANTIGEN_CODES = {antigen: code for code, antigen in enumerate(ANTIGEN_DICTIONARY)}
+
+# 2-bit reaction codes; code 3 marks an entry in the escape table
+REACTION_CODES = {'-': 0, '+': 1, '0': 2}
+_ESCAPE_CODE = 3
+_CODE_VALUES = np.array(['-', '+', '0', None], dtype=object)
+_MISSING_VALUE_LENGTH = 0xFF
+
+_HEADER = struct.Struct('<4sBBHHI')
+
+
+class MatrixCodecError(ValueError):
+    """Raised when stored matrix data cannot be decoded."""
+
+
+def is_binary_matrix(data) -> bool:
+    """Check whether stored matrix data uses the binary format."""
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:4]) == MAGIC
+
+
+def _pack_string(value: str) -> bytes:
+    encoded = str(value).encode('utf-8')
+    if len(encoded) >= _MISSING_VALUE_LENGTH:
+        raise MatrixCodecError(f"Value too long to encode: {value!r}")
+    return bytes((len(encoded),)) + encoded
+
+
+def encode_matrix(matrix: pd.DataFrame) -> bytes:
+    """
+    Encode an antigram matrix (cells as index, antigens as columns) to the binary format.
+
+    Args:
+        matrix: Antigram matrix
+
+    Returns:
+        bytes: Encoded matrix
+    """
+    antigens = [str(antigen) for antigen in matrix.columns]
+    cells = [str(cell) for cell in matrix.index]
+
+    extras = []
+    antigen_codes = []
+    for antigen in antigens:
+        code = _ANTIGEN_CODES.get(antigen)
+        if code is None:
+            code = len(ANTIGEN_DICTIONARY) + len(extras)
+            extras.append(antigen)
+        antigen_codes.append(code)
+
+    values = matrix.to_numpy(dtype=object).ravel()
+    codes = np.full(len(values), _ESCAPE_CODE, dtype=np.uint8)
+    for reaction, code in REACTION_CODES.items():
+        codes[values == reaction] = code
+    escape_positions = np.flatnonzero(codes == _ESCAPE_CODE)
+
+    flags = 0
+    if cells == [str(n) for n in range(1, len(cells) + 1)]:
+        flags |= FLAG_SEQUENTIAL_CELLS
+
+    parts = [
+        _HEADER.pack(MAGIC, FORMAT_VERSION, flags, len(antigens), len(cells), len(escape_positions)),
+        np.array(antigen_codes, dtype='<u2').tobytes(),
+        struct.pack('<H', len(extras)),
+    ]
+    parts.extend(_pack_string(antigen) for antigen in extras)
+    if not flags & FLAG_SEQUENTIAL_CELLS:
+        parts.extend(_pack_string(cell) for cell in cells)
+
+    # Four 2-bit codes per byte, first value in the lowest bits
+    padded = np.zeros((len(codes) + 3) // 4 * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    quads = padded.reshape(-1, 4)
+    parts.append((quads[:, 0] | (quads[:, 1] << 2) | (quads[:, 2] << 4) | (quads[:, 3] << 6)).astype(np.uint8).tobytes())
+
+    for position in escape_positions.tolist():
+        value = values[position]
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            parts.append(struct.pack('<IB', position, _MISSING_VALUE_LENGTH))
+        else:
+            parts.append(struct.pack('<I', position) + _pack_string(value))
+
+    return b''.join(parts)
+
+
+def _decode_binary(data: bytes) -> pd.DataFrame:
+    """Decode a matrix stored in the binary format."""
+    try:
+        magic, version, flags, antigen_count, cell_count, escape_count = _HEADER.unpack_from(data, 0)
+        if version != FORMAT_VERSION:
+            raise MatrixCodecError(f"Unsupported matrix format version {version}")
+        offset = _HEADER.size
+
+        antigen_codes = np.frombuffer(data, dtype='<u2', count=antigen_count, offset=offset).tolist()
+        offset += 2 * antigen_count
+
+        def read_string():
+            nonlocal offset
+            length = data[offset]
+            value = data[offset + 1:offset + 1 + length].decode('utf-8')
+            offset += 1 + length
+            return value
+
+        (extra_count,) = struct.unpack_from('<H', data, offset)
+        offset += 2
+        extras = [read_string() for _ in range(extra_count)]
+        antigens = [
+            ANTIGEN_DICTIONARY[code] if code < len(ANTIGEN_DICTIONARY) else extras[code - len(ANTIGEN_DICTIONARY)]
+            for code in antigen_codes
+        ]
+
+        if flags & FLAG_SEQUENTIAL_CELLS:
+            cells = [str(n) for n in range(1, cell_count + 1)]
+        else:
+            cells = [read_string() for _ in range(cell_count)]
+
+        value_count = antigen_count * cell_count
+        packed_length = (value_count + 3) // 4
+        packed = np.frombuffer(data, dtype=np.uint8, count=packed_length, offset=offset)
+        offset += packed_length
+        codes = np.stack([(packed >> shift) & 3 for shift in (0, 2, 4, 6)], axis=1).ravel()[:value_count]
+        values = _CODE_VALUES[codes]
+
+        for _ in range(escape_count):
+            (position,) = struct.unpack_from('<I', data, offset)
+            if data[offset + 4] == _MISSING_VALUE_LENGTH:
+                values[position] = None
+                offset += 5
+            else:
+                offset += 4
+                values[position] = read_string()
+    except (struct.error, IndexError, ValueError) as e:
+        if isinstance(e, MatrixCodecError):
+            raise
+        raise MatrixCodecError(f"Corrupt binary matrix data: {e}") from e
+
+    # Reactions are plain Python strings, so skip pandas' per-column dtype inference
+    return pd.DataFrame(values.reshape(cell_count, antigen_count),
+                        index=pd.Index(cells, name='cell_number', dtype=object),
+                        columns=pd.Index(antigens, dtype=object), dtype=object)
+
+
+def _decode_legacy_json(data: Union[str, bytes]) -> pd.DataFrame:
+    """Decode a matrix stored as json.dumps(matrix.to_dict())."""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data).decode('utf-8')
+    matrix_df = pd.DataFrame.from_dict(json.loads(data), orient='index')
+
+    # Check if the matrix is transposed (antigens as index, cells as columns)
+    # If so, transpose it to have cells as index and antigens as columns.
+    # Antigen names are never numeric, so a non-numeric index means antigens.
+    columns_are_cells = any(str(col).isdigit() for col in matrix_df.columns)
+    index_is_cells = any(str(label).isdigit() for label in matrix_df.index)
+    if columns_are_cells and (not index_is_cells or len(matrix_df.columns) < len(matrix_df.index)):
+        matrix_df = matrix_df.T
+        logger.info("Transposed legacy JSON antigram matrix")
+
+    matrix_df.index.name = 'cell_number'
+    return matrix_df
+
+
+def decode_matrix(data: Union[str, bytes]) -> pd.DataFrame:
+    """
+    Decode stored matrix data, accepting both the binary format and legacy JSON.
+
+    Args:
+        data: Value of AntigramMatrixStorage.matrix_data
+
+    Returns:
+        pandas.DataFrame: Matrix with cells as index and antigens as columns
+    """
+    if is_binary_matrix(data):
+        return _decode_binary(bytes(data))
+    return _decode_legacy_json(data)
@@ -0,0 +1,248 @@
+import math
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+import logging
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from sub-millisecond bitmap work to slow cold starts
+DEFAULT_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# One metric as rendered at scrape time: samples are (suffix, {label: value}, value)
+MetricFamily = namedtuple('MetricFamily', ['name', 'type', 'documentation', 'samples'])
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels: Dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape_label_value(value)}"' for key, value in labels.items()) + '}'
+
+
+class _LabeledMetric:
+    """Base for metrics whose values are kept per combination of label values."""
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple) -> Dict:
+        return dict(zip(self.labelnames, key))
+
+
+class Counter(_LabeledMetric):
+    """Monotonically increasing count."""
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self) -> MetricFamily:
+        with self._lock:
+            samples = [('', self._labels(key), value) for key, value in self._values.items()]
+        return MetricFamily(self.name, self.type, self.documentation, samples)
+
+
+class Histogram(_LabeledMetric):
+    """Cumulative bucket counts, sum and count of observed values."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Per label key: [bucket counts..., sum, count]
+        self._values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self) -> MetricFamily:
+        samples = []
+        with self._lock:
+            for key, values in self._values.items():
+                labels = self._labels(key)
+                for bound, count in zip(self.buckets, values):
+                    samples.append(('_bucket', {**labels, 'le': _format_value(float(bound))}, count))
+                samples.append(('_sum', labels, values[-2]))
+                samples.append(('_count', labels, values[-1]))
+        return MetricFamily(self.name, self.type, self.documentation, samples)
+
+
+class MetricsRegistry:
+    """
+    Process-wide set of metrics rendered in the Prometheus text exposition format.
+
+    Counters and histograms are updated as events happen; collectors are called at
+    scrape time for values read from elsewhere (inventory sizes, cache statistics).
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _LabeledMetric] = {}
+        self._collectors: List[Callable[[], Iterable[MetricFamily]]] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _LabeledMetric) -> _LabeledMetric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collector: Callable[[], Iterable[MetricFamily]]):
+        """Add a callable returning MetricFamily values at scrape time."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self) -> List[MetricFamily]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        families = [metric.collect() for metric in metrics]
+        for collector in collectors:
+            try:
+                families.extend(collector())
+            except Exception as e:
+                logger.error(f"Metrics collector {collector} failed: {e}")
+        return families
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for family in self.collect():
+            lines.append(f"# HELP {family.name} {family.documentation}")
+            lines.append(f"# TYPE {family.name} {family.type}")
+            for suffix, labels, value in family.samples:
+                lines.append(f"{family.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+def gauge(name: str, documentation: str, samples: Iterable[Tuple[Dict, float]]) -> MetricFamily:
+    """A gauge family for a collector, from (labels, value) pairs."""
+    return MetricFamily(name, 'gauge', documentation, [('', labels, value) for labels, value in samples])
+
+
+def counter_family(name: str, documentation: str, samples: Iterable[Tuple[Dict, float]]) -> MetricFamily:
+    """A counter family for a collector whose counts are kept elsewhere."""
+    return MetricFamily(name, 'counter', documentation, [('', labels, value) for labels, value in samples])
+
+
+# ---------- Application metrics ----------
+
+registry = MetricsRegistry()
+
+REQUEST_LATENCY = registry.histogram(
+    'bbapp_http_request_duration_seconds', 'HTTP request latency by route.',
+    ['method', 'route', 'status']
+)
+REQUEST_DB_QUERIES = registry.histogram(
+    'bbapp_http_request_db_queries', 'SQL statements executed per HTTP request.',
+    ['method', 'route'], buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+)
+ABID_PHASE_LATENCY = registry.histogram(
+    'bbapp_abid_phase_duration_seconds', 'Time spent in each phase of antibody identification.',
+    ['engine', 'phase']
+)
+DB_QUERIES = registry.counter(
+    'bbapp_db_queries_total', 'SQL statements executed, by statement type.', ['operation']
+)
+
+# SQL statements counted on the current thread (reset at the start of each request)
+_query_counts = threading.local()
+
+
+def time_phase(phase: str, engine: str = 'full'):
+    """
+    Context manager observing the duration of one identification phase.
+
+    Args:
+        phase: Phase name (e.g. 'rule_load', 'rule_evaluation')
+        engine: 'full' for EnhancedAntibodyIdentifier, 'incremental' for the ABID tracker
+    """
+    return ABID_PHASE_LATENCY.time(engine=engine, phase=phase)
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    operation = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else 'other'
+    if operation not in ('select', 'insert', 'update', 'delete'):
+        operation = 'other'
+    DB_QUERIES.inc(operation=operation)
+    _query_counts.value = getattr(_query_counts, 'value', 0) + 1
+
+
+def instrument_engine(engine):
+    """Count every SQL statement executed through the engine."""
+    from sqlalchemy import event
+
+    if not event.contains(engine, 'before_cursor_execute', _count_query):
+        event.listen(engine, 'before_cursor_execute', _count_query)
+
+
+def reset_query_count():
+    """Start counting SQL statements for a new request on this thread."""
+    _query_counts.value = 0
+
+
+def query_count() -> int:
+    """SQL statements executed on this thread since reset_query_count()."""
+    return getattr(_query_counts, 'value', 0)
@@ -1,30 +1,244 @@
 import os
 import pandas as pd
 import numpy as np
-from typing import Dict, List, Optional, Tuple, Any
+from typing import Callable, Dict, Iterator, List, Mapping, Optional, Set, Tuple, Any
 from datetime import date, datetime
 import json
 import logging
-from sqlalchemy import Column, Integer, String, Date, Text
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import Column, Integer, String, Date, Text, LargeBinary, UniqueConstraint
 from sqlalchemy.orm import declarative_base
 from models import Base
+from core.antigen_index import AntigenExpressionIndex
+from core.antigram_residency import AntigramResidencyCache
+from core.inventory_snapshot import InventorySnapshot
+from core.matrix_codec import encode_matrix, decode_matrix
+from core.reaction_store import ReactionStore
+from core.bulk_persistence import bulk_upsert, bulk_insert, bulk_delete
+from core.change_feed import (Change, record_changes, reaction_key, parse_reaction_key,
+                              ENTITY_ANTIGRAM, ENTITY_PATIENT_REACTION, ENTITY_TEMPLATE,
+                              OP_UPSERT, OP_DELETE, OP_DELETE_ALL)
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+
+def lot_expired(metadata: Dict, as_of: Optional[date] = None) -> bool:
+    """Whether an antigram's lot is past its expiration date (as of today by default)."""
+    expiration_date = metadata.get('expiration_date')
+    if isinstance(expiration_date, str):
+        try:
+            expiration_date = date.fromisoformat(expiration_date[:10])
+        except ValueError:
+            return False
+    if isinstance(expiration_date, datetime):
+        expiration_date = expiration_date.date()
+    return isinstance(expiration_date, date) and expiration_date < (as_of or date.today())
+
+
 class PandasAntigramManager:
     """
     Manages antigram data using pandas DataFrames for matrix-style storage.
     Provides efficient operations for antibody identification and cell finding.
     Now includes database persistence for data durability.
+    
+    Metadata for every antigram is held in memory, but matrices loaded from the
+    database are fetched on first use and may be evicted again when they exceed
+    memory_budget_bytes (None keeps every loaded matrix resident).
+    
+    Metadata and the expression index are published as immutable InventorySnapshots.
+    Readers take the current one with snapshot() and never lock; writers hold the
+    write lock, change copies of the published index and metadata and swap a new
+    snapshot in, so request threads never see a half-applied change.
+    
+    Lots past their expiration date are archived: they keep their metadata but are
+    left out of the expression index, and their matrices are not loaded, so
+    identification, the cell finder and validation work on the active lots only.
+    Lots are archived as they are loaded or saved and by archive_expired, run on a
+    schedule as lots expire; snapshot(include_archived=True) adds them back for
+    historical queries.
     """
     
-    def __init__(self, db_session=None):
-        self.antigram_matrices: Dict[int, pd.DataFrame] = {}
-        self.antigram_metadata: Dict[int, Dict] = {}
+    def __init__(self, db_session=None, memory_budget_bytes: Optional[int] = None,
+                 archive_interval_seconds: Optional[float] = None):
         self.patient_reactions: pd.DataFrame = pd.DataFrame()
         self.db_session = db_session
+        # Antigrams changed since the last flush to the database
+        self._dirty_antigrams: Set[int] = set()
+        self._deleted_antigrams: Set[int] = set()
+        self._delete_all_antigrams = False
+        # Matrices of every known antigram, loaded on demand within the memory budget
+        self.antigram_matrices = AntigramResidencyCache(
+            loader=self._fetch_matrices,
+            memory_budget_bytes=memory_budget_bytes,
+            is_expired=self._is_expired,
+            can_evict=lambda antigram_id: self.db_session is not None and antigram_id not in self._dirty_antigrams
+        )
+        # Bit-packed antigen expression index kept in sync with antigram_matrices,
+        # completed on first use for antigrams registered without their matrix
+        self._unindexed_antigrams: Set[int] = set()
+        # Expired lots, kept out of the expression index; archive_expired_if_due
+        # looks for newly expired ones every archive_interval_seconds
+        self._archived_antigrams: Set[int] = set()
+        self.archive_interval_seconds = archive_interval_seconds
+        self._next_archive_at = time.monotonic() + (archive_interval_seconds or 0)
+        # Serializes writers; readers only take the published snapshot
+        self._write_lock = threading.RLock()
+        self._snapshot = InventorySnapshot(0, AntigenExpressionIndex(), {})
+        # Snapshot whose index also covers archived lots, built on request for the current version
+        self._historical_snapshot: Optional[InventorySnapshot] = None
+    
+    def snapshot(self, indexed: bool = True, include_archived: bool = False) -> InventorySnapshot:
+        """
+        The current inventory snapshot, taken without locking.
+        
+        Args:
+            indexed: Index antigrams registered without their matrix first, so the
+                snapshot's index covers every active antigram (metadata-only readers can skip it)
+            include_archived: Get a snapshot whose index covers archived lots too,
+                loading their matrices (for historical queries)
+        """
+        snapshot = self._snapshot
+        if (indexed or include_archived) and not snapshot.indexed:
+            with self._write_lock:
+                self._index_pending_antigrams()
+                snapshot = self._snapshot
+        if include_archived and snapshot.archived:
+            return self._with_archived(snapshot)
+        return snapshot
+    
+    def _with_archived(self, snapshot: InventorySnapshot) -> InventorySnapshot:
+        """A snapshot of the same version whose index adds the archived lots."""
+        historical = self._historical_snapshot
+        if historical is not None and historical.version == snapshot.version:
+            return historical
+        with self._write_lock:
+            historical = self._historical_snapshot
+            if historical is not None and historical.version == snapshot.version:
+                return historical
+            index = snapshot.index.copy()
+            archived = [antigram_id for antigram_id in snapshot.metadata if antigram_id in snapshot.archived]
+            for start in range(0, len(archived), 50):
+                matrices = self.antigram_matrices.load_many(archived[start:start + 50])
+                for antigram_id, matrix in matrices.items():
+                    index.add_antigram(antigram_id, matrix)
+            historical = InventorySnapshot(snapshot.version, index, snapshot.metadata,
+                                           archived=snapshot.archived, include_archived=True)
+            self._historical_snapshot = historical
+            logger.info(f"Indexed {len(archived)} archived antigrams for a historical query")
+            return historical
+    
+    @property
+    def version(self) -> int:
+        """
+        Bumped whenever an antigram is added, changed or removed (not when a matrix is
+        merely loaded or evicted), so responses built from antigrams can be reused.
+        """
+        return self._snapshot.version
+    
+    @property
+    def antigram_metadata(self) -> Mapping[int, Dict]:
+        """Read-only {antigram_id: metadata} of the current snapshot."""
+        return self._snapshot.metadata
+    
+    @property
+    def expression_index(self) -> AntigenExpressionIndex:
+        """Expression index of the current snapshot, completed lazily on first use."""
+        return self.snapshot().index
+    
+    @contextmanager
+    def _writing(self) -> Iterator[Tuple[AntigenExpressionIndex, Dict[int, Dict]]]:
+        """
+        Hold the write lock and yield copies of the published index and metadata to
+        change; they are published as the next snapshot when the block completes.
+        """
+        with self._write_lock:
+            current = self._snapshot
+            index, metadata = current.index.copy(), dict(current.metadata)
+            yield index, metadata
+            self._publish(index, metadata, current.version + 1)
+    
+    def _publish(self, index: AntigenExpressionIndex, metadata: Mapping[int, Dict], version: int):
+        """Swap in a new snapshot. Call with the write lock held."""
+        if version != self._snapshot.version:
+            self._historical_snapshot = None
+        self._snapshot = InventorySnapshot(version, index, metadata, indexed=not self._unindexed_antigrams,
+                                           archived=frozenset(self._archived_antigrams))
+    
+    def _index_pending_antigrams(self, batch_size: int = 50):
+        """
+        Load and index antigrams registered without their matrix, in registration order,
+        and publish the completed index under the same version. Call with the write lock held.
+        """
+        current = self._snapshot
+        pending = [antigram_id for antigram_id in current.metadata if antigram_id in self._unindexed_antigrams]
+        if not pending:
+            return
+        index = current.index.copy()
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            matrices = self.antigram_matrices.load_many(batch)
+            for antigram_id in batch:
+                matrix = matrices.get(antigram_id)
+                if matrix is not None:
+                    index.add_antigram(antigram_id, matrix)
+                else:
+                    logger.warning(f"Antigram {antigram_id} could not be loaded for indexing")
+                self._unindexed_antigrams.discard(antigram_id)
+        self._publish(index, current.metadata, current.version)
+        logger.info(f"Indexed {len(pending)} antigrams loaded on demand")
+    
+    def _is_expired(self, antigram_id: int) -> bool:
+        """Whether an antigram's lot is past its expiration date."""
+        return lot_expired(self._snapshot.metadata.get(antigram_id) or {})
+    
+    def archive_expired(self, as_of: Optional[date] = None) -> List[int]:
+        """
+        Archive every active lot that has expired: drop it from the expression index
+        and its matrix from memory (the database keeps it as cold storage).
+        Meant to run on a schedule, e.g. daily.
         
+        Args:
+            as_of: Date lots are compared with (today by default)
+            
+        Returns:
+            IDs of the newly archived antigrams
+        """
+        with self._write_lock:
+            current = self._snapshot
+            expired = [antigram_id for antigram_id, metadata in current.metadata.items()
+                       if antigram_id not in current.archived and lot_expired(metadata, as_of)]
+            if not expired:
+                return []
+            with self._writing() as (index, _):
+                for antigram_id in expired:
+                    self._archive(index, antigram_id)
+            # Matrices with unsaved changes stay until they are flushed
+            for antigram_id in expired:
+                if antigram_id not in self._dirty_antigrams:
+                    self.antigram_matrices.evict(antigram_id)
+        logger.info(f"Archived {len(expired)} expired antigrams")
+        return expired
+    
+    def archive_expired_if_due(self) -> List[int]:
+        """Run archive_expired if archive_interval_seconds have passed since the last run."""
+        if self.archive_interval_seconds is None or time.monotonic() < self._next_archive_at:
+            return []
+        with self._write_lock:
+            if time.monotonic() < self._next_archive_at:
+                return []
+            self._next_archive_at = time.monotonic() + self.archive_interval_seconds
+            return self.archive_expired()
+    
+    def _archive(self, index: AntigenExpressionIndex, antigram_id: int):
+        """Move an antigram to the archived partition (in a writer's index)."""
+        self._archived_antigrams.add(antigram_id)
+        self._unindexed_antigrams.discard(antigram_id)
+        index.remove_antigram(antigram_id)
+    
+
     def create_antigram_matrix(self, antigram_id: int, lot_number: str, 
                               template_name: str, antigens: List[str], 
                               cells_data: List[Dict], expiration_date: date) -> pd.DataFrame:
@@ -62,95 +276,103 @@ class PandasAntigramManager:
         df = pd.DataFrame(matrix_data, index=cell_numbers)
         df.index.name = 'cell_number'
         
-        # Store metadata
-        self.antigram_metadata[antigram_id] = {
-            'lot_number': lot_number,
-            'template_name': template_name,
-            'antigens': antigens,
-            'expiration_date': expiration_date,
-            'cell_count': len(cells_data)
-        }
-        
-        # Store matrix
-        self.antigram_matrices[antigram_id] = df
-        
-        # Persist to database if session is available
-        if self.db_session:
-            self._save_antigram_to_db(antigram_id, df, self.antigram_metadata[antigram_id])
+        with self._writing() as (index, metadata):
+            # Store metadata
+            metadata[antigram_id] = {
+                'lot_number': lot_number,
+                'template_name': template_name,
+                'antigens': antigens,
+                'expiration_date': expiration_date,
+                'cell_count': len(cells_data)
+            }
+            
+            # Store matrix
+            self._mark_antigram_dirty(antigram_id)
+            self.antigram_matrices[antigram_id] = df
+            self._index_antigram(index, metadata, antigram_id, df)
         
         return df
     
-    def _save_antigram_to_db(self, antigram_id: int, matrix: pd.DataFrame, metadata: Dict):
-        """Save antigram matrix and metadata to database."""
-        try:
-            # Check if antigram already exists
-            existing = self.db_session.query(AntigramMatrixStorage).filter_by(antigram_id=antigram_id).first()
-            
-            # Prepare data for storage
-            matrix_json = json.dumps(matrix.to_dict())
-            metadata_json = json.dumps(metadata, default=str)
-            current_time = datetime.now().date()
-            
-            if existing:
-                # Update existing record
-                existing.matrix_data = matrix_json
-                existing.matrix_metadata = metadata_json
-                existing.updated_at = current_time
-            else:
-                # Create new record
-                storage = AntigramMatrixStorage(
-                    antigram_id=antigram_id,
-                    matrix_data=matrix_json,
-                    matrix_metadata=metadata_json,
-                    created_at=current_time,
-                    updated_at=current_time
-                )
-                self.db_session.add(storage)
-            
-            # Don't commit immediately - let the caller handle batching
-            # self.db_session.commit()
-        except Exception as e:
-            self.db_session.rollback()
-            logger.error(f"Error saving antigram to database: {e}")
-            raise
+    def _index_antigram(self, index: AntigenExpressionIndex, metadata: Mapping[int, Dict],
+                        antigram_id: int, matrix: pd.DataFrame):
+        """Add or re-index an antigram whose matrix is in hand, or archive it if its lot has expired (in a writer's index)."""
+        if lot_expired(metadata[antigram_id]):
+            self._archive(index, antigram_id)
+            return
+        self._archived_antigrams.discard(antigram_id)
+        self._unindexed_antigrams.discard(antigram_id)
+        index.add_antigram(antigram_id, matrix)
+    
+    def _mark_antigram_dirty(self, antigram_id: int):
+        """Record that an antigram must be written on the next flush."""
+        if self.db_session:
+            self._dirty_antigrams.add(antigram_id)
+            self._deleted_antigrams.discard(antigram_id)
+    
+    def _antigram_storage_row(self, antigram_id: int, current_time: date) -> Dict:
+        """Column values for an antigram's AntigramMatrixStorage row."""
+        return {
+            'antigram_id': antigram_id,
+            'matrix_data': encode_matrix(self.antigram_matrices[antigram_id]),
+            'matrix_metadata': json.dumps(self._snapshot.metadata[antigram_id], default=str),
+            'created_at': current_time,
+            'updated_at': current_time,
+        }
     
     def load_from_database(self, db_session):
-        """Load all antigram data from database."""
+        """
+        Load metadata for every stored antigram. Matrices are not decoded here;
+        they are fetched on first use (see load_antigram_lazy).
+        """
         self.db_session = db_session
         try:
-            # Load all stored antigrams
-            stored_antigrams = db_session.query(AntigramMatrixStorage).all()
+            # Load only the lightweight metadata column
+            stored_antigrams = db_session.query(
+                AntigramMatrixStorage.antigram_id, AntigramMatrixStorage.matrix_metadata
+            ).all()
             
-            for stored in stored_antigrams:
-                # Load matrix
-                matrix_dict = json.loads(stored.matrix_data)
-                matrix_df = pd.DataFrame.from_dict(matrix_dict, orient='index')
-                
-                # Check if the matrix is transposed (antigens as index, cells as columns)
-                # If so, transpose it to have cells as index and antigens as columns
-                if len(matrix_df.columns) < len(matrix_df.index) and any(str(col).isdigit() for col in matrix_df.columns):
-                    # Matrix is transposed, fix it
-                    matrix_df = matrix_df.T
-                    logger.info(f"Transposed matrix for antigram {stored.antigram_id}")
-                
-                matrix_df.index.name = 'cell_number'
-                
-                # Load metadata
-                metadata = json.loads(stored.matrix_metadata)
-                
-                # Store in memory
-                self.antigram_matrices[stored.antigram_id] = matrix_df
-                self.antigram_metadata[stored.antigram_id] = metadata
+            with self._writing() as (_, metadata):
+                for antigram_id, matrix_metadata in stored_antigrams:
+                    self._register_antigram(metadata, antigram_id, json.loads(matrix_metadata))
             
-            logger.info(f"Loaded {len(stored_antigrams)} antigrams from database")
+            logger.info(f"Loaded metadata for {len(stored_antigrams)} antigrams from database")
             
         except Exception as e:
             logger.error(f"Error loading antigrams from database: {e}")
     
+    def _register_antigram(self, metadata: Dict[int, Dict], antigram_id: int, antigram_metadata: Dict):
+        """
+        Record a stored antigram (in a writer's metadata) whose matrix will be loaded
+        and indexed on demand; expired lots are archived and never loaded.
+        """
+        metadata[antigram_id] = antigram_metadata
+        self.antigram_matrices.register(antigram_id)
+        if lot_expired(antigram_metadata):
+            self._archived_antigrams.add(antigram_id)
+        else:
+            self._unindexed_antigrams.add(antigram_id)
+    
+    def _fetch_matrices(self, antigram_ids: List[int]) -> Dict[int, pd.DataFrame]:
+        """Decode the stored matrices of several antigrams with one query."""
+        if not self.db_session or not antigram_ids:
+            return {}
+        try:
+            stored = self.db_session.query(
+                AntigramMatrixStorage.antigram_id, AntigramMatrixStorage.matrix_data
+            ).filter(AntigramMatrixStorage.antigram_id.in_(antigram_ids)).all()
+            # Load matrix (binary format, or legacy JSON)
+            return {antigram_id: decode_matrix(matrix_data) for antigram_id, matrix_data in stored}
+        except Exception as e:
+            logger.error(f"Error loading antigram matrices {antigram_ids}: {e}")
+            return {}
+    
     def load_antigram_lazy(self, antigram_id: int) -> Optional[pd.DataFrame]:
-        """Lazy load a specific antigram from database."""
+        """
+        Get an antigram matrix, loading it from the database if it is not resident.
+        Antigrams stored after startup (e.g. by another worker) are registered on first use.
+        """
         if antigram_id in self.antigram_matrices:
-            return self.antigram_matrices[antigram_id]
+            return self.antigram_matrices.get(antigram_id)
         
         if not self.db_session:
             return None
@@ -158,25 +380,14 @@ class PandasAntigramManager:
         try:
             stored = self.db_session.query(AntigramMatrixStorage).filter_by(antigram_id=antigram_id).first()
             if stored:
-                # Load matrix
-                matrix_dict = json.loads(stored.matrix_data)
-                matrix_df = pd.DataFrame.from_dict(matrix_dict, orient='index')
-                
-                # Check if the matrix is transposed (antigens as index, cells as columns)
-                # If so, transpose it to have cells as index and antigens as columns
-                if len(matrix_df.columns) < len(matrix_df.index) and any(str(col).isdigit() for col in matrix_df.columns):
-                    # Matrix is transposed, fix it
-                    matrix_df = matrix_df.T
-                    logger.info(f"Transposed matrix for antigram {antigram_id}")
-                
-                matrix_df.index.name = 'cell_number'
-                
-                # Load metadata
-                metadata = json.loads(stored.matrix_metadata)
+                # Load matrix (binary format, or legacy JSON)
+                matrix_df = decode_matrix(stored.matrix_data)
                 
                 # Store in memory
-                self.antigram_matrices[antigram_id] = matrix_df
-                self.antigram_metadata[antigram_id] = metadata
+                with self._writing() as (index, metadata):
+                    metadata[antigram_id] = json.loads(stored.matrix_metadata)
+                    self.antigram_matrices[antigram_id] = matrix_df
+                    self._index_antigram(index, metadata, antigram_id, matrix_df)
                 
                 return matrix_df
         except Exception as e:
@@ -184,6 +395,59 @@ class PandasAntigramManager:
         
         return None
     
+    def apply_remote_changes(self, changes: List[Change]):
+        """
+        Reload antigrams another worker changed (see core.change_feed). Nothing is
+        marked for writing: the database already holds these changes.
+        
+        Args:
+            changes: The worker's unseen antigram changes, in version order
+        """
+        last_clear = max((i for i, change in enumerate(changes) if change.operation == OP_DELETE_ALL), default=None)
+        if last_clear is not None:
+            self._forget_all_antigrams()
+            changes = changes[last_clear + 1:]
+        
+        antigram_ids = {int(change.key) for change in changes}
+        if not antigram_ids:
+            return
+        
+        # Current state of every changed antigram, whatever the sequence of operations
+        stored = self.db_session.query(
+            AntigramMatrixStorage.antigram_id, AntigramMatrixStorage.matrix_metadata, AntigramMatrixStorage.matrix_data
+        ).filter(AntigramMatrixStorage.antigram_id.in_(antigram_ids)).all()
+        
+        # Every change lands in one new snapshot
+        with self._writing() as (index, metadata):
+            found = set()
+            for antigram_id, matrix_metadata, matrix_data in stored:
+                matrix = decode_matrix(matrix_data)
+                metadata[antigram_id] = json.loads(matrix_metadata)
+                self.antigram_matrices[antigram_id] = matrix
+                self._index_antigram(index, metadata, antigram_id, matrix)
+                found.add(antigram_id)
+            
+            removed = [antigram_id for antigram_id in antigram_ids - found if antigram_id in metadata]
+            for antigram_id in removed:
+                del metadata[antigram_id]
+                self._unindexed_antigrams.discard(antigram_id)
+                self._archived_antigrams.discard(antigram_id)
+                index.remove_antigram(antigram_id)
+        
+        for antigram_id in removed:
+            if antigram_id in self.antigram_matrices:
+                del self.antigram_matrices[antigram_id]
+    
+    def reload_from_database(self):
+        """Discard in-memory antigrams and load metadata for every stored antigram again."""
+        self._forget_all_antigrams()
+        self.load_from_database(self.db_session)
+    
+    def residency_stats(self) -> Dict:
+        """Matrix residency counters and the numbers of antigrams not yet indexed and archived."""
+        return {**self.antigram_matrices.stats(), 'unindexed_antigrams': len(self._unindexed_antigrams),
+                'archived_antigrams': len(self._snapshot.archived)}
+    
     def save_all_to_database(self):
         """Save all current antigram data to database."""
         if not self.db_session:
@@ -191,79 +455,205 @@ class PandasAntigramManager:
             return
         
         try:
-            for antigram_id, matrix in self.antigram_matrices.items():
-                metadata = self.antigram_metadata.get(antigram_id, {})
-                self._save_antigram_to_db(antigram_id, matrix, metadata)
-            
-            # Batch commit all changes
-            self.db_session.commit()
+            # Write every resident antigram (the rest are unchanged since they were
+            # loaded) along with any pending deletes, then batch commit
+            with self._write_lock:
+                self._dirty_antigrams.update(
+                    antigram_id for antigram_id in self.antigram_matrices if self.antigram_matrices.is_resident(antigram_id)
+                )
+                self.commit_changes()
             logger.info(f"Saved {len(self.antigram_matrices)} antigrams to database")
         except Exception as e:
-            self.db_session.rollback()
             logger.error(f"Error saving antigrams to database: {e}")
     
+    @property
+    def has_pending_changes(self) -> bool:
+        """Whether any antigram changed since the last flush."""
+        return bool(self._dirty_antigrams or self._deleted_antigrams or self._delete_all_antigrams)
+    
+    def _reset_change_tracking(self):
+        self._dirty_antigrams.clear()
+        self._deleted_antigrams.clear()
+        self._delete_all_antigrams = False
+    
+    def _write_antigram_changes(self) -> int:
+        """Stage deletes and upserts for changed antigrams in the session."""
+        if self._delete_all_antigrams:
+            self.db_session.query(AntigramMatrixStorage).delete(synchronize_session=False)
+            record_changes(self.db_session, ENTITY_ANTIGRAM, OP_DELETE_ALL)
+        elif self._deleted_antigrams:
+            bulk_delete(self.db_session, AntigramMatrixStorage, ['antigram_id'],
+                        [(antigram_id,) for antigram_id in self._deleted_antigrams])
+            record_changes(self.db_session, ENTITY_ANTIGRAM, OP_DELETE, sorted(self._deleted_antigrams))
+        
+        current_time = datetime.now().date()
+        rows = [self._antigram_storage_row(antigram_id, current_time)
+                for antigram_id in sorted(self._dirty_antigrams) if antigram_id in self.antigram_matrices]
+        written = bulk_upsert(self.db_session, AntigramMatrixStorage, rows, key_columns=['antigram_id'])
+        # Published to other workers in the same transaction as the rows themselves
+        record_changes(self.db_session, ENTITY_ANTIGRAM, OP_UPSERT, [row['antigram_id'] for row in rows])
+        return written
+    
+    def flush_changes(self) -> bool:
+        """
+        Persist only the antigrams created, updated or deleted since the last flush.
+        Does nothing (and touches no database connection) when nothing changed.
+        
+        Returns:
+            bool: True if changes were written
+        """
+        if not self.db_session or not self.has_pending_changes:
+            return False
+        try:
+            self.commit_changes()
+            return True
+        except Exception:
+            return False
+    
     def commit_changes(self):
-        """Commit pending database changes."""
+        """Write changed antigrams and commit pending database changes."""
         if self.db_session:
-            try:
-                self.db_session.commit()
-            except Exception as e:
-                self.db_session.rollback()
-                logger.error(f"Error committing changes: {e}")
-                raise
+            # Writers wait, so the change tracking sets are not changed mid-flush
+            with self._write_lock:
+                try:
+                    written = self._write_antigram_changes()
+                    self.db_session.commit()
+                    if self.has_pending_changes:
+                        logger.debug(f"Flushed {written} changed antigrams to database")
+                    self._reset_change_tracking()
+                except Exception as e:
+                    self.db_session.rollback()
+                    logger.error(f"Error committing changes: {e}")
+                    raise
     
     def get_antigram_matrix(self, antigram_id: int) -> Optional[pd.DataFrame]:
-        """Get antigram matrix by ID."""
-        return self.antigram_matrices.get(antigram_id)
+        """Get antigram matrix by ID, loading it if it is not resident."""
+        return self.load_antigram_lazy(antigram_id)
     
     def get_antigram_metadata(self, antigram_id: int) -> Optional[Dict]:
         """Get antigram metadata by ID."""
         return self.antigram_metadata.get(antigram_id)
     
+    def cell_numbers(self, antigram_id: int) -> Optional[List[str]]:
+        """
+        Cell numbers of an antigram in matrix order, if known without loading its
+        matrix (from the expression index or the resident matrix); None otherwise.
+        """
+        if antigram_id not in self._unindexed_antigrams:
+            cells = self._snapshot.index.antigram_cells(antigram_id)
+            if cells:
+                return [str(cell_number) for cell_number in cells]
+        if self.antigram_matrices.is_resident(antigram_id):
+            return [str(cell_number) for cell_number in self.antigram_matrices[antigram_id].index]
+        return None
+    
+    def get_all_antigens(self) -> List[str]:
+        """Sorted distinct antigens across all antigrams, from metadata only."""
+        all_antigens = set()
+        for metadata in self.snapshot(indexed=False).metadata.values():
+            all_antigens.update(metadata.get('antigens', []))
+        return sorted(all_antigens)
+    
     def get_all_antigrams(self) -> List[Dict]:
         """Get all antigram metadata."""
         return [
             {'id': antigram_id, **metadata}
-            for antigram_id, metadata in self.antigram_metadata.items()
+            for antigram_id, metadata in self.snapshot(indexed=False).metadata.items()
         ]
     
-    def find_cells_by_pattern(self, antigen_pattern: Dict[str, str]) -> List[Dict]:
+    def find_cells_by_pattern(self, antigen_pattern: Dict[str, str],
+                              reaction_antigens: Optional[List[str]] = None,
+                              include_archived: bool = False) -> List[Dict]:
         """
         Find cells matching a specific antigen pattern across all antigrams.
         
+        Uses the expression index posting lists, so no matrix is scanned or loaded.
+        
         Args:
             antigen_pattern: Dict of {antigen: reaction_value}
+            reaction_antigens: Antigens to include in each match's reactions (missing
+                ones as '-'). Defaults to the antigens of the cell's antigram.
+            include_archived: Search expired (archived) lots too
             
         Returns:
-            List of matching cells with antigram info
+            List of matching cells with antigram info, in antigram ID then cell order
+        """
+        return list(self.iter_cells_by_pattern(antigen_pattern, reaction_antigens, include_archived))
+    
+    def iter_cells_by_pattern(self, antigen_pattern: Dict[str, str],
+                              reaction_antigens: Optional[List[str]] = None,
+                              include_archived: bool = False,
+                              after: Optional[Tuple[int, str]] = None,
+                              batch_size: int = 256) -> Iterator[Dict]:
         """
-        matches = []
+        Iterate over the cells matching an antigen pattern, in antigram ID then cell order.
         
-        for antigram_id, matrix in self.antigram_matrices.items():
-            metadata = self.antigram_metadata[antigram_id]
-            
-            # Check if matrix has all required antigens
-            if not all(antigen in matrix.columns for antigen in antigen_pattern.keys()):
-                continue
-            
-            # Find matching cells
-            mask = pd.Series(True, index=matrix.index)
-            for antigen, expected_reaction in antigen_pattern.items():
-                mask &= (matrix[antigen] == expected_reaction)
-            
-            matching_cells = matrix[mask]
+        The search runs when this is called; matching slots are sorted by their
+        (antigram_id, position in the antigram) key (see InventorySnapshot.cell_order_keys)
+        and materialized batch_size cells at a time as the iterator is consumed, so the
+        first matches are ready, and memory stays bounded, however many cells match.
+        
+        Args:
+            antigen_pattern: Dict of {antigen: reaction_value}
+            reaction_antigens: Antigens to include in each match's reactions (see find_cells_by_pattern)
+            include_archived: Search expired (archived) lots too
+            after: (antigram_id, cell_number) of a previous match to resume after (a
+                keyset cursor: the cell need not still be in the inventory; if its
+                antigram is gone the search resumes at the next antigram, and if only
+                the cell is gone, at the start of its antigram)
+            batch_size: Matches materialized per batch
             
-            for cell_number in matching_cells.index:
-                matches.append({
+        Returns:
+            Iterator of matching cells with antigram info, shaped like find_cells_by_pattern results
+        """
+        # One snapshot, so the matches and their metadata come from the same inventory
+        snapshot = self.snapshot(include_archived=include_archived)
+        index = snapshot.index
+        slots = index.slots(index.match(antigen_pattern))
+        if not len(slots):
+            return iter(())
+        
+        slot_antigrams, slot_positions = snapshot.cell_order_keys()
+        antigram_ids, positions = slot_antigrams[slots], slot_positions[slots]
+        order = np.lexsort((positions, antigram_ids))
+        slots, antigram_ids, positions = slots[order], antigram_ids[order], positions[order]
+        
+        if after is not None:
+            after_antigram, after_cell = after
+            after_slot = index.slot_of(after_antigram, after_cell)
+            after_position = slot_positions[after_slot] if after_slot is not None else -1
+            first = np.searchsorted(antigram_ids, after_antigram, side='left')
+            last = np.searchsorted(antigram_ids, after_antigram, side='right')
+            slots = slots[first + np.searchsorted(positions[first:last], after_position, side='right'):]
+        return self._materialize_matches(snapshot, slots, reaction_antigens, batch_size)
+    
+    @staticmethod
+    def _materialize_matches(snapshot: InventorySnapshot, slots: np.ndarray,
+                             reaction_antigens: Optional[List[str]], batch_size: int) -> Iterator[Dict]:
+        """Yield the cell finder records of the given slots, batch_size at a time."""
+        index = snapshot.index
+        columns = list(reaction_antigens) if reaction_antigens is not None else index.antigens
+        column_positions = {antigen: position for position, antigen in enumerate(columns)}
+        
+        for start in range(0, len(slots), batch_size):
+            # Materialize every row of the batch in one pass over the posting lists
+            batch = slots[start:start + batch_size]
+            rows = index.materialize(batch, columns)
+            for slot, row in zip(batch.tolist(), rows):
+                antigram_id, cell_number = index.cell_key(slot)
+                metadata = snapshot.metadata[antigram_id]
+                if reaction_antigens is not None:
+                    reactions = dict(zip(columns, row.tolist()))
+                else:
+                    reactions = {antigen: row[column_positions[antigen]] for antigen in index.antigram_antigens(antigram_id)}
+                yield {
                     'antigram_id': antigram_id,
                     'lot_number': metadata['lot_number'],
                     'template_name': metadata['template_name'],
                     'cell_number': cell_number,
-                    'reactions': matching_cells.loc[cell_number].to_dict(),
+                    'reactions': reactions,
                     'expiration_date': metadata['expiration_date']
-                })
-        
-        return matches
+                }
     
     def get_antigen_reactions(self, antigen: str) -> Dict[int, Dict[int, str]]:
         """
@@ -277,8 +667,9 @@ class PandasAntigramManager:
         """
         antigen_reactions = {}
         
-        for antigram_id, matrix in self.antigram_matrices.items():
-            if antigen in matrix.columns:
+        for antigram_id in self.snapshot(indexed=False).antigram_ids:
+            matrix = self.antigram_matrices.get(antigram_id)
+            if matrix is not None and antigen in matrix.columns:
                 antigen_reactions[antigram_id] = matrix[antigen].to_dict()
         
         return antigen_reactions
@@ -297,11 +688,11 @@ class PandasAntigramManager:
         Returns:
             pandas.DataFrame: Updated matrix with cells as index and antigens as columns
         """
-        if antigram_id not in self.antigram_matrices:
+        existing_metadata = self._snapshot.metadata.get(antigram_id)
+        if existing_metadata is None:
             raise ValueError(f"Antigram with ID {antigram_id} not found")
         
         # Get existing metadata to preserve template info
-        existing_metadata = self.antigram_metadata[antigram_id]
         template_name = existing_metadata['template_name']
         antigens = existing_metadata['antigens']
         
@@ -325,53 +716,79 @@ class PandasAntigramManager:
         df = pd.DataFrame(matrix_data, index=cell_numbers)
         df.index.name = 'cell_number'
         
-        # Update metadata
-        self.antigram_metadata[antigram_id] = {
-            'lot_number': lot_number,
-            'template_name': template_name,
-            'antigens': antigens,
-            'expiration_date': expiration_date,
-            'cell_count': len(cells_data)
-        }
-        
-        # Update matrix
-        self.antigram_matrices[antigram_id] = df
-        
-        # Persist to database if session is available
-        if self.db_session:
-            self._save_antigram_to_db(antigram_id, df, self.antigram_metadata[antigram_id])
+        with self._writing() as (index, metadata):
+            if antigram_id not in metadata:
+                raise ValueError(f"Antigram with ID {antigram_id} not found")
+            
+            # Update metadata
+            metadata[antigram_id] = {
+                'lot_number': lot_number,
+                'template_name': template_name,
+                'antigens': antigens,
+                'expiration_date': expiration_date,
+                'cell_count': len(cells_data)
+            }
+            
+            # Update matrix
+            self._mark_antigram_dirty(antigram_id)
+            self.antigram_matrices[antigram_id] = df
+            self._index_antigram(index, metadata, antigram_id, df)
         
         return df
 
     def delete_antigram(self, antigram_id: int) -> bool:
         """Delete an antigram and its matrix."""
-        if antigram_id in self.antigram_matrices:
-            del self.antigram_matrices[antigram_id]
-            del self.antigram_metadata[antigram_id]
+        with self._write_lock:
+            if antigram_id not in self._snapshot.metadata:
+                return False
+            self._forget_antigram(antigram_id)
             
-            # Delete from database if session is available
+            # Delete from database on the next flush
             if self.db_session:
-                try:
-                    stored = self.db_session.query(AntigramMatrixStorage).filter_by(antigram_id=antigram_id).first()
-                    if stored:
-                        self.db_session.delete(stored)
-                        self.db_session.commit()
-                except Exception as e:
-                    self.db_session.rollback()
-                    logger.error(f"Error deleting antigram from database: {e}")
+                self._dirty_antigrams.discard(antigram_id)
+                self._deleted_antigrams.add(antigram_id)
             
             return True
-        return False
+    
+    def _forget_antigram(self, antigram_id: int):
+        """Drop an antigram from the expression index and then from memory."""
+        with self._writing() as (index, metadata):
+            del metadata[antigram_id]
+            self._unindexed_antigrams.discard(antigram_id)
+            self._archived_antigrams.discard(antigram_id)
+            index.remove_antigram(antigram_id)
+        # Readers of older snapshots that still ask for the matrix get None
+        del self.antigram_matrices[antigram_id]
+    
+    def _forget_all_antigrams(self):
+        """Drop every antigram from the expression index and then from memory."""
+        with self._writing() as (index, metadata):
+            metadata.clear()
+            self._unindexed_antigrams.clear()
+            self._archived_antigrams.clear()
+            index.clear()
+        self.antigram_matrices.clear()
+    
+    def clear_antigrams(self):
+        """Remove all antigrams (from the database on the next flush)."""
+        with self._write_lock:
+            self._forget_all_antigrams()
+            if self.db_session:
+                self._delete_all_antigrams = True
+                self._dirty_antigrams.clear()
+                self._deleted_antigrams.clear()
     
     def to_json(self) -> Dict:
         """Convert all data to JSON-serializable format."""
+        snapshot = self.snapshot(indexed=False)
+        matrices = {antigram_id: self.antigram_matrices.get(antigram_id) for antigram_id in snapshot.antigram_ids}
         return {
             'antigram_matrices': {
                 str(antigram_id): {
                     'matrix': matrix.to_dict(),
-                    'metadata': self.antigram_metadata[antigram_id]
+                    'metadata': snapshot.metadata[antigram_id]
                 }
-                for antigram_id, matrix in self.antigram_matrices.items()
+                for antigram_id, matrix in matrices.items() if matrix is not None
             },
             'patient_reactions': self.patient_reactions.to_dict() if not self.patient_reactions.empty else {}
         }
@@ -379,12 +796,15 @@ class PandasAntigramManager:
     def from_json(self, data: Dict):
         """Load data from JSON format."""
         # Load antigram matrices
-        for antigram_id_str, antigram_data in data.get('antigram_matrices', {}).items():
-            antigram_id = int(antigram_id_str)
-            matrix_df = pd.DataFrame.from_dict(antigram_data['matrix'], orient='index')
-            matrix_df.index.name = 'cell_number'
-            self.antigram_matrices[antigram_id] = matrix_df
-            self.antigram_metadata[antigram_id] = antigram_data['metadata']
+        with self._writing() as (index, metadata):
+            for antigram_id_str, antigram_data in data.get('antigram_matrices', {}).items():
+                antigram_id = int(antigram_id_str)
+                matrix_df = pd.DataFrame.from_dict(antigram_data['matrix'], orient='index')
+                matrix_df.index.name = 'cell_number'
+                metadata[antigram_id] = antigram_data['metadata']
+                self._mark_antigram_dirty(antigram_id)
+                self.antigram_matrices[antigram_id] = matrix_df
+                self._index_antigram(index, metadata, antigram_id, matrix_df)
         
         # Load patient reactions
         if data.get('patient_reactions'):
@@ -395,86 +815,149 @@ class PandasPatientReactionManager:
     """
     Manages patient reaction data using pandas for efficient operations.
     Now includes database persistence for data durability.
+    
+    Reactions live in a ReactionStore (one int8 code vector per antigram), so adding,
+    reading and deleting a reaction take constant time; reactions_df is a DataFrame
+    view of the store for callers that want one.
+    
+    Args:
+        db_session: Database session for persistence
+        cell_order: Returns an antigram's cell numbers in matrix order, or None if
+            unknown (e.g. PandasAntigramManager.cell_numbers)
     """
     
-    def __init__(self, db_session=None):
-        # Always initialize with a MultiIndex, even if empty
-        self.reactions_df = pd.DataFrame(columns=['patient_reaction'])
-        self.reactions_df.index = pd.MultiIndex.from_tuples([], names=['antigram_id', 'cell_number'])
+    def __init__(self, db_session=None, cell_order: Optional[Callable[[int], Optional[List[str]]]] = None):
+        self._store = ReactionStore(cell_order)
+        self._reactions_df: Optional[Tuple[int, pd.DataFrame]] = None
         self.db_session = db_session
+        # Bumped on every mutation so derived state can detect changes it did not see
+        self.version = 0
+        # Reactions changed since the last flush to the database
+        self._dirty_reactions: Set[Tuple[int, str]] = set()
+        self._deleted_reactions: Set[Tuple[int, str]] = set()
+        self._delete_all_reactions = False
+        # Serializes mutations and flushes, so no change lands between a flush's
+        # write and its reset of the change tracking sets
+        self._write_lock = threading.RLock()
     
     def add_reaction(self, antigram_id: int, cell_number, reaction: str):
         """Add or update a patient reaction."""
         # Convert cell_number to string to handle both numeric and alphabetic cell numbers
         cell_number = str(cell_number)
         index = (antigram_id, cell_number)
-        # If not MultiIndex, convert
-        if not isinstance(self.reactions_df.index, pd.MultiIndex):
-            self.reactions_df.index = pd.MultiIndex.from_tuples(self.reactions_df.index, names=['antigram_id', 'cell_number'])
-        # Add or update
-        self.reactions_df.loc[index, 'patient_reaction'] = reaction
-        # Ensure MultiIndex after assignment
-        if not isinstance(self.reactions_df.index, pd.MultiIndex):
-            self.reactions_df.index = pd.MultiIndex.from_tuples(self.reactions_df.index, names=['antigram_id', 'cell_number'])
-        
-        # Persist to database if session is available
-        if self.db_session:
-            self._save_reaction_to_db(antigram_id, cell_number, reaction)
-    
-    def _save_reaction_to_db(self, antigram_id: int, cell_number, reaction: str):
-        """Save patient reaction to database."""
-        try:
-            # Convert cell_number to string for consistent handling
-            cell_number = str(cell_number)
-            
-            # Check if reaction already exists
-            existing = self.db_session.query(PatientReactionStorage).filter_by(
-                antigram_id=antigram_id, 
-                cell_number=cell_number
-            ).first()
-            
-            current_time = datetime.now().date()
-            
-            if existing:
-                # Update existing record
-                existing.patient_reaction = reaction
-                existing.updated_at = current_time
-            else:
-                # Create new record
-                storage = PatientReactionStorage(
-                    antigram_id=antigram_id,
-                    cell_number=cell_number,
-                    patient_reaction=reaction,
-                    created_at=current_time,
-                    updated_at=current_time
-                )
-                self.db_session.add(storage)
+        with self._write_lock:
+            self._store_reaction(index, reaction)
             
-            # Don't commit immediately - let the caller handle batching
-            # self.db_session.commit()
-        except Exception as e:
-            self.db_session.rollback()
-            logger.error(f"Error saving patient reaction to database: {e}")
-            raise
+            # Persist on the next flush if session is available
+            if self.db_session:
+                self._dirty_reactions.add(index)
+                self._deleted_reactions.discard(index)
+    
+    def _store_reaction(self, index: Tuple[int, str], reaction: str):
+        """Set a reaction in memory."""
+        self._store.set(index[0], index[1], reaction)
+        self.version += 1
+    
+    def _drop_reaction(self, index: Tuple[int, str]) -> bool:
+        """Remove a reaction from memory, if present."""
+        if not self._store.delete(index[0], index[1]):
+            return False
+        self.version += 1
+        return True
+    
+    def _reset_reactions(self):
+        """Remove every reaction from memory."""
+        self._store.clear()
+        self.version += 1
+    
+    @property
+    def reactions_df(self) -> pd.DataFrame:
+        """
+        Reactions as a DataFrame indexed by (antigram_id, cell_number), with a
+        patient_reaction column. Built from the store when reactions changed since
+        the last call; treat it as read-only.
+        """
+        if self._reactions_df is None or self._reactions_df[0] != self.version:
+            keys, reactions = [], []
+            for key, reaction in self._store.items():
+                keys.append(key)
+                reactions.append(reaction)
+            reactions_df = pd.DataFrame(
+                {'patient_reaction': pd.Series(reactions, dtype=object)},
+            )
+            reactions_df.index = pd.MultiIndex.from_tuples(keys, names=['antigram_id', 'cell_number'])
+            self._reactions_df = (self.version, reactions_df)
+        return self._reactions_df[1]
+    
+    @property
+    def reaction_count(self) -> int:
+        """Number of cells with a patient reaction."""
+        return len(self._store)
+    
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the reactions."""
+        return self._store.nbytes
+    
+    def iter_reactions(self) -> Iterator[Tuple[Tuple[int, str], str]]:
+        """((antigram_id, cell_number), reaction) of every reaction, by antigram then cell order."""
+        return self._store.items()
+    
+    def reaction_codes(self, antigram_id: int) -> Tuple[List[str], np.ndarray]:
+        """An antigram's cell numbers and a read-only view of their reaction codes (see ReactionStore.codes)."""
+        return self._store.codes(antigram_id)
+    
+    def apply_remote_changes(self, changes: List[Change]):
+        """
+        Reload reactions another worker changed (see core.change_feed). Nothing is
+        marked for writing: the database already holds these changes.
+        
+        Args:
+            changes: The worker's unseen patient reaction changes, in version order
+        """
+        last_clear = max((i for i, change in enumerate(changes) if change.operation == OP_DELETE_ALL), default=None)
+        if last_clear is not None:
+            with self._write_lock:
+                self._reset_reactions()
+            changes = changes[last_clear + 1:]
+        
+        keys = {parse_reaction_key(change.key) for change in changes}
+        if not keys:
+            return
+        
+        # Current state of every changed reaction, whatever the sequence of operations
+        stored = self.db_session.query(
+            PatientReactionStorage.antigram_id, PatientReactionStorage.cell_number, PatientReactionStorage.patient_reaction
+        ).filter(PatientReactionStorage.antigram_id.in_({antigram_id for antigram_id, _ in keys})).all()
+        current = {(antigram_id, cell_number): reaction for antigram_id, cell_number, reaction in stored
+                   if (antigram_id, cell_number) in keys}
+        
+        with self._write_lock:
+            for index in sorted(keys):
+                if index in current:
+                    self._store_reaction(index, current[index])
+                else:
+                    self._drop_reaction(index)
+    
+    def reload_from_database(self):
+        """Discard in-memory reactions and load every stored reaction again."""
+        with self._write_lock:
+            self._reset_reactions()
+            self.load_from_database(self.db_session)
     
     def load_from_database(self, db_session):
         """Load all patient reaction data from database."""
         self.db_session = db_session
         try:
-            # Load all stored reactions
-            stored_reactions = db_session.query(PatientReactionStorage).all()
+            # Load all stored reactions straight into the store's code vectors
+            stored_reactions = db_session.query(
+                PatientReactionStorage.antigram_id, PatientReactionStorage.cell_number, PatientReactionStorage.patient_reaction
+            ).all()
             
             if stored_reactions:
-                # Prepare data for DataFrame
-                tuples = []
-                reactions = []
-                
-                for stored in stored_reactions:
-                    tuples.append((stored.antigram_id, stored.cell_number))
-                    reactions.append({'patient_reaction': stored.patient_reaction})
-                
-                # Create DataFrame
-                self.reactions_df = pd.DataFrame(reactions, index=pd.MultiIndex.from_tuples(tuples, names=['antigram_id', 'cell_number']))
+                with self._write_lock:
+                    self._store.load(stored_reactions)
+                    self.version += 1
             
             logger.info(f"Loaded {len(stored_reactions)} patient reactions from database")
             
@@ -488,43 +971,99 @@ class PandasPatientReactionManager:
             return
         
         try:
-            # Clear existing reactions in database
-            self.db_session.query(PatientReactionStorage).delete()
-            
-            # Save all current reactions
-            for (antigram_id, cell_number), row in self.reactions_df.iterrows():
-                self._save_reaction_to_db(antigram_id, cell_number, row['patient_reaction'])
-            
-            # Batch commit all changes
-            self.db_session.commit()
-            logger.info(f"Saved {len(self.reactions_df)} patient reactions to database")
+            # Clear existing reactions in database and save all current reactions
+            with self._write_lock:
+                self._delete_all_reactions = True
+                self._deleted_reactions.clear()
+                self._dirty_reactions = {key for key, _ in self._store.items()}
+                
+                # Batch commit all changes
+                self.commit_changes()
+            logger.info(f"Saved {self.reaction_count} patient reactions to database")
         except Exception as e:
-            self.db_session.rollback()
             logger.error(f"Error saving patient reactions to database: {e}")
     
+    @property
+    def has_pending_changes(self) -> bool:
+        """Whether any reaction changed since the last flush."""
+        return bool(self._dirty_reactions or self._deleted_reactions or self._delete_all_reactions)
+    
+    def _reset_change_tracking(self):
+        self._dirty_reactions.clear()
+        self._deleted_reactions.clear()
+        self._delete_all_reactions = False
+    
+    def _write_reaction_changes(self) -> int:
+        """Stage deletes and upserts for changed reactions in the session."""
+        if self._delete_all_reactions:
+            self.db_session.query(PatientReactionStorage).delete(synchronize_session=False)
+            record_changes(self.db_session, ENTITY_PATIENT_REACTION, OP_DELETE_ALL)
+        elif self._deleted_reactions:
+            bulk_delete(self.db_session, PatientReactionStorage, ['antigram_id', 'cell_number'],
+                        self._deleted_reactions)
+            record_changes(self.db_session, ENTITY_PATIENT_REACTION, OP_DELETE,
+                           [reaction_key(antigram_id, cell_number) for antigram_id, cell_number in sorted(self._deleted_reactions)])
+        
+        current_time = datetime.now().date()
+        rows = []
+        for antigram_id, cell_number in sorted(self._dirty_reactions):
+            reaction = self.get_reaction(antigram_id, cell_number)
+            if reaction is not None:
+                rows.append({
+                    'antigram_id': antigram_id,
+                    'cell_number': cell_number,
+                    'patient_reaction': reaction,
+                    'created_at': current_time,
+                    'updated_at': current_time,
+                })
+        # Published to other workers in the same transaction as the rows themselves
+        record_changes(self.db_session, ENTITY_PATIENT_REACTION, OP_UPSERT,
+                       [reaction_key(row['antigram_id'], row['cell_number']) for row in rows])
+        if self._delete_all_reactions:
+            # The table was just emptied, so every row is new
+            return bulk_insert(self.db_session, PatientReactionStorage, rows)
+        return bulk_upsert(self.db_session, PatientReactionStorage, rows,
+                           key_columns=['antigram_id', 'cell_number'])
+    
+    def flush_changes(self) -> bool:
+        """
+        Persist only the reactions added, updated or deleted since the last flush.
+        Does nothing (and touches no database connection) when nothing changed.
+        
+        Returns:
+            bool: True if changes were written
+        """
+        if not self.db_session or not self.has_pending_changes:
+            return False
+        try:
+            self.commit_changes()
+            return True
+        except Exception:
+            return False
+    
     def commit_changes(self):
-        """Commit pending database changes."""
+        """Write changed reactions and commit pending database changes."""
         if self.db_session:
-            try:
-                self.db_session.commit()
-            except Exception as e:
-                self.db_session.rollback()
-                logger.error(f"Error committing changes: {e}")
-                raise
+            # Writers wait, so the change tracking sets are not changed mid-flush
+            with self._write_lock:
+                try:
+                    written = self._write_reaction_changes()
+                    self.db_session.commit()
+                    if self.has_pending_changes:
+                        logger.debug(f"Flushed {written} changed patient reactions to database")
+                    self._reset_change_tracking()
+                except Exception as e:
+                    self.db_session.rollback()
+                    logger.error(f"Error committing changes: {e}")
+                    raise
     
     def get_reactions_for_antigram(self, antigram_id: int) -> Dict:
-        """Get all patient reactions for a specific antigram."""
-        if self.reactions_df.empty:
-            return {}
-        if not isinstance(self.reactions_df.index, pd.MultiIndex):
-            self.reactions_df.index = pd.MultiIndex.from_tuples(self.reactions_df.index, names=['antigram_id', 'cell_number'])
-        try:
-            mask = self.reactions_df.index.get_level_values(0) == antigram_id
-            reactions = self.reactions_df[mask]
-            return {cell_number: val for (_, cell_number), val in reactions['patient_reaction'].items()}
-        except Exception as e:
-            logger.error(f"Error in get_reactions_for_antigram: {e}")
-            return {}
+        """Get all patient reactions for a specific antigram, as {cell_number: reaction} in cell order."""
+        return self._store.reactions_for_antigram(antigram_id)
+    
+    def get_reaction(self, antigram_id: int, cell_number) -> Optional[str]:
+        """Get the patient reaction for a single cell, or None if there is none."""
+        return self._store.get(antigram_id, str(cell_number))
     
     def get_reactions_for_antigen(self, antigen: str, antigram_manager: PandasAntigramManager) -> List[Dict]:
         """
@@ -566,64 +1105,55 @@ class PandasPatientReactionManager:
     
     def clear_reactions(self):
         """Clear all patient reactions."""
-        self.reactions_df = pd.DataFrame(columns=['patient_reaction'])
-        self.reactions_df.index = pd.MultiIndex.from_tuples([], names=['antigram_id', 'cell_number'])
+        with self._write_lock:
+            self._reset_reactions()
+            
+            # Delete every stored reaction on the next flush
+            if self.db_session:
+                self._delete_all_reactions = True
+                self._dirty_reactions.clear()
+                self._deleted_reactions.clear()
     
     def delete_reaction(self, antigram_id: int, cell_number):
         """Delete a specific patient reaction."""
         # Convert cell_number to string for consistent handling
         cell_number = str(cell_number)
         index = (antigram_id, cell_number)
-        if index in self.reactions_df.index:
-            self.reactions_df = self.reactions_df.drop(index)
-            if not isinstance(self.reactions_df.index, pd.MultiIndex):
-                self.reactions_df.index = pd.MultiIndex.from_tuples(self.reactions_df.index, names=['antigram_id', 'cell_number'])
-            
-            # Delete from database if session is available
-            if self.db_session:
-                try:
-                    stored = self.db_session.query(PatientReactionStorage).filter_by(
-                        antigram_id=antigram_id, 
-                        cell_number=cell_number
-                    ).first()
-                    if stored:
-                        self.db_session.delete(stored)
-                        self.db_session.commit()
-                except Exception as e:
-                    self.db_session.rollback()
-                    logger.error(f"Error deleting patient reaction from database: {e}")
+        with self._write_lock:
+            if self._drop_reaction(index):
+                # Delete from database on the next flush
+                if self.db_session:
+                    self._dirty_reactions.discard(index)
+                    self._deleted_reactions.add(index)
     
     def to_dict(self) -> Dict:
         """Convert to dictionary format."""
-        if self.reactions_df.empty:
-            return {}
-        
-        # Serialize MultiIndex as string keys
-        return {str(index): row.to_dict() for index, row in self.reactions_df.iterrows()}
+        # Serialize (antigram_id, cell_number) keys as strings
+        return {str(key): {'patient_reaction': reaction} for key, reaction in self._store.items()}
     
     def from_dict(self, data: Dict):
         """Load from dictionary format."""
         if data:
-            tuples = []
             rows = []
             for index_str, row in data.items():
                 index_str = index_str.strip('()')
-                antigram_id, cell_number = map(int, index_str.split(', '))
-                tuples.append((antigram_id, cell_number))
-                rows.append(row)
-            self.reactions_df = pd.DataFrame(rows, index=pd.MultiIndex.from_tuples(tuples, names=['antigram_id', 'cell_number']))
+                antigram_id, cell_number = index_str.split(', ')
+                rows.append((int(antigram_id), cell_number.strip("'\""), row['patient_reaction']))
+            with self._write_lock:
+                self._store.load(rows)
+                self.version += 1
         else:
             self.clear_reactions()
 
 
 # SQLAlchemy model for storing pandas data
 class AntigramMatrixStorage(Base):
-    """SQLAlchemy model for storing antigram matrices as JSON."""
+    """SQLAlchemy model for storing antigram matrices in the compact binary format."""
     __tablename__ = 'antigram_matrix_storage'
     
     id = Column(Integer, primary_key=True)
     antigram_id = Column(Integer, nullable=False, unique=True)
-    matrix_data = Column(Text, nullable=False)  # JSON string of pandas DataFrame
+    matrix_data = Column(LargeBinary, nullable=False)  # core.matrix_codec encoding (legacy rows: JSON)
     matrix_metadata = Column(Text, nullable=False)     # JSON string of metadata
     created_at = Column(Date, nullable=False)
     updated_at = Column(Date, nullable=False)
@@ -632,7 +1162,7 @@ class AntigramMatrixStorage(Base):
         return {
             'id': self.id,
             'antigram_id': self.antigram_id,
-            'matrix_data': json.loads(self.matrix_data),
+            'matrix_data': decode_matrix(self.matrix_data).to_dict(),
             'metadata': json.loads(self.matrix_metadata),
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
@@ -642,6 +1172,9 @@ class AntigramMatrixStorage(Base):
 class PatientReactionStorage(Base):
     """SQLAlchemy model for storing patient reactions as JSON."""
     __tablename__ = 'patient_reaction_storage'
+    __table_args__ = (
+        UniqueConstraint('antigram_id', 'cell_number', name='uq_patient_reaction_cell'),
+    )
     
     id = Column(Integer, primary_key=True)
     antigram_id = Column(Integer, nullable=False)
@@ -669,55 +1202,78 @@ class PandasTemplateManager:
     def __init__(self, db_session=None):
         self.templates = {}  # template_id: dict
         self.db_session = db_session
+        # Templates changed since the last flush to the database
+        self._dirty_templates: Set[int] = set()
+        self._deleted_templates: Set[int] = set()
+        # Bumped on every change to the set of templates
+        self.version = 0
+        # Serializes mutations and flushes, so no change lands between a flush's
+        # write and its reset of the change tracking sets
+        self._write_lock = threading.RLock()
 
     def add_template(self, template_id: int, name: str, antigen_order: list, cell_count: int, cell_range: list = None):
         """Add template to memory and database."""
-        self.templates[template_id] = {
-            "id": template_id,
-            "name": name,
-            "antigen_order": antigen_order,
-            "cell_count": cell_count,
-            "cell_range": cell_range
+        with self._write_lock:
+            self.templates[template_id] = {
+                "id": template_id,
+                "name": name,
+                "antigen_order": antigen_order,
+                "cell_count": cell_count,
+                "cell_range": cell_range
+            }
+            self.version += 1
+            
+            # Persist on the next flush if session is available
+            if self.db_session:
+                self._dirty_templates.add(template_id)
+                self._deleted_templates.discard(template_id)
+
+    @staticmethod
+    def _template_from_storage(stored) -> Dict:
+        """Template dict for a stored AntigramTemplate row."""
+        # Parse cell_range from JSON string
+        cell_range_list = None
+        if stored.cell_range:
+            try:
+                cell_range_list = json.loads(stored.cell_range)
+            except (json.JSONDecodeError, TypeError):
+                cell_range_list = None
+        
+        return {
+            "id": stored.id,
+            "name": stored.name,
+            "antigen_order": stored.antigen_order.split(",") if stored.antigen_order else [],
+            "cell_count": stored.cell_count,
+            "cell_range": cell_range_list
         }
+
+    def apply_remote_changes(self, changes: List[Change]):
+        """
+        Reload templates another worker changed (see core.change_feed). Nothing is
+        marked for writing: the database already holds these changes.
         
-        # Persist to database if session is available
-        if self.db_session:
-            self._save_template_to_db(template_id, name, antigen_order, cell_count, cell_range)
+        Args:
+            changes: The worker's unseen template changes, in version order
+        """
+        from models import AntigramTemplate
+        
+        template_ids = {int(change.key) for change in changes}
+        if not template_ids:
+            return
+        stored_templates = self.db_session.query(AntigramTemplate).filter(AntigramTemplate.id.in_(template_ids)).all()
+        with self._write_lock:
+            for stored in stored_templates:
+                self.templates[stored.id] = self._template_from_storage(stored)
+            for template_id in template_ids - {stored.id for stored in stored_templates}:
+                self.templates.pop(template_id, None)
+            self.version += 1
 
-    def _save_template_to_db(self, template_id: int, name: str, antigen_order: list, cell_count: int, cell_range: list = None):
-        """Save template to database."""
-        try:
-            from models import AntigramTemplate
-            
-            # Check if template already exists
-            existing = self.db_session.query(AntigramTemplate).filter_by(id=template_id).first()
-            
-            # Convert cell_range to JSON string if provided
-            cell_range_json = json.dumps(cell_range) if cell_range else None
-            
-            if existing:
-                # Update existing record
-                existing.name = name
-                existing.antigen_order = ",".join(antigen_order)
-                existing.cell_count = cell_count
-                existing.cell_range = cell_range_json
-            else:
-                # Create new record
-                template = AntigramTemplate(
-                    id=template_id,
-                    name=name,
-                    antigen_order=",".join(antigen_order),
-                    cell_count=cell_count,
-                    cell_range=cell_range_json
-                )
-                self.db_session.add(template)
-            
-            # Don't commit immediately - let the caller handle batching
-            # self.db_session.commit()
-        except Exception as e:
-            self.db_session.rollback()
-            logger.error(f"Error saving template to database: {e}")
-            raise
+    def reload_from_database(self):
+        """Discard in-memory templates and load every stored template again."""
+        with self._write_lock:
+            self.templates.clear()
+            self.version += 1
+            self.load_from_database(self.db_session)
 
     def load_from_database(self, db_session):
         """Load all templates from database."""
@@ -728,22 +1284,10 @@ class PandasTemplateManager:
             # Load all stored templates
             stored_templates = db_session.query(AntigramTemplate).all()
             
-            for stored in stored_templates:
-                # Parse cell_range from JSON string
-                cell_range_list = None
-                if stored.cell_range:
-                    try:
-                        cell_range_list = json.loads(stored.cell_range)
-                    except (json.JSONDecodeError, TypeError):
-                        cell_range_list = None
-                
-                self.templates[stored.id] = {
-                    "id": stored.id,
-                    "name": stored.name,
-                    "antigen_order": stored.antigen_order.split(",") if stored.antigen_order else [],
-                    "cell_count": stored.cell_count,
-                    "cell_range": cell_range_list
-                }
+            with self._write_lock:
+                for stored in stored_templates:
+                    self.templates[stored.id] = self._template_from_storage(stored)
+                self.version += 1
             
             logger.info(f"Loaded {len(stored_templates)} templates from database")
             
@@ -757,60 +1301,105 @@ class PandasTemplateManager:
             return
         
         try:
-            for template_id, template_data in self.templates.items():
-                self._save_template_to_db(
-                    template_id,
-                    template_data["name"],
-                    template_data["antigen_order"],
-                    template_data["cell_count"],
-                    template_data.get("cell_range")
-                )
-            
-            # Batch commit all changes
-            self.db_session.commit()
+            # Write every template along with any pending deletes, then batch commit
+            with self._write_lock:
+                self._dirty_templates.update(self.templates.keys())
+                self.commit_changes()
             logger.info(f"Saved {len(self.templates)} templates to database")
         except Exception as e:
-            self.db_session.rollback()
             logger.error(f"Error saving templates to database: {e}")
     
+    @property
+    def has_pending_changes(self) -> bool:
+        """Whether any template changed since the last flush."""
+        return bool(self._dirty_templates or self._deleted_templates)
+    
+    def _write_template_changes(self) -> int:
+        """Stage deletes and upserts for changed templates in the session."""
+        from models import AntigramTemplate
+        
+        if self._deleted_templates:
+            bulk_delete(self.db_session, AntigramTemplate, ['id'],
+                        [(template_id,) for template_id in self._deleted_templates])
+            record_changes(self.db_session, ENTITY_TEMPLATE, OP_DELETE, sorted(self._deleted_templates))
+        
+        rows = []
+        for template_id in sorted(self._dirty_templates):
+            template_data = self.templates.get(template_id)
+            if template_data is not None:
+                cell_range = template_data.get("cell_range")
+                rows.append({
+                    'id': template_id,
+                    'name': template_data["name"],
+                    'antigen_order': ",".join(template_data["antigen_order"]),
+                    'cell_count': template_data["cell_count"],
+                    # Store cell_range as a JSON string if provided
+                    'cell_range': json.dumps(cell_range) if cell_range else None,
+                })
+        written = bulk_upsert(self.db_session, AntigramTemplate, rows, key_columns=['id'])
+        # Published to other workers in the same transaction as the rows themselves
+        record_changes(self.db_session, ENTITY_TEMPLATE, OP_UPSERT, [row['id'] for row in rows])
+        return written
+    
+    def flush_changes(self) -> bool:
+        """
+        Persist only the templates added, updated or deleted since the last flush.
+        Does nothing (and touches no database connection) when nothing changed.
+        
+        Returns:
+            bool: True if changes were written
+        """
+        if not self.db_session or not self.has_pending_changes:
+            return False
+        try:
+            self.commit_changes()
+            return True
+        except Exception:
+            return False
+    
     def commit_changes(self):
-        """Commit pending database changes."""
+        """Write changed templates and commit pending database changes."""
         if self.db_session:
-            try:
-                self.db_session.commit()
-            except Exception as e:
-                self.db_session.rollback()
-                logger.error(f"Error committing changes: {e}")
-                raise
-
-    def delete_template(self, template_id: int):
-        """Delete template from memory and database."""
-        if template_id in self.templates:
-            del self.templates[template_id]
-            
-            # Delete from database if session is available
-            if self.db_session:
+            # Writers wait, so the change tracking sets are not changed mid-flush
+            with self._write_lock:
                 try:
-                    from models import AntigramTemplate
-                    stored = self.db_session.query(AntigramTemplate).filter_by(id=template_id).first()
-                    if stored:
-                        self.db_session.delete(stored)
-                        self.db_session.commit()
+                    written = self._write_template_changes()
+                    self.db_session.commit()
+                    if self.has_pending_changes:
+                        logger.debug(f"Flushed {written} changed templates to database")
+                    self._dirty_templates.clear()
+                    self._deleted_templates.clear()
                 except Exception as e:
                     self.db_session.rollback()
-                    logger.error(f"Error deleting template from database: {e}")
+                    logger.error(f"Error committing changes: {e}")
+                    raise
+
+    def delete_template(self, template_id: int):
+        """Delete template from memory (and from the database on the next flush)."""
+        with self._write_lock:
+            if template_id in self.templates:
+                del self.templates[template_id]
+                self.version += 1
+                
+                # Delete from database on the next flush
+                if self.db_session:
+                    self._dirty_templates.discard(template_id)
+                    self._deleted_templates.add(template_id)
 
     def get_template(self, template_id: int):
         return self.templates.get(template_id)
 
     def get_all_templates(self):
-        return list(self.templates.values())
+        with self._write_lock:
+            return list(self.templates.values())
 
     def to_json(self):
         return self.templates
 
     def from_json(self, data):
-        self.templates = data
+        with self._write_lock:
+            self.templates = data
+            self.version += 1
 
     def save_to_json(self, filepath):
         import json
@@ -822,6 +1411,7 @@ class PandasTemplateManager:
         if os.path.exists(filepath):
             with open(filepath, 'r') as f:
                 self.templates = json.load(f)
+            self.version += 1
     
     def validate_cell_range(self, cell_count: int, cell_range: list = None) -> bool:
         """
@@ -0,0 +1,189 @@
+import numpy as np
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+import logging
+
+from core.id_registry import IdRegistry
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Code of a cell without a reaction; reaction values get codes 1, 2, ... as first seen
+NO_REACTION = 0
+
+# Cells reserved per antigram before its first reaction when its cell order is unknown
+_INITIAL_CELLS = 16
+
+
+class _AntigramReactions:
+    """Reaction codes of one antigram's cells, one int8 per cell position."""
+
+    __slots__ = ('positions', 'cell_numbers', 'codes', 'count')
+
+    def __init__(self, cell_numbers: Sequence[str]):
+        self.cell_numbers: List[str] = list(cell_numbers)
+        self.positions: Dict[str, int] = {cell_number: position for position, cell_number in enumerate(self.cell_numbers)}
+        self.codes = np.zeros(max(len(self.cell_numbers), _INITIAL_CELLS), dtype=np.int8)
+        self.count = 0
+
+    def position(self, cell_number: str) -> int:
+        """Position of a cell, appending it (and growing the codes) if it is new."""
+        position = self.positions.get(cell_number)
+        if position is None:
+            position = len(self.cell_numbers)
+            self.positions[cell_number] = position
+            self.cell_numbers.append(cell_number)
+            if position >= len(self.codes):
+                grown = np.zeros(len(self.codes) * 2, dtype=np.int8)
+                grown[:len(self.codes)] = self.codes
+                self.codes = grown
+        return position
+
+
+class ReactionStore:
+    """
+    Patient reactions held as a dense int8 code vector per antigram.
+
+    Each antigram's vector is aligned with its cell order (from the cell_order
+    callback, when the antigram's cells are known as the vector is created); cells
+    outside that order are appended as they are first seen. Setting, reading and
+    deleting a reaction is a dict lookup plus an array write, and an antigram's
+    reactions are available as a read-only view of its vector without copying.
+
+    Args:
+        cell_order: Returns an antigram's cell numbers in matrix order, or None if unknown
+    """
+
+    def __init__(self, cell_order: Optional[Callable[[int], Optional[Sequence[str]]]] = None):
+        self.cell_order = cell_order
+        self._reactions = IdRegistry()
+        self._reactions.intern(None)  # NO_REACTION
+        self._antigrams: Dict[int, _AntigramReactions] = {}
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _antigram(self, antigram_id: int) -> _AntigramReactions:
+        """The antigram's vector, creating it in the antigram's cell order if it is new."""
+        antigram = self._antigrams.get(antigram_id)
+        if antigram is None:
+            cell_numbers = self.cell_order(antigram_id) if self.cell_order is not None else None
+            antigram = _AntigramReactions([str(cell_number) for cell_number in cell_numbers or ()])
+            self._antigrams[antigram_id] = antigram
+        return antigram
+
+    def code_of(self, reaction: str) -> int:
+        """Code of a reaction value, assigning the next code if it is new."""
+        code = self._reactions.intern(reaction)
+        if code > np.iinfo(np.int8).max:
+            raise ValueError(f"Too many distinct patient reaction values to store '{reaction}'")
+        return code
+
+    def reaction_of(self, code: int) -> Optional[str]:
+        """Reaction value of a code (None for NO_REACTION)."""
+        return self._reactions.key_of(code)
+
+    # ---------- Mutation ----------
+
+    def set(self, antigram_id: int, cell_number: str, reaction: str) -> Optional[str]:
+        """
+        Set a cell's reaction.
+
+        Returns:
+            The cell's previous reaction, or None
+        """
+        code = self.code_of(reaction)
+        antigram = self._antigram(antigram_id)
+        position = antigram.position(cell_number)
+        previous = int(antigram.codes[position])
+        antigram.codes[position] = code
+        if previous == NO_REACTION:
+            antigram.count += 1
+            self._count += 1
+        return self._reactions.key_of(previous)
+
+    def delete(self, antigram_id: int, cell_number: str) -> bool:
+        """Remove a cell's reaction; returns whether it had one."""
+        antigram = self._antigrams.get(antigram_id)
+        position = antigram.positions.get(cell_number) if antigram is not None else None
+        if position is None or antigram.codes[position] == NO_REACTION:
+            return False
+        antigram.codes[position] = NO_REACTION
+        antigram.count -= 1
+        self._count -= 1
+        return True
+
+    def clear(self):
+        """Remove every reaction."""
+        self._antigrams.clear()
+        self._count = 0
+
+    def load(self, rows: Iterable[Tuple[int, str, str]]):
+        """
+        Replace every reaction with the given rows in bulk.
+
+        Args:
+            rows: (antigram_id, cell_number, reaction) triples, e.g. PatientReactionStorage
+                columns; later rows for the same cell win
+        """
+        self.clear()
+        grouped: Dict[int, Dict[str, str]] = {}
+        for antigram_id, cell_number, reaction in rows:
+            grouped.setdefault(antigram_id, {})[str(cell_number)] = reaction
+
+        for antigram_id, reactions in grouped.items():
+            antigram = self._antigram(antigram_id)
+            positions = np.fromiter((antigram.position(cell_number) for cell_number in reactions),
+                                    dtype=np.int64, count=len(reactions))
+            antigram.codes[positions] = np.fromiter((self.code_of(reaction) for reaction in reactions.values()),
+                                                    dtype=np.int8, count=len(reactions))
+            antigram.count = len(reactions)
+            self._count += len(reactions)
+
+    # ---------- Queries ----------
+
+    def get(self, antigram_id: int, cell_number: str) -> Optional[str]:
+        """A cell's reaction, or None."""
+        antigram = self._antigrams.get(antigram_id)
+        position = antigram.positions.get(cell_number) if antigram is not None else None
+        if position is None:
+            return None
+        return self._reactions.key_of(int(antigram.codes[position]))
+
+    def codes(self, antigram_id: int) -> Tuple[List[str], np.ndarray]:
+        """
+        An antigram's cell numbers and their reaction codes (NO_REACTION where there is none).
+
+        Returns:
+            Tuple of (cell numbers, read-only int8 view of the codes); the view reflects
+            later changes until the antigram gains a cell beyond its vector's capacity
+        """
+        antigram = self._antigrams.get(antigram_id)
+        if antigram is None:
+            return [], np.zeros(0, dtype=np.int8)
+        view = antigram.codes[:len(antigram.cell_numbers)]
+        view.flags.writeable = False
+        return antigram.cell_numbers, view
+
+    def reactions_for_antigram(self, antigram_id: int) -> Dict[str, str]:
+        """{cell_number: reaction} of an antigram's cells with a reaction, in cell order."""
+        antigram = self._antigrams.get(antigram_id)
+        if antigram is None or not antigram.count:
+            return {}
+        codes = antigram.codes
+        key_of = self._reactions.key_of
+        return {
+            antigram.cell_numbers[position]: key_of(code)
+            for position, code in zip(np.flatnonzero(codes).tolist(), codes[codes != NO_REACTION].tolist())
+        }
+
+    def items(self) -> Iterator[Tuple[Tuple[int, str], str]]:
+        """((antigram_id, cell_number), reaction) of every reaction, by antigram then cell order."""
+        for antigram_id in list(self._antigrams):
+            for cell_number, reaction in self.reactions_for_antigram(antigram_id).items():
+                yield (antigram_id, cell_number), reaction
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the code vectors and cell lookups."""
+        return sum(antigram.codes.nbytes + 96 * len(antigram.cell_numbers) for antigram in self._antigrams.values())
@@ -0,0 +1,163 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+from core.metrics import registry
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+LOG_RECORDS_DROPPED = registry.counter(
+    'bbapp_log_records_dropped_total', 'Log records dropped because the log queue was full.'
+)
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_listener: Optional[QueueListener] = None
+
+
+def _record_fields(record: logging.LogRecord) -> Dict:
+    """Structured fields attached to a record with ``extra={'fields': {...}}``."""
+    fields = getattr(record, 'fields', None)
+    if not fields:
+        return {}
+    rendered = {}
+    for key, value in fields.items():
+        if isinstance(value, (bytes, bytearray)):
+            # Request bodies are captured as raw bytes and decoded here, on the writer thread
+            value = bytes(value).decode('utf-8', errors='replace')
+        rendered[key] = value
+    return rendered
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: timestamp, level, logger, message and any structured fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(_record_fields(record))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Plain text (the previous LEVEL:logger:message layout) with structured fields as key=value."""
+
+    def __init__(self):
+        super().__init__('%(levelname)s:%(name)s:%(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = _record_fields(record)
+        if fields:
+            text += ' ' + ' '.join(f'{key}={value!r}' for key, value in fields.items())
+        return text
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to the background writer without formatting them or blocking.
+
+    Records are formatted by the writer thread, so arguments passed to a log call
+    must not be mutated afterwards. When the queue is full the record is dropped
+    and counted rather than stalling the request thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def configure_logging(level: Optional[str] = None, log_format: Optional[str] = None,
+                      queue_size: Optional[int] = None):
+    """
+    Route every log record through a bounded queue to a background writer thread.
+
+    Args:
+        level: Root log level (default: LOG_LEVEL environment variable, or INFO)
+        log_format: 'json' for structured records or 'text' (default: LOG_FORMAT, or json)
+        queue_size: Records buffered before new ones are dropped (default: LOG_QUEUE_SIZE, or 10000)
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    level = (level or os.getenv('LOG_LEVEL', 'INFO')).upper()
+    log_format = (log_format or os.getenv('LOG_FORMAT', 'json')).lower()
+    queue_size = queue_size if queue_size is not None else int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JsonFormatter() if log_format == 'json' else KeyValueFormatter())
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(NonBlockingQueueHandler(log_queue))
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    # Drain queued records on interpreter exit
+    atexit.register(_listener.stop)
+
+
+class RequestBodySampler:
+    """
+    Decides which request bodies are logged and how much of each.
+
+    Args:
+        sample_rate: Fraction of requests whose body is logged (0 disables body logging)
+        max_bytes: Bodies are truncated to this many bytes
+    """
+
+    def __init__(self, sample_rate: float = 0.01, max_bytes: int = 1024):
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_env(cls) -> 'RequestBodySampler':
+        """Configure from LOG_BODY_SAMPLE_RATE and LOG_BODY_MAX_BYTES."""
+        return cls(
+            sample_rate=float(os.getenv('LOG_BODY_SAMPLE_RATE', '0.01')),
+            max_bytes=int(os.getenv('LOG_BODY_MAX_BYTES', '1024'))
+        )
+
+    def body_fields(self, request) -> Dict:
+        """
+        Log fields for a sampled request body, or an empty dict.
+
+        JSON bodies are captured as raw (cached) bytes so nothing is parsed or
+        formatted on the request thread; form bodies as their parsed fields.
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return {}
+        if request.is_json:
+            data = request.get_data(cache=True)
+            return {
+                'body': data[:self.max_bytes],
+                'body_bytes': len(data),
+                'body_truncated': len(data) > self.max_bytes,
+            }
+        if request.form:
+            return {'form': {key: value[:self.max_bytes] for key, value in request.form.items()}}
+        return {}
@@ -0,0 +1,115 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, NamedTuple, Optional
+import logging
+
+from flask import Response, current_app, request
+
+from core.serialization import MSGPACK_MIMETYPE, packb, wants_msgpack
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class CachedResponse(NamedTuple):
+    """A serialized body and its entity tag, valid for one data version."""
+    version: Hashable
+    etag: str
+    body: bytes
+    mimetype: str
+
+
+class ResponseCache:
+    """
+    Serialized bodies of read-mostly JSON endpoints, with conditional GET support.
+
+    Each entry is keyed by the endpoint (and its arguments) and tagged with the
+    version of the data it was built from, e.g. a manager's version counter. While
+    the version is unchanged the stored body is sent as is, and a request whose
+    If-None-Match names its ETag gets a bodiless 304 without anything being built.
+
+    The ETag is a hash of the body rather than the version itself: version counters
+    are local to a worker, whereas equal bodies get equal tags on every worker, so a
+    client's cached copy stays valid whichever worker answers.
+
+    Args:
+        max_entries: Least recently used entries beyond this are dropped
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Hashable, CachedResponse]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def _entry(self, key: Hashable, version: Hashable, build: Callable[[], Any],
+               msgpack: bool) -> Optional[CachedResponse]:
+        """Stored entry for the current version, building and storing it if needed."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # Built outside the lock; the version was read first, so a change made while
+        # building leaves a stale entry that the next request's version no longer matches
+        payload = build()
+        if payload is None:
+            return None
+        if msgpack:
+            body, mimetype = packb(payload), MSGPACK_MIMETYPE
+        else:
+            body, mimetype = current_app.json.response(payload).get_data(), current_app.json.mimetype
+        entry = CachedResponse(version, hashlib.blake2b(body, digest_size=16).hexdigest(), body, mimetype)
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def respond(self, key: Hashable, version: Hashable, build: Callable[[], Any],
+                negotiate: bool = False) -> Optional[Response]:
+        """
+        JSON response for the current request, or 304 Not Modified if the client has it.
+
+        Args:
+            key: Identifies the endpoint and any arguments that change its payload
+            version: Version of every piece of data the payload is built from
+            build: Returns the JSON-serializable payload, or None if it does not exist
+            negotiate: Send MessagePack instead of JSON to clients that ask for it
+
+        Returns:
+            Response: 200 with the body or 304, both carrying the ETag; None if build returned None
+        """
+        msgpack = negotiate and wants_msgpack()
+        entry = self._entry((key, 'msgpack') if msgpack else key, version, build, msgpack)
+        if entry is None:
+            return None
+
+        if request.if_none_match.contains_weak(entry.etag):
+            self.not_modified += 1
+            response = Response(status=304)
+        else:
+            response = Response(entry.body, mimetype=entry.mimetype)
+        if negotiate:
+            response.vary.add('Accept')
+        response.set_etag(entry.etag)
+        # Clients may keep the body but must revalidate it before each use
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def stats(self) -> Dict:
+        """Entry count and hit, miss and 304 counters."""
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'not_modified': self.not_modified,
+        }
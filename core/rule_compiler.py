@@ -0,0 +1,267 @@
+import numpy as np
+from typing import Any, Callable, Dict, Hashable, List, Mapping, Optional, Tuple
+import json
+import logging
+import threading
+
+from core.antigen_index import AntigenExpressionIndex, Condition, popcount_rows
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class CompiledRule:
+    """A single enabled antibody rule lowered to condition mask references."""
+
+    __slots__ = ('target_antigen', 'rule_type', 'required_count', 'terms', 'antibody', 'fixed_details')
+
+    def __init__(self, target_antigen: str, rule_type: str, required_count: int,
+                 terms: List[Tuple[int, Dict]] = None, antibody: str = None,
+                 fixed_details: List[Dict] = None):
+        self.target_antigen = target_antigen
+        self.rule_type = rule_type
+        self.required_count = required_count
+        self.terms = terms or []                # (condition index, detail fields) pairs
+        self.antibody = antibody                # Gate for ABSpecificRO rules
+        self.fixed_details = fixed_details      # Set for rules satisfied without cells (LowF)
+
+
+class CompiledRulePlan:
+    """
+    Vectorized evaluation plan for a set of enabled antibody rules.
+
+    Every rule is reduced to one or more conditions such as A=+,B=0 (Homo),
+    A=+,B=+ (Hetero, ABSpecificRO) or A=+ (SingleAG). Identical conditions are
+    shared between rules. Condition masks depend only on the inventory, so the
+    antigen expression index materializes them when antigrams are indexed; a whole
+    rule set is evaluated by intersecting the stacked masks with the patient's
+    negative cells in a single pass instead of rules x antigrams loops.
+    """
+
+    def __init__(self, rules: List[Dict]):
+        self.rules: List[CompiledRule] = []
+        self.conditions: List[Condition] = []
+        self._condition_lookup: Dict[Condition, int] = {}
+        # antigen -> indexes of compiled rules that touch it (target or condition antigen)
+        self.antigen_groups: Dict[str, List[int]] = {}
+
+        for rule in rules:
+            if not rule.get('enabled', True):
+                continue
+            compiled = self._compile_rule(rule)
+            if compiled is not None:
+                self._add_rule(compiled)
+
+
+    # ---------- Compilation ----------
+
+    def _compile_rule(self, rule: Dict) -> Optional[CompiledRule]:
+        """Lower one rule dict to a CompiledRule, or None if it can never be satisfied."""
+        rule_type = rule['rule_type']
+        target_antigen = rule['target_antigen']
+        rule_data = rule['rule_data']
+
+        if rule_type == 'abspecific':
+            # ABSpecificRO(A,B,C,X): rule out B when patient is 0 for cells with B=+, C=+,
+            # at least X times, only while antibody A is suspected
+            antigen1 = rule_data.get('antigen1')
+            antigen2 = rule_data.get('antigen2')
+            condition = self._condition_index(((antigen1, '+'), (antigen2, '+')))
+            return CompiledRule(target_antigen, rule_type, rule_data.get('required_count', 1),
+                                terms=[(condition, {'rule_type': 'abspecific', 'antigen1': antigen1, 'antigen2': antigen2})],
+                                antibody=rule_data.get('antibody'))
+
+        elif rule_type == 'homo':
+            # Homo[(A,B),]: rule out A when patient is 0 for cells with A=+, B=0
+            terms = []
+            for antigen_a, antigen_b in rule_data.get('antigen_pairs', []):
+                if antigen_a == target_antigen:
+                    condition = self._condition_index(((antigen_a, '+'), (antigen_b, '0')))
+                    terms.append((condition, {'rule_type': 'homozygous', 'antigen_a': antigen_a, 'antigen_b': antigen_b}))
+            return CompiledRule(target_antigen, rule_type, 1, terms=terms)
+
+        elif rule_type == 'hetero':
+            # Hetero(A,B,X): rule out A when patient is 0 for cells with A=+, B=+, at least X times
+            antigen_a = rule_data.get('antigen_a')
+            antigen_b = rule_data.get('antigen_b')
+            if antigen_a != target_antigen:
+                return None
+            condition = self._condition_index(((antigen_a, '+'), (antigen_b, '+')))
+            return CompiledRule(target_antigen, rule_type, rule_data.get('required_count', 3),
+                                terms=[(condition, {'rule_type': 'heterozygous', 'antigen_a': antigen_a, 'antigen_b': antigen_b})])
+
+        elif rule_type == 'single':
+            # SingleAG([A,B,C,...]): rule out when patient is 0 and the cell is +
+            if target_antigen not in rule_data.get('antigens', []):
+                return None
+            condition = self._condition_index(((target_antigen, '+'),))
+            return CompiledRule(target_antigen, rule_type, 1,
+                                terms=[(condition, {'rule_type': 'single', 'antigen': target_antigen})])
+
+        elif rule_type == 'lowf':
+            # LowF([A,B,C,...]): automatically ruled out due to low prevalence
+            if target_antigen not in rule_data.get('antigens', []):
+                return None
+            return CompiledRule(target_antigen, rule_type, 0,
+                                fixed_details=[{'rule_type': 'lowf', 'antigen': target_antigen, 'reason': 'low_prevalence'}])
+
+        return None
+
+    def _condition_index(self, condition: Condition) -> int:
+        """Get the shared index of a condition, registering it if new."""
+        if condition not in self._condition_lookup:
+            self._condition_lookup[condition] = len(self.conditions)
+            self.conditions.append(condition)
+        return self._condition_lookup[condition]
+
+    def _add_rule(self, compiled: CompiledRule):
+        """Register a compiled rule and group it by the antigens it touches."""
+        rule_index = len(self.rules)
+        self.rules.append(compiled)
+        touched = {compiled.target_antigen}
+        for condition, _ in compiled.terms:
+            touched.update(antigen for antigen, _ in self.conditions[condition])
+        for antigen in touched:
+            self.antigen_groups.setdefault(antigen, []).append(rule_index)
+
+    # ---------- Evaluation ----------
+
+    def condition_masks(self, index: AntigenExpressionIndex) -> np.ndarray:
+        """
+        Get the candidate cell mask of every condition as one stacked array, as
+        materialized by the index (computed there on first use, then kept current
+        as antigrams are indexed).
+
+        Returns:
+            np.ndarray: Array of shape (conditions, bitmap bytes)
+        """
+        if not self.conditions:
+            return np.zeros((0, len(index.empty())), dtype=np.uint8)
+        return index.condition_bitmaps(self.conditions)
+
+    def evaluate(self, index: AntigenExpressionIndex, negative_cells: np.ndarray,
+                 suspected_antibodies: List[str] = None,
+                 collect_cells: Callable[[np.ndarray, Dict], List[Dict]] = None) -> Dict[str, Any]:
+        """
+        Evaluate every compiled rule against the patient's negative cells.
+
+        Args:
+            index: Antigen expression index for the inventory
+            negative_cells: Bitmap of cells with a negative patient reaction
+            suspected_antibodies: Suspected antibodies gating ABSpecificRO rules
+            collect_cells: Callback expanding a ruling out bitmap into detail records
+
+        Returns:
+            Dict with ruled_out antigens and their ruling out details
+        """
+        suspected = set(suspected_antibodies or [])
+        hits = self.condition_masks(index) & negative_cells
+        hit_counts = popcount_rows(hits)
+
+        ruled_out_antigens = set()
+        ruling_out_details = {}
+
+        for rule in self.rules:
+            # ABSpecificRO rules only apply while their antibody is suspected
+            if rule.rule_type == 'abspecific' and rule.antibody not in suspected:
+                continue
+
+            if rule.fixed_details is not None:
+                ruling_out_cells = list(rule.fixed_details)
+            else:
+                if int(sum(hit_counts[condition] for condition, _ in rule.terms)) < rule.required_count:
+                    continue
+                ruling_out_cells = []
+                if collect_cells is not None:
+                    for condition, details in rule.terms:
+                        ruling_out_cells.extend(collect_cells(hits[condition], details))
+
+            ruled_out_antigens.add(rule.target_antigen)
+            ruling_out_details.setdefault(rule.target_antigen, []).extend(ruling_out_cells)
+
+        return {
+            'ruled_out_antigens': list(ruled_out_antigens),
+            'ruling_out_details': ruling_out_details
+        }
+
+    def evaluate_single(self, rule_index: int, index: AntigenExpressionIndex, negative_cells: np.ndarray,
+                        suspected_antibody: str = None,
+                        collect_cells: Callable[[np.ndarray, Dict], List[Dict]] = None) -> Tuple[bool, List[Dict]]:
+        """
+        Evaluate one compiled rule, returning its ruling out cells even when the
+        required count is not reached.
+
+        Returns:
+            Tuple of (is_satisfied, ruling_out_cells)
+        """
+        rule = self.rules[rule_index]
+        if rule.rule_type == 'abspecific' and (not suspected_antibody or rule.antibody != suspected_antibody):
+            return False, []
+        if rule.fixed_details is not None:
+            return True, list(rule.fixed_details)
+
+        hits = self.condition_masks(index) & negative_cells
+        hit_counts = popcount_rows(hits)
+        ruling_out_cells = []
+        if collect_cells is not None:
+            for condition, details in rule.terms:
+                ruling_out_cells.extend(collect_cells(hits[condition], details))
+        is_satisfied = int(sum(hit_counts[condition] for condition, _ in rule.terms)) >= rule.required_count
+        return is_satisfied, ruling_out_cells
+
+
+# ---------- Plan cache ----------
+
+_PLAN_CACHE_SIZE = 8
+_plan_cache: Dict[Hashable, CompiledRulePlan] = {}
+_plan_cache_lock = threading.Lock()
+_plan_cache_hits = 0
+_plan_cache_misses = 0
+
+
+def _fingerprint_default(value):
+    # Read-only rules from core.rule_repository are mappings rather than dicts
+    if isinstance(value, Mapping):
+        return dict(value)
+    return str(value)
+
+
+def rule_set_version(rules: List[Dict]) -> str:
+    """Fingerprint a rule set so identical rule sets share a compiled plan."""
+    return json.dumps(rules, sort_keys=True, default=_fingerprint_default)
+
+
+def get_compiled_plan(rules: List[Dict], version: Hashable = None) -> CompiledRulePlan:
+    """
+    Get the compiled plan for a rule set, compiling it on first use.
+
+    Args:
+        rules: List of antibody rule dictionaries
+        version: Rule-set version key. If None, a fingerprint of the rules is used.
+
+    Returns:
+        CompiledRulePlan: Cached plan for the rule set
+    """
+    global _plan_cache_hits, _plan_cache_misses
+    key = version if version is not None else rule_set_version(rules)
+    with _plan_cache_lock:
+        plan = _plan_cache.get(key)
+        if plan is not None:
+            _plan_cache_hits += 1
+            return plan
+        _plan_cache_misses += 1
+
+    plan = CompiledRulePlan(rules)
+    logger.debug(f"Compiled {len(plan.rules)} antibody rules into {len(plan.conditions)} condition masks")
+
+    with _plan_cache_lock:
+        if len(_plan_cache) >= _PLAN_CACHE_SIZE:
+            _plan_cache.pop(next(iter(_plan_cache)))
+        _plan_cache[key] = plan
+    return plan
+
+
+def plan_cache_stats() -> Dict:
+    """Compiled plan cache size and hit/miss counters."""
+    with _plan_cache_lock:
+        return {'plans': len(_plan_cache), 'hits': _plan_cache_hits, 'misses': _plan_cache_misses}
@@ -0,0 +1,163 @@
+import itertools
+import json
+import threading
+from types import MappingProxyType
+from typing import Any, Dict, FrozenSet, List, Mapping, Optional, Tuple
+import logging
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Distinguishes the plan cache keys of separate repositories in one process
+_repository_ids = itertools.count(1)
+
+
+def _freeze(value: Any) -> Any:
+    """Recursively convert dicts to read-only mappings and lists to tuples."""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def rule_to_dict(rule: Mapping) -> Dict:
+    """
+    Mutable, JSON-serializable copy of a repository rule (same shape as AntibodyRule.to_dict()).
+
+    Args:
+        rule: Read-only rule from the repository
+
+    Returns:
+        Dict: Rule dictionary
+    """
+    def thaw(value):
+        if isinstance(value, Mapping):
+            return {key: thaw(item) for key, item in value.items()}
+        if isinstance(value, tuple):
+            return [thaw(item) for item in value]
+        return value
+    return thaw(rule)
+
+
+class RuleSnapshot:
+    """Parsed antibody rules as of one repository version. Never modified after creation."""
+
+    def __init__(self, version: int, cache_key: Tuple, rules: Tuple[Mapping, ...]):
+        self.version = version
+        # Key for the compiled plan cache (see core.rule_compiler.get_compiled_plan)
+        self.cache_key = cache_key
+        self.rules = rules
+        self.enabled_rules = tuple(rule for rule in rules if rule['enabled'])
+        self.rules_by_id: Mapping[int, Mapping] = MappingProxyType({rule['id']: rule for rule in rules})
+        self.antigens_with_enabled_rules: FrozenSet[str] = frozenset(
+            rule['target_antigen'] for rule in self.enabled_rules
+        )
+
+
+class AntibodyRuleRepository:
+    """
+    In-process cache of the antibody rules table.
+
+    Rules are loaded and their rule_data JSON parsed once per version into read-only
+    mappings (use rule_to_dict() for a mutable copy). Every code path that writes the
+    antibody_rules table must call invalidate() after committing; the next read then
+    reloads the table. Readers between writes never touch the database or JSON parser.
+    """
+
+    def __init__(self, db_session):
+        self.db_session = db_session
+        self._repository_id = next(_repository_ids)
+        self._version = 0
+        self._snapshot: Optional[RuleSnapshot] = None
+        self._lock = threading.Lock()
+        # Reads served from the cached snapshot, and reloads of the rules table
+        self.hits = 0
+        self.loads = 0
+
+    @property
+    def version(self) -> int:
+        """Bumped on every invalidation."""
+        return self._version
+
+    def invalidate(self):
+        """Record that the rules table changed so the next read reloads it."""
+        with self._lock:
+            self._version += 1
+            self._snapshot = None
+        logger.debug(f"Antibody rule repository invalidated (version {self._version})")
+
+    def snapshot(self) -> RuleSnapshot:
+        """
+        Get the rules for the current version, loading them if the table changed.
+
+        Returns:
+            RuleSnapshot: Parsed, read-only rules
+        """
+        snapshot = self._snapshot
+        if snapshot is not None:
+            self.hits += 1
+            return snapshot
+
+        with self._lock:
+            if self._snapshot is not None:
+                self.hits += 1
+                return self._snapshot
+            version = self._version
+            snapshot = RuleSnapshot(version, ('antibody_rules', self._repository_id, version), self._load_rules())
+            self._snapshot = snapshot
+            self.loads += 1
+        logger.info(f"Loaded {len(snapshot.rules)} antibody rules (version {version})")
+        return snapshot
+
+    def stats(self) -> Dict:
+        """Version, loaded rule counts and cache hit/reload counters (never loads the table)."""
+        snapshot = self._snapshot
+        return {
+            'version': self._version,
+            'rules': len(snapshot.rules) if snapshot is not None else None,
+            'enabled_rules': len(snapshot.enabled_rules) if snapshot is not None else None,
+            'hits': self.hits,
+            'loads': self.loads,
+        }
+
+    def _load_rules(self) -> Tuple[Mapping, ...]:
+        """Read and parse every rule from the database."""
+        from models import AntibodyRule
+
+        rows = self.db_session.query(
+            AntibodyRule.id, AntibodyRule.rule_type, AntibodyRule.target_antigen,
+            AntibodyRule.rule_data, AntibodyRule.description, AntibodyRule.enabled
+        ).order_by(AntibodyRule.id).all()
+        return tuple(
+            _freeze({
+                "id": rule_id,
+                "rule_type": rule_type,
+                "target_antigen": target_antigen,
+                "rule_data": json.loads(rule_data),
+                "description": description,
+                "enabled": enabled
+            })
+            for rule_id, rule_type, target_antigen, rule_data, description, enabled in rows
+        )
+
+    def all_rules(self) -> Tuple[Mapping, ...]:
+        """Every rule, enabled or not, in ID order."""
+        return self.snapshot().rules
+
+    def enabled_rules(self) -> Tuple[Mapping, ...]:
+        """Enabled rules in ID order."""
+        return self.snapshot().enabled_rules
+
+    def get_rule(self, rule_id: int) -> Optional[Mapping]:
+        """A single rule by ID, or None."""
+        return self.snapshot().rules_by_id.get(rule_id)
+
+    def antigens_with_enabled_rules(self) -> FrozenSet[str]:
+        """Target antigens of every enabled rule."""
+        return self.snapshot().antigens_with_enabled_rules
+
+    def rules_as_dicts(self, enabled_only: bool = False) -> List[Dict]:
+        """Mutable copies of the rules, for JSON responses."""
+        rules = self.enabled_rules() if enabled_only else self.all_rules()
+        return [rule_to_dict(rule) for rule in rules]
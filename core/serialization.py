@@ -0,0 +1,147 @@
+import os
+from typing import Any, Iterable
+import logging
+
+from flask import Response, current_app, request
+from flask.json.provider import DefaultJSONProvider, _default
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+import numpy as np
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+# Older clients still ask for the unregistered name
+MSGPACK_MIMETYPES = (MSGPACK_MIMETYPE, 'application/x-msgpack')
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def _fallback_default(obj: Any) -> Any:
+    """Types neither serializer handles natively: numpy values, then Flask's defaults (dates, decimals...)."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return _default(obj)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider that serializes with orjson when it is installed.
+
+    Output matches DefaultJSONProvider (sorted keys, compact separators, dates as
+    HTTP dates), except that non-ASCII text is written as UTF-8 rather than \\u
+    escapes and NaN as null. Responses are built from orjson's bytes without an
+    intermediate str. Without orjson, or with JSON_SERIALIZER=stdlib, the standard
+    library serializer is used.
+
+    Args:
+        app: Flask application
+        backend: 'orjson' or 'stdlib' (default: JSON_SERIALIZER environment variable, or orjson)
+    """
+
+    def __init__(self, app, backend: str = None):
+        super().__init__(app)
+        backend = (backend or os.getenv('JSON_SERIALIZER', 'orjson')).lower()
+        self.use_orjson = backend == 'orjson' and orjson is not None
+        if backend == 'orjson' and orjson is None:
+            logger.info("orjson is not installed; serializing JSON with the standard library")
+
+    def _orjson_options(self) -> int:
+        options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def dumps_bytes(self, obj: Any) -> bytes:
+        """Serialize obj to UTF-8 JSON bytes."""
+        if self.use_orjson:
+            return orjson.dumps(obj, default=_fallback_default, option=self._orjson_options())
+        return super().dumps(obj).encode('utf-8')
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if not self.use_orjson or kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode('utf-8')
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        # Pretty-printed (debug) responses keep the standard formatting
+        if not self.use_orjson or self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj) + b"\n", mimetype=self.mimetype)
+
+
+def wants_msgpack() -> bool:
+    """Whether the current request prefers MessagePack over JSON (JSON wins ties, e.g. */*)."""
+    if msgpack is None:
+        return False
+    best = request.accept_mimetypes.best_match((JSON_MIMETYPE,) + MSGPACK_MIMETYPES)
+    return best in MSGPACK_MIMETYPES
+
+
+def packb(payload: Any) -> bytes:
+    """Serialize a JSON-compatible payload to MessagePack."""
+    return msgpack.packb(payload, default=_fallback_default, use_bin_type=True)
+
+
+def negotiated_response(payload: Any, status: int = 200) -> Response:
+    """
+    Response with the payload as MessagePack if the client asks for it (Accept:
+    application/msgpack) and msgpack is installed, otherwise as JSON.
+
+    Args:
+        payload: JSON-serializable response body
+        status: HTTP status code
+
+    Returns:
+        Response: Serialized payload, marked as varying by Accept
+    """
+    if wants_msgpack():
+        response = Response(packb(payload), status=status, mimetype=MSGPACK_MIMETYPE)
+    else:
+        response = current_app.json.response(payload)
+        response.status_code = status
+    response.vary.add('Accept')
+    return response
+
+
+def wants_ndjson() -> bool:
+    """Whether the current request prefers newline-delimited JSON over JSON (JSON wins ties, e.g. */*)."""
+    return request.accept_mimetypes.best_match((JSON_MIMETYPE, NDJSON_MIMETYPE)) == NDJSON_MIMETYPE
+
+
+def ndjson_response(records: Iterable[Any], status: int = 200) -> Response:
+    """
+    Streamed response with one JSON document per line, serialized as the records
+    are produced, so the client gets the first ones before the last are built.
+    Streamed responses are not compressed.
+
+    Args:
+        records: JSON-serializable records; iterated while the response is sent
+        status: HTTP status code
+
+    Returns:
+        Response: Streaming NDJSON response, marked as varying by Accept
+    """
+    json_provider = current_app.json
+    dumps = getattr(json_provider, 'dumps_bytes', None) or (lambda obj: json_provider.dumps(obj).encode('utf-8'))
+
+    def generate():
+        for record in records:
+            yield dumps(record) + b"\n"
+
+    response = Response(generate(), status=status, mimetype=NDJSON_MIMETYPE)
+    response.vary.add('Accept')
+    return response
@@ -0,0 +1,235 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import logging
+
+from core.pandas_models import PandasAntigramManager, PandasPatientReactionManager
+from core.incremental_abid import IncrementalABIDTracker
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKUP_ID = 'default'
+
+_WORKUP_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.:-]{1,64}$')
+
+
+def normalize_workup_id(workup_id) -> str:
+    """
+    Validate a workup ID supplied by a client.
+
+    Args:
+        workup_id: Raw workup ID, or None/empty for the default workup
+
+    Returns:
+        str: The workup ID to use
+
+    Raises:
+        ValueError: If the workup ID contains unsupported characters or is too long
+    """
+    if workup_id is None:
+        return DEFAULT_WORKUP_ID
+    workup_id = str(workup_id).strip()
+    if not workup_id:
+        return DEFAULT_WORKUP_ID
+    if not _WORKUP_ID_PATTERN.match(workup_id):
+        raise ValueError("workup_id must be 1-64 characters of letters, digits, '_', '-', '.' or ':'")
+    return workup_id
+
+
+class UnknownWorkupError(LookupError):
+    """Raised for a workup that has no workspace on this worker."""
+
+
+class WorkupWorkspace:
+    """Patient reactions and incremental identification state for a single workup."""
+
+    def __init__(self, workup_id: str, antigram_manager: PandasAntigramManager,
+                 patient_reaction_manager: PandasPatientReactionManager):
+        self.workup_id = workup_id
+        self.patient_reaction_manager = patient_reaction_manager
+        self.abid_tracker = IncrementalABIDTracker(antigram_manager, patient_reaction_manager)
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+    @property
+    def is_default(self) -> bool:
+        return self.workup_id == DEFAULT_WORKUP_ID
+
+    def estimated_bytes(self) -> int:
+        """Approximate memory held by the workspace's reactions and identification state."""
+        size = self.patient_reaction_manager.nbytes
+        for state in (self.abid_tracker.state, self.abid_tracker.historical_state):
+            if state is not None:
+                size += state.nbytes
+        return size
+
+    def to_dict(self) -> Dict:
+        """Convert to dictionary format."""
+        now = time.monotonic()
+        return {
+            'workup_id': self.workup_id,
+            'reaction_count': self.patient_reaction_manager.reaction_count,
+            'estimated_bytes': self.estimated_bytes(),
+            'age_seconds': round(now - self.created_at, 1),
+            'idle_seconds': round(now - self.last_used, 1),
+        }
+
+
+class WorkupWorkspaceManager:
+    """
+    Keeps one patient reaction workspace per workup so several benches can run
+    antibody identification at the same time without sharing a reaction table.
+
+    The default workup wraps the persisted global patient reaction manager and is
+    never evicted. Every other workup is started explicitly (start), held in this
+    worker's memory only and is evicted when idle longer than the TTL, or least
+    recently used first when the number of workspaces or their estimated memory
+    exceeds the configured limits.
+
+    Workup reactions are not persisted or shared through the change feed, so with
+    several workers every request of a workup must reach the worker that started
+    it. get raises UnknownWorkupError for a workup this worker does not hold
+    rather than handing out an empty workspace that would silently lose reactions.
+    """
+
+    def __init__(self, antigram_manager: PandasAntigramManager,
+                 default_reaction_manager: PandasPatientReactionManager,
+                 max_workspaces: int = 64,
+                 idle_ttl_seconds: float = 4 * 60 * 60,
+                 memory_limit_bytes: int = 64 * 1024 * 1024,
+                 sweep_interval_seconds: float = 60):
+        self.antigram_manager = antigram_manager
+        self.max_workspaces = max_workspaces
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.memory_limit_bytes = memory_limit_bytes
+        self.sweep_interval_seconds = sweep_interval_seconds
+
+        self.default_workspace = WorkupWorkspace(DEFAULT_WORKUP_ID, antigram_manager, default_reaction_manager)
+        self._workspaces: 'OrderedDict[str, WorkupWorkspace]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.evicted_count = 0
+
+    def get(self, workup_id: Optional[str] = None) -> WorkupWorkspace:
+        """
+        Get the workspace of a started workup.
+
+        Args:
+            workup_id: Workup ID, or None for the default workup
+
+        Returns:
+            WorkupWorkspace: Workspace for the workup
+
+        Raises:
+            UnknownWorkupError: If the workup was not started on this worker, or was evicted
+        """
+        workspace, _ = self._get(workup_id, create=False)
+        return workspace
+
+    def start(self, workup_id: str) -> bool:
+        """
+        Start a workup on this worker, creating its empty workspace.
+
+        Returns:
+            bool: True if the workspace was created, False if the workup was already started
+        """
+        _, created = self._get(workup_id, create=True)
+        return created
+
+    def _get(self, workup_id: Optional[str], create: bool) -> Tuple[WorkupWorkspace, bool]:
+        """Look up (and, if create is set, create) a workup's workspace; returns it and whether it was created."""
+        workup_id = normalize_workup_id(workup_id)
+        now = time.monotonic()
+        if workup_id == DEFAULT_WORKUP_ID:
+            self.default_workspace.last_used = now
+            return self.default_workspace, False
+
+        with self._lock:
+            workspace = self._workspaces.get(workup_id)
+            created = workspace is None
+            if not created:
+                self._workspaces.move_to_end(workup_id)
+                workspace.last_used = now
+            elif create:
+                reactions = PandasPatientReactionManager(cell_order=self.antigram_manager.cell_numbers)
+                workspace = WorkupWorkspace(workup_id, self.antigram_manager, reactions)
+                self._workspaces[workup_id] = workspace
+                logger.debug(f"Created workspace for workup {workup_id}")
+                self._enforce_limits(now, keep=workup_id)
+            else:
+                raise UnknownWorkupError(
+                    f"Workup {workup_id} is not open on this worker; it was never started here or was "
+                    f"evicted after being idle (every request of a workup must reach the worker that started it)"
+                )
+
+            if now - self._last_sweep >= self.sweep_interval_seconds:
+                self._enforce_limits(now, keep=workup_id)
+            return workspace, created
+
+    def discard(self, workup_id: str) -> bool:
+        """
+        Drop a workup's workspace. The default workup is cleared instead of dropped.
+
+        Returns:
+            bool: True if a workspace existed
+        """
+        workup_id = normalize_workup_id(workup_id)
+        if workup_id == DEFAULT_WORKUP_ID:
+            self.default_workspace.patient_reaction_manager.clear_reactions()
+            return True
+        with self._lock:
+            return self._workspaces.pop(workup_id, None) is not None
+
+    def evict_expired(self) -> int:
+        """Evict idle and over-limit workspaces now. Returns the number evicted."""
+        with self._lock:
+            return self._enforce_limits(time.monotonic())
+
+    def _enforce_limits(self, now: float, keep: str = None) -> int:
+        """Evict expired workspaces, then least recently used ones until within limits."""
+        self._last_sweep = now
+        evicted = []
+
+        for workup_id, workspace in list(self._workspaces.items()):
+            if workup_id != keep and now - workspace.last_used > self.idle_ttl_seconds:
+                evicted.append(workup_id)
+        for workup_id in evicted:
+            del self._workspaces[workup_id]
+
+        def over_limits() -> bool:
+            if len(self._workspaces) > self.max_workspaces:
+                return True
+            total_bytes = sum(workspace.estimated_bytes() for workspace in self._workspaces.values())
+            return total_bytes > self.memory_limit_bytes
+
+        while len(self._workspaces) > 1 and over_limits():
+            workup_id = next(workup_id for workup_id in self._workspaces if workup_id != keep)
+            del self._workspaces[workup_id]
+            evicted.append(workup_id)
+
+        if evicted:
+            self.evicted_count += len(evicted)
+            logger.info(f"Evicted {len(evicted)} idle workup workspaces: {', '.join(evicted)}")
+        return len(evicted)
+
+    def list_workspaces(self) -> List[Dict]:
+        """Summaries of the default and every live workspace, most recently used last."""
+        with self._lock:
+            workspaces = [self.default_workspace] + list(self._workspaces.values())
+        return [workspace.to_dict() for workspace in workspaces]
+
+    def stats(self) -> Dict:
+        """Workspace counts and limits."""
+        with self._lock:
+            total_bytes = sum(workspace.estimated_bytes() for workspace in self._workspaces.values())
+            return {
+                'workspace_count': len(self._workspaces),
+                'estimated_bytes': total_bytes,
+                'evicted_count': self.evicted_count,
+                'max_workspaces': self.max_workspaces,
+                'idle_ttl_seconds': self.idle_ttl_seconds,
+                'memory_limit_bytes': self.memory_limit_bytes,
+            }
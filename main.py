@@ -6,14 +6,26 @@ from api.antigram_routes import register_antigram_routes
 from api.antibody_routes import register_antibody_routes
 from api.utility_routes import register_utility_routes
 from api.antigen import register_antigen_routes
+from api.metrics_routes import register_metrics_routes
 from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
 from core.pandas_models import PandasAntigramManager, PandasPatientReactionManager
 from core.pandas_models import PandasAntigramManager, PandasPatientReactionManager, PandasTemplateManager
+from core.workup_workspaces import WorkupWorkspaceManager
+from core.bulk_persistence import bulk_insert
+from core.rule_repository import AntibodyRuleRepository
+from core.change_feed import ChangeFeed, ENTITY_ANTIGRAM, ENTITY_PATIENT_REACTION, ENTITY_TEMPLATE, ENTITY_ANTIBODY_RULES
+from core.request_logging import configure_logging, RequestBodySampler
+from core.response_cache import ResponseCache
+from core.serialization import FastJSONProvider
+from core.compression import ResponseCompressor
+from core.metrics import instrument_engine, reset_query_count, query_count, REQUEST_LATENCY, REQUEST_DB_QUERIES
+from utils.default_rules import get_default_rules
 
 import json
 import os
 import time
+from datetime import timedelta
+from types import SimpleNamespace
 
 from models import Base
 from dotenv import load_dotenv
@@ -21,27 +33,33 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging: records are written by a background thread (see core/request_logging.py)
+configure_logging()
 logger = logging.getLogger(__name__)
 
-# Initialize Flask app
-app = Flask(__name__)
+# Request bodies logged (LOG_BODY_SAMPLE_RATE) and their maximum length (LOG_BODY_MAX_BYTES)
+request_body_sampler = RequestBodySampler.from_env()
 
-# Configure SQLAlchemy
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///local.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Responses compressed per Accept-Encoding (COMPRESS_MIN_BYTES, COMPRESS_GZIP_LEVEL, COMPRESS_BROTLI_QUALITY)
+response_compressor = ResponseCompressor.from_env()
 
-# Initialize Flask-SQLAlchemy
-db = SQLAlchemy(app)
+# Initialize Flask app
+app = Flask(__name__)
 
-# Initialize Flask-Migrate
-migrate = Migrate(app, db)
+# Serialize JSON with orjson when it is installed (JSON_SERIALIZER=stdlib to opt out)
+app.json = FastJSONProvider(app)
 
-# Set up the SQLAlchemy engine and session
+# Set up the SQLAlchemy engine (the only one) and a session per request thread,
+# released when each request's app context is torn down
 engine = connect_with_connector()
 db_session = scoped_session(sessionmaker(bind=engine))
 
+# Initialize Flask-Migrate against the application engine and models
+migrate = Migrate(app, SimpleNamespace(engine=engine, metadata=Base.metadata))
+
+# Count SQL statements for /api/metrics
+instrument_engine(engine)
+
 # Initialize the database schema for SQLite
 # Only runs when using SQLite
 if "sqlite" in str(engine.url):
@@ -61,18 +79,18 @@ if "sqlite" in str(engine.url):
                 # Get default rules
                 default_rules = get_default_rules()
                 
-                # Add new rules
-                for rule_data in default_rules:
-                    # Convert rule_data to JSON string for storage
-                    rule_data_json = json.dumps(rule_data['rule_data'])
-                    rule = AntibodyRule(
-                        rule_type=rule_data['rule_type'],
-                        target_antigen=rule_data['target_antigen'],
-                        rule_data=rule_data_json,
-                        description=rule_data['description'],
-                        enabled=True
-                    )
-                    db_session.add(rule)
+                # Add new rules in multi-row INSERT statements
+                bulk_insert(db_session, AntibodyRule, [
+                    {
+                        "rule_type": rule_data['rule_type'],
+                        "target_antigen": rule_data['target_antigen'],
+                        # Convert rule_data to JSON string for storage
+                        "rule_data": json.dumps(rule_data['rule_data']),
+                        "description": rule_data['description'],
+                        "enabled": True
+                    }
+                    for rule_data in default_rules
+                ])
                 
                 db_session.commit()
                 logger.info("Default antibody rules initialized successfully")
@@ -82,10 +100,30 @@ if "sqlite" in str(engine.url):
         logger.error(f"Error checking/initializing antibody rules: {str(e)}")
 
 # Initialize pandas managers
-antigram_manager = PandasAntigramManager(db_session)
-patient_reaction_manager = PandasPatientReactionManager(db_session)
+# Matrices are loaded on demand; resident matrices beyond the budget are evicted.
+# Expired lots are archived (left out of searches and memory) as they are found
+antigram_manager = PandasAntigramManager(
+    db_session,
+    memory_budget_bytes=int(os.getenv("ANTIGRAM_MEMORY_BUDGET_MB", "256")) * 1024 * 1024,
+    archive_interval_seconds=float(os.getenv("INVENTORY_ARCHIVE_INTERVAL_SECONDS", "3600"))
+)
+# Reaction vectors are laid out in each antigram's cell order
+patient_reaction_manager = PandasPatientReactionManager(db_session, cell_order=antigram_manager.cell_numbers)
 template_manager = PandasTemplateManager(db_session) 
 
+# Changes committed by other workers are applied before each request; start from the
+# current version before loading so nothing committed during the load is missed
+change_feed = ChangeFeed(
+    db_session,
+    gap_timeout_seconds=float(os.getenv("CHANGE_FEED_GAP_TIMEOUT_SECONDS", "60")),
+    retention=timedelta(hours=float(os.getenv("CHANGE_LOG_RETENTION_HOURS", "24")))
+)
+try:
+    change_feed.start()
+except Exception as e:
+    db_session.rollback()
+    logger.error(f"Error reading change log version (is the change_log table migrated?): {e}")
+
 # Load existing data from database
 try:
     antigram_manager.load_from_database(db_session)
@@ -101,53 +139,115 @@ app.config['antigram_manager'] = antigram_manager
 app.config['patient_reaction_manager'] = patient_reaction_manager
 app.config['template_manager'] = template_manager
 
-
-# Register routes, passing the database session
-register_antigen_routes(app, db_session)
-register_antigram_routes(app, db_session)
-register_antibody_routes(app, db_session)
-register_utility_routes(app, db_session)
-
-
+# Parsed antibody rules, reloaded only after the rule endpoints (here or on another worker) change the table
+rule_repository = AntibodyRuleRepository(db_session)
+app.config['rule_repository'] = rule_repository
+
+# Reload records other workers changed
+change_feed.subscribe(ENTITY_ANTIGRAM, antigram_manager.apply_remote_changes, antigram_manager.reload_from_database)
+change_feed.subscribe(ENTITY_PATIENT_REACTION, patient_reaction_manager.apply_remote_changes,
+                      patient_reaction_manager.reload_from_database)
+change_feed.subscribe(ENTITY_TEMPLATE, template_manager.apply_remote_changes, template_manager.reload_from_database)
+change_feed.subscribe(ENTITY_ANTIBODY_RULES, lambda changes: rule_repository.invalidate(), rule_repository.invalidate)
+app.config['change_feed'] = change_feed
+
+# Serialized library endpoint bodies (antigrams, templates, rules), reused and
+# answered with 304 Not Modified until the data behind them changes
+app.config['response_cache'] = ResponseCache(max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "256")))
+
+# Per-workup patient reaction workspaces; requests without a workup ID use the global manager
+app.config['workup_workspace_manager'] = WorkupWorkspaceManager(
+    antigram_manager,
+    patient_reaction_manager,
+    max_workspaces=int(os.getenv("WORKUP_MAX_WORKSPACES", "64")),
+    idle_ttl_seconds=float(os.getenv("WORKUP_IDLE_TTL_SECONDS", str(4 * 60 * 60))),
+    memory_limit_bytes=int(os.getenv("WORKUP_MEMORY_LIMIT_MB", "64")) * 1024 * 1024
+)
+
+
+# Request hooks run in registration order, so these are registered before the route
+# modules' own hooks: a request they reject early (e.g. an unknown workup) is still
+# timed, counted and logged, and sees the changes of other workers
 @app.before_request
 def start_timer():
     """Start timer for request performance monitoring"""
     request.start_time = time.time()
+    reset_query_count()
+
+@app.before_request
+def apply_change_feed():
+    """Bring in-memory state up to date with changes committed by other workers."""
+    if request.endpoint != 'static':
+        change_feed.poll()
+
+@app.before_request
+def archive_expired_lots():
+    """Archive lots that expired since the last check (at most once per archive interval)."""
+    if request.endpoint != 'static':
+        antigram_manager.archive_expired_if_due()
 
 @app.before_request
 def log_request_info():
     """Log incoming request information"""
-    logger.info(f"Request: {request.method} {request.url}")
+    fields = {'method': request.method, 'url': request.url}
     if request.method == 'POST':
-        logger.info(f"Request data: {request.get_json() if request.is_json else request.form}")
+        fields.update(request_body_sampler.body_fields(request))
+    # Message arguments are formatted on the log writer thread
+    logger.info("Request: %s %s", request.method, request.url, extra={'fields': fields})
+
+# Register routes, passing the database session
+register_antigen_routes(app, db_session)
+register_antigram_routes(app, db_session)
+register_antibody_routes(app, db_session)
+register_utility_routes(app, db_session)
+register_metrics_routes(app, db_session)
+
+# Return the startup session's connection to the pool; requests open their own
+db_session.remove()
+
 
 @app.after_request
 def log_response_info(response):
     """Log response information with performance metrics"""
     if hasattr(request, 'start_time'):
         duration = time.time() - request.start_time
-        logger.info(f"Response: {response.status_code} for {request.method} {request.url} - Duration: {duration:.3f}s")
+        logger.info("Response: %s for %s %s - Duration: %.3fs", response.status_code, request.method, request.url, duration,
+                    extra={'fields': {'method': request.method, 'url': request.url,
+                                      'status': response.status_code, 'duration_ms': round(duration * 1000, 3)}})
+        # Label by route pattern (not URL) to keep the number of series bounded
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_LATENCY.observe(duration, method=request.method, route=route, status=response.status_code)
+        REQUEST_DB_QUERIES.observe(query_count(), method=request.method, route=route)
     else:
-        logger.info(f"Response: {response.status_code} for {request.method} {request.url}")
+        logger.info("Response: %s for %s %s", response.status_code, request.method, request.url,
+                    extra={'fields': {'method': request.method, 'url': request.url, 'status': response.status_code}})
     return response
 
+@app.after_request
+def compress_response(response):
+    """Compress the body with the client's preferred encoding (runs before the response is logged)."""
+    return response_compressor.compress_response(response, request.accept_encodings)
+
 @app.route("/")
 def home():
     return render_template("home.html")
 
 @app.teardown_appcontext
 def save_data_on_shutdown(exception=None):
-    """Save all data to database when the app context is torn down."""
+    """Flush data changed during the request to the database when the app context is torn down."""
     try:
-        if 'antigram_manager' in app.config:
-            app.config['antigram_manager'].save_all_to_database()
-        if 'patient_reaction_manager' in app.config:
-            app.config['patient_reaction_manager'].save_all_to_database()
-        if 'template_manager' in app.config:
-            app.config['template_manager'].save_all_to_database()
-        logger.info("Data saved to database on shutdown")
+        flushed = []
+        for manager_key in ('antigram_manager', 'patient_reaction_manager', 'template_manager'):
+            manager = app.config.get(manager_key)
+            if manager is not None and manager.flush_changes():
+                flushed.append(manager_key)
+        if flushed:
+            logger.info(f"Flushed changes to database on teardown: {', '.join(flushed)}")
     except Exception as e:
         logger.error(f"Error saving data on shutdown: {e}")
+    finally:
+        # Close the request's session so its connection goes back to the pool
+        db_session.remove()
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=5000)
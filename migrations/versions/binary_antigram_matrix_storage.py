@@ -0,0 +1,73 @@
+"""Store antigram matrices in the compact binary format
+
+Revision ID: binary_antigram_matrix_storage
+Revises: a5242d456a2e
+Create Date: 2025-08-04 09:00:00.000000
+
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+from core.matrix_codec import decode_matrix, encode_matrix, is_binary_matrix
+
+# revision identifiers, used by Alembic.
+revision = 'binary_antigram_matrix_storage'
+down_revision = 'a5242d456a2e'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+
+def _convert_rows(source_column, target_column, convert):
+    """Convert matrix_data between formats in id-ordered batches."""
+    connection = op.get_bind()
+    table = sa.table(
+        'antigram_matrix_storage',
+        sa.column('id', sa.Integer),
+        sa.column(source_column),
+        sa.column(target_column),
+    )
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(table.c.id, table.c[source_column])
+            .where(table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        for row_id, data in rows:
+            connection.execute(
+                table.update().where(table.c.id == row_id).values({target_column: convert(data)})
+            )
+        last_id = rows[-1][0]
+
+
+def upgrade():
+    """Re-encode every stored matrix from JSON to the binary format."""
+    op.add_column('antigram_matrix_storage', sa.Column('matrix_blob', sa.LargeBinary(), nullable=True))
+
+    _convert_rows('matrix_data', 'matrix_blob',
+                  lambda data: bytes(data) if is_binary_matrix(data) else encode_matrix(decode_matrix(data)))
+
+    with op.batch_alter_table('antigram_matrix_storage') as batch_op:
+        batch_op.drop_column('matrix_data')
+        batch_op.alter_column('matrix_blob', new_column_name='matrix_data',
+                              existing_type=sa.LargeBinary(), nullable=False)
+
+
+def downgrade():
+    """Re-encode every stored matrix back to JSON."""
+    op.add_column('antigram_matrix_storage', sa.Column('matrix_json', sa.Text(), nullable=True))
+
+    _convert_rows('matrix_data', 'matrix_json',
+                  lambda data: json.dumps(decode_matrix(data).to_dict()))
+
+    with op.batch_alter_table('antigram_matrix_storage') as batch_op:
+        batch_op.drop_column('matrix_data')
+        batch_op.alter_column('matrix_json', new_column_name='matrix_data',
+                              existing_type=sa.Text(), nullable=False)
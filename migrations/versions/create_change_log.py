@@ -0,0 +1,37 @@
+"""Create the change log table read by every worker's change feed
+
+Revision ID: create_change_log
+Revises: unique_patient_reaction_cell
+Create Date: 2025-08-06 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'create_change_log'
+down_revision = 'unique_patient_reaction_cell'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Create change_log; IDs are versions, so they must never be reused."""
+    op.create_table('change_log',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('entity', sa.String(length=32), nullable=False),
+        sa.Column('entity_key', sa.String(length=64), nullable=True),
+        sa.Column('operation', sa.String(length=16), nullable=False),
+        sa.Column('worker_id', sa.String(length=64), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sqlite_autoincrement=True
+    )
+    op.create_index('ix_change_log_created_at', 'change_log', ['created_at'])
+
+
+def downgrade():
+    """Drop change_log."""
+    op.drop_index('ix_change_log_created_at', table_name='change_log')
+    op.drop_table('change_log')
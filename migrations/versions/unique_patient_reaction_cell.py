@@ -0,0 +1,52 @@
+"""Add a unique key on patient reaction (antigram_id, cell_number)
+
+Revision ID: unique_patient_reaction_cell
+Revises: binary_antigram_matrix_storage
+Create Date: 2025-08-05 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'unique_patient_reaction_cell'
+down_revision = 'binary_antigram_matrix_storage'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+
+def upgrade():
+    """Drop duplicate reaction rows (keeping the newest) and add the unique key used by bulk upserts."""
+    connection = op.get_bind()
+    reactions = sa.table(
+        'patient_reaction_storage',
+        sa.column('id', sa.Integer),
+        sa.column('antigram_id', sa.Integer),
+        sa.column('cell_number', sa.String),
+    )
+
+    # Rows are read in id order, so the last row seen for a cell is the newest one
+    newest = {}
+    duplicate_ids = []
+    for row_id, antigram_id, cell_number in connection.execute(
+        sa.select(reactions.c.id, reactions.c.antigram_id, reactions.c.cell_number).order_by(reactions.c.id)
+    ):
+        key = (antigram_id, cell_number)
+        if key in newest:
+            duplicate_ids.append(newest[key])
+        newest[key] = row_id
+
+    for start in range(0, len(duplicate_ids), BATCH_SIZE):
+        connection.execute(reactions.delete().where(reactions.c.id.in_(duplicate_ids[start:start + BATCH_SIZE])))
+
+    with op.batch_alter_table('patient_reaction_storage') as batch_op:
+        batch_op.create_unique_constraint('uq_patient_reaction_cell', ['antigram_id', 'cell_number'])
+
+
+def downgrade():
+    """Remove the unique key."""
+    with op.batch_alter_table('patient_reaction_storage') as batch_op:
+        batch_op.drop_constraint('uq_patient_reaction_cell', type_='unique')
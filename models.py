@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Date, ForeignKey, Boolean, Text
+from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Boolean, Text, Index
 from sqlalchemy.orm import relationship, declarative_base
 import json
 
@@ -74,3 +74,23 @@ class Antigen(Base):
             "name": self.name,
             "system": self.system
         }
+
+
+class ChangeLog(Base):
+    """
+    One row per committed change to state that workers hold in memory.
+    The auto-increment ID is the change feed version (see core/change_feed.py).
+    """
+    __tablename__ = "change_log"
+    __table_args__ = (
+        Index('ix_change_log_created_at', 'created_at'),
+        # Never reuse IDs of pruned rows, so versions only increase
+        {'sqlite_autoincrement': True},
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    entity = Column(String(32), nullable=False)  # 'antigram', 'patient_reaction', 'template', 'antibody_rules'
+    entity_key = Column(String(64), nullable=True)  # Changed record's key; NULL for whole-entity changes
+    operation = Column(String(16), nullable=False)  # 'upsert', 'delete', 'delete_all'
+    worker_id = Column(String(64), nullable=False)  # Writing worker, which skips its own changes
+    created_at = Column(DateTime, nullable=False)
@@ -10,10 +10,32 @@ document.addEventListener("DOMContentLoaded", () => {
     let selectedAntigramId = null;
     let selectedLotNumber = null;
 
+    // Each page load is its own workup so benches working in parallel keep separate reactions
+    const workupId = (window.crypto && crypto.randomUUID)
+        ? crypto.randomUUID()
+        : `workup-${Date.now()}-${Math.random().toString(36).slice(2, 10)}`;
+
+    // Start the workup on the server; its workspace lives on the worker that started it
+    const workupStarted = fetch(`/api/workups/${encodeURIComponent(workupId)}`, { method: "PUT" });
+
+    // fetch() for workup-scoped endpoints (patient reactions and ABID results)
+    const workupFetch = async (url, options = {}) => {
+        await workupStarted;
+        return fetch(url, {
+            ...options,
+            headers: { ...(options.headers || {}), "X-Workup-ID": workupId },
+        });
+    };
+
+    // Release the workup's workspace when the page is closed
+    window.addEventListener("pagehide", () => {
+        fetch(`/api/workups/${encodeURIComponent(workupId)}`, { method: "DELETE", keepalive: true });
+    });
+
     // Function to fetch and render ABID results
     const fetchAndRenderPatientReactions = async () => {
         try {
-            const response = await fetch("/api/patient-reactions");
+            const response = await workupFetch("/api/patient-reactions");
             if (!response.ok) throw new Error("Failed to fetch patient reactions.");
     
             const data = await response.json();
@@ -199,7 +221,7 @@ document.addEventListener("DOMContentLoaded", () => {
     
             // Send each reaction individually
             for (const reactionData of reactions) {
-                const response = await fetch("/api/patient-reactions", {
+                const response = await workupFetch("/api/patient-reactions", {
                     method: "POST",
                     headers: { "Content-Type": "application/json" },
                     body: JSON.stringify({ 
@@ -242,7 +264,7 @@ document.addEventListener("DOMContentLoaded", () => {
             }
     
             try {
-                const response = await fetch(`/api/patient-reactions/${antigramId}/${cellNumber}`, {
+                const response = await workupFetch(`/api/patient-reactions/${antigramId}/${cellNumber}`, {
                     method: "DELETE",
                 });
     
@@ -266,15 +288,25 @@ document.addEventListener("DOMContentLoaded", () => {
     });
     
 
+    // ABID results only carry status lists; ruling out cells are fetched per antigen on demand
+    let lastAbidResults = null;
+    let loadedRuleOutDetails = {};
+
     // Render ABID results
     const renderAbidResults = (results) => {
-        const createRowDisplay = (data, label) => {
+        if (results !== lastAbidResults) {
+            lastAbidResults = results;
+            loadedRuleOutDetails = {};
+        }
+        const ruledOutDetails = results.ruled_out_details || loadedRuleOutDetails;
+
+        const createRowDisplay = (data, label, itemClass = "antigen") => {
             if (!data || data.length === 0) {
                 return `<div class="result-row"><strong>${label}:</strong> None</div>`;
             }
     
             let row = `<div class="result-row"><strong>${label}:</strong> `;
-            row += data.map(item => `<span class="antigen">${item}</span>`).join(", ");
+            row += data.map(item => `<span class="${itemClass}" data-antigen="${item}">${item}</span>`).join(", ");
             row += `</div>`;
             return row;
         };
@@ -286,7 +318,7 @@ document.addEventListener("DOMContentLoaded", () => {
             heterozygous: []
         };
 
-        Object.entries(results.ruled_out_details || {}).forEach(([antigen, cells]) => {
+        Object.entries(ruledOutDetails).forEach(([antigen, cells]) => {
             // First check for homozygous rule-outs
             const homozygousCells = cells.filter(cell => cell.rule_type === 'homozygous');
             if (homozygousCells.length > 0) {
@@ -420,16 +452,25 @@ document.addEventListener("DOMContentLoaded", () => {
                     border-radius: 3px;
                     margin: 0 2px;
                 }
+                .ruled-out-antigen {
+                    cursor: pointer;
+                    text-decoration: underline dotted;
+                }
+                .rule-out-hint {
+                    color: #666;
+                }
             </style>
         `;
     
         abidResultsContainer.innerHTML = `
             ${styles}
-            ${createRowDisplay(results.ruled_out, "Ruled Out (RO)")}
+            ${createRowDisplay(results.ruled_out, "Ruled Out (RO)", "antigen ruled-out-antigen")}
             ${createRowDisplay(results.stro, "Still to Rule Out (STRO)")}
             ${createRowDisplay(results.matches, "100% Match")}
             <div class="rule-out-details">
                 <h3>Ruled Out Details</h3>
+                ${results.ruled_out_details || (results.ruled_out || []).length === 0 ? '' :
+                    '<p class="rule-out-hint">Select a ruled out antigen to show the cells that rule it out.</p>'}
                 ${singleRuleOuts}
                 ${homoRuleOuts}
                 ${heteroRuleOuts}
@@ -437,10 +478,30 @@ document.addEventListener("DOMContentLoaded", () => {
         `;
     };
 
+    // Load the ruling out cells of a ruled out antigen when it is clicked
+    abidResultsContainer.addEventListener("click", async (e) => {
+        const target = e.target.closest(".ruled-out-antigen");
+        if (!target || !lastAbidResults) return;
+        const antigen = target.dataset.antigen;
+        if (loadedRuleOutDetails[antigen]) return;
+
+        try {
+            const response = await workupFetch(`/api/abid/antigen/${encodeURIComponent(antigen)}`);
+            if (!response.ok) throw new Error(`Failed to fetch details for ${antigen}.`);
+
+            const antigenResults = await response.json();
+            loadedRuleOutDetails[antigen] = antigenResults.ruling_out_cells || [];
+            renderAbidResults(lastAbidResults);
+        } catch (error) {
+            console.error("❌ Error fetching rule-out details:", error);
+            alert("Error fetching rule-out details: " + error.message);
+        }
+    });
+
     const fetchAndRenderAbidResults = async () => {
         try {
             console.log("✅ Fetching ABID results...");
-            const response = await fetch("/api/abid");
+            const response = await workupFetch("/api/abid");
             if (!response.ok) throw new Error("Failed to fetch ABID results.");
     
             const abidResults = await response.json();
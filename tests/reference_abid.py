@@ -0,0 +1,166 @@
+"""
+Reference antibody identification for the differential tests.
+
+A direct, cell by cell implementation of the rule semantics over the antigram
+matrices, with no expression index, compiled plan or incremental state, so the
+engines in core/ can be checked against it.
+"""
+
+from typing import Dict, List, Optional, Set, Tuple
+
+CellKey = Tuple[int, str]
+
+
+def cell_sets(antigram_manager, antigram_ids: List[int]) -> Tuple[Dict[str, Set[CellKey]], Dict[str, Set[CellKey]]]:
+    """Cells expressing ('+') and not expressing ('0') each antigen."""
+    expressing: Dict[str, Set[CellKey]] = {}
+    non_expressing: Dict[str, Set[CellKey]] = {}
+    for antigram_id in antigram_ids:
+        matrix = antigram_manager.get_antigram_matrix(antigram_id)
+        for antigen in matrix.columns:
+            for cell_number, value in matrix[antigen].items():
+                if value == '+':
+                    expressing.setdefault(antigen, set()).add((antigram_id, str(cell_number)))
+                elif value == '0':
+                    non_expressing.setdefault(antigen, set()).add((antigram_id, str(cell_number)))
+    return expressing, non_expressing
+
+
+def _ruling_out_cells(cells: Set[CellKey], negative: Set[CellKey], metadata: Dict[int, Dict], details: Dict) -> List[Dict]:
+    """Detail records of the cells in the set the patient is negative for."""
+    return [
+        {'cell_number': cell_number, 'lot_number': metadata[antigram_id]['lot_number'],
+         'antigram_id': antigram_id, **details}
+        for antigram_id, cell_number in sorted(cells & negative)
+    ]
+
+
+def evaluate_rule(rule: Dict, expressing: Dict[str, Set[CellKey]], non_expressing: Dict[str, Set[CellKey]],
+                  negative: Set[CellKey], metadata: Dict[int, Dict],
+                  suspected_antibody: Optional[str] = None) -> Tuple[bool, List[Dict]]:
+    """
+    Evaluate one rule.
+
+    Returns:
+        Tuple of (is_satisfied, ruling_out_cells)
+    """
+    rule_type = rule['rule_type']
+    target = rule['target_antigen']
+    data = rule['rule_data']
+
+    if rule_type == 'single':
+        if target not in data.get('antigens', []):
+            return False, []
+        cells = _ruling_out_cells(expressing.get(target, set()), negative, metadata,
+                                  {'rule_type': 'single', 'antigen': target})
+        return len(cells) >= 1, cells
+
+    if rule_type == 'lowf':
+        if target not in data.get('antigens', []):
+            return False, []
+        return True, [{'rule_type': 'lowf', 'antigen': target, 'reason': 'low_prevalence'}]
+
+    if rule_type == 'homo':
+        cells = []
+        for antigen_a, antigen_b in data.get('antigen_pairs', []):
+            if antigen_a != target:
+                continue
+            pair_cells = expressing.get(antigen_a, set()) & non_expressing.get(antigen_b, set())
+            cells += _ruling_out_cells(pair_cells, negative, metadata,
+                                       {'rule_type': 'homozygous', 'antigen_a': antigen_a, 'antigen_b': antigen_b})
+        return len(cells) >= 1, cells
+
+    if rule_type == 'hetero':
+        antigen_a, antigen_b = data.get('antigen_a'), data.get('antigen_b')
+        if antigen_a != target:
+            return False, []
+        pair_cells = expressing.get(antigen_a, set()) & expressing.get(antigen_b, set())
+        cells = _ruling_out_cells(pair_cells, negative, metadata,
+                                  {'rule_type': 'heterozygous', 'antigen_a': antigen_a, 'antigen_b': antigen_b})
+        return len(cells) >= data.get('required_count', 3), cells
+
+    if rule_type == 'abspecific':
+        if not suspected_antibody or data.get('antibody') != suspected_antibody:
+            return False, []
+        antigen1, antigen2 = data.get('antigen1'), data.get('antigen2')
+        pair_cells = expressing.get(antigen1, set()) & expressing.get(antigen2, set())
+        cells = _ruling_out_cells(pair_cells, negative, metadata,
+                                  {'rule_type': 'abspecific', 'antigen1': antigen1, 'antigen2': antigen2})
+        return len(cells) >= data.get('required_count', 1), cells
+
+    return False, []
+
+
+def identify(antigram_manager, reactions: Dict[CellKey, str], rules: List[Dict],
+             include_archived: bool = False) -> Dict:
+    """
+    Identify antibodies from patient reactions.
+
+    Args:
+        antigram_manager: Inventory to identify against
+        reactions: Patient reaction of each (antigram_id, cell_number)
+        rules: Antibody rules (disabled ones are skipped)
+        include_archived: Use the archived (expired) lots too
+
+    Returns:
+        Dict shaped like EnhancedAntibodyIdentifier.identify_antibodies results
+    """
+    if not reactions:
+        return {"ruled_out": [], "stro": [], "matches": [], "progress": {},
+                "ruled_out_details": {}, "suspected_antibodies": []}
+
+    snapshot = antigram_manager.snapshot(include_archived=include_archived)
+    antigram_ids = snapshot.visible_antigram_ids
+    metadata = {antigram_id: snapshot.metadata[antigram_id] for antigram_id in antigram_ids}
+    expressing, non_expressing = cell_sets(antigram_manager, antigram_ids)
+    antigens = set(expressing) | set(non_expressing)
+
+    visible = set(antigram_ids)
+    positive = {key for key, reaction in reactions.items() if reaction == '+' and key[0] in visible}
+    negative = {key for key, reaction in reactions.items() if reaction == '0' and key[0] in visible}
+
+    suspected = sorted(antigen for antigen in antigens if expressing.get(antigen, set()) & positive)
+
+    ruled_out: Set[str] = set()
+    details: Dict[str, List[Dict]] = {}
+    for rule in rules:
+        if not rule.get('enabled', True):
+            continue
+        target = rule['target_antigen']
+        candidates = suspected if rule['rule_type'] == 'abspecific' else [None]
+        for suspected_antibody in candidates:
+            satisfied, cells = evaluate_rule(rule, expressing, non_expressing, negative, metadata, suspected_antibody)
+            if satisfied:
+                ruled_out.add(target)
+                details.setdefault(target, []).extend(cells)
+                break
+
+    progress = {}
+    stro, matches = set(), set()
+    for antigen in antigens:
+        plus, zero = expressing.get(antigen, set()), non_expressing.get(antigen, set())
+        meets_match_criteria = plus <= positive and zero <= negative
+        positive_matches = len(plus & positive)
+        negative_matches = len(zero & negative)
+        total_cells = len(plus | zero)
+        progress[antigen] = {
+            "total_cells": total_cells,
+            "positive_matches": positive_matches,
+            "negative_matches": negative_matches,
+            "mismatches": len(plus & negative) + len(zero & positive),
+            "match_percentage": (positive_matches + negative_matches) / total_cells * 100 if total_cells else 0,
+            "ruling_out_cells": details.get(antigen, []),
+            "can_be_ruled_out": antigen in details,
+            "meets_match_criteria": meets_match_criteria,
+        }
+        if antigen not in ruled_out:
+            (matches if meets_match_criteria else stro).add(antigen)
+
+    return {
+        "ruled_out": sorted(ruled_out),
+        "stro": sorted(stro),
+        "matches": sorted(matches),
+        "progress": progress,
+        "ruled_out_details": details,
+        "suspected_antibodies": suspected,
+    }
@@ -0,0 +1,73 @@
+"""
+Tests for the change feed: changes committed by another worker reach the
+subscribed handlers, and a handler that fails has its changes retried.
+"""
+
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from core.change_feed import ENTITY_ANTIGRAM, ENTITY_TEMPLATE, OP_UPSERT, ChangeFeed
+from models import Base, ChangeLog
+
+
+@pytest.fixture
+def db_session():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = scoped_session(sessionmaker(bind=engine))
+    yield session
+    session.remove()
+    engine.dispose()
+
+
+def commit_remote_change(db_session, entity: str, key: str):
+    """Commit a change log row as another worker would."""
+    db_session.add(ChangeLog(entity=entity, entity_key=key, operation=OP_UPSERT,
+                             worker_id='other-worker', created_at=datetime.now()))
+    db_session.commit()
+
+
+def test_remote_changes_are_applied_once(db_session):
+    feed = ChangeFeed(db_session)
+    feed.start()
+    applied = []
+    feed.subscribe(ENTITY_ANTIGRAM, applied.extend, lambda: None)
+
+    commit_remote_change(db_session, ENTITY_ANTIGRAM, '1')
+    assert feed.poll() == 1
+    assert feed.poll() == 0
+    assert [change.key for change in applied] == ['1']
+    assert feed.version == 1
+
+
+def test_failed_handler_is_retried_by_the_next_poll(db_session):
+    feed = ChangeFeed(db_session)
+    feed.start()
+    antigram_changes, template_changes = [], []
+    failures = [RuntimeError('database is locked')]
+
+    def apply_antigram_changes(changes):
+        if failures:
+            raise failures.pop()
+        antigram_changes.extend(changes)
+
+    feed.subscribe(ENTITY_ANTIGRAM, apply_antigram_changes, lambda: None)
+    feed.subscribe(ENTITY_TEMPLATE, template_changes.extend, lambda: None)
+
+    commit_remote_change(db_session, ENTITY_ANTIGRAM, '7')
+    commit_remote_change(db_session, ENTITY_TEMPLATE, '3')
+
+    # The antigram handler fails: nothing is marked as applied
+    assert feed.poll() == 0
+    assert feed.version == 0
+    assert antigram_changes == []
+
+    # The next poll reads the same rows again, so no entity's change is lost
+    assert feed.poll() == 2
+    assert feed.version == 2
+    assert [change.key for change in antigram_changes] == ['7']
+    assert [change.key for change in template_changes][-1] == '3'
+    assert feed.poll() == 0
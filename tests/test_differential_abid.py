@@ -0,0 +1,226 @@
+"""
+Differential tests: the identification engines (bitmap evaluator, compiled rule
+plan, incremental state and batch identification) must give the same results,
+details included, as the reference implementation in tests/reference_abid.py on
+generated inventories, patient panels and rule sets.
+"""
+
+import json
+import random
+from typing import Dict, List
+
+import pytest
+
+from benchmarks.generator import generate_inventory, generate_patient_panel
+from benchmarks.run import benchmark_rules
+from core.antibody_rule_evaluator import AntibodyRuleEvaluator
+from core.enhanced_antibody_identifier import EnhancedAntibodyIdentifier
+from core.incremental_abid import IncrementalABIDTracker
+from core.pandas_models import PandasPatientReactionManager
+from core.rule_compiler import plan_cache_stats
+from tests import reference_abid
+from utils.default_rules import DEFAULT_ANTIGEN_ORDER
+
+# (antigrams, cells per antigram, seed) of the generated inventories
+SCALES = [(1, 11, 0), (8, 11, 1), (20, 16, 2), (40, 20, 3)]
+
+RULE_SET_SEEDS = [0, 1, 2]
+
+PATIENT_REACTIONS = ['+', '0', '+', '0', 'w']
+
+
+def generate_rules(seed: int, antigens=DEFAULT_ANTIGEN_ORDER, count: int = 40) -> List[Dict]:
+    """
+    Draw a random rule set of every rule type, shaped like rules loaded from the database.
+
+    Targets, antigens and required counts are random, so the set includes rules that
+    never apply (a target outside the rule's antigens) or need several cells, and
+    about one rule in eight is disabled.
+    """
+    rng = random.Random(seed)
+    antigens = list(antigens)
+    rules = []
+    for rule_id in range(1, count + 1):
+        rule_type = rng.choice(['abspecific', 'homo', 'hetero', 'single', 'lowf'])
+        target = rng.choice(antigens)
+        if rule_type == 'abspecific':
+            rule_data = {'antibody': rng.choice(antigens), 'antigen1': target,
+                         'antigen2': rng.choice(antigens), 'required_count': rng.randint(1, 4)}
+        elif rule_type == 'homo':
+            pairs = [[rng.choice(antigens), rng.choice(antigens)] for _ in range(rng.randint(1, 4))]
+            pairs.append([target, rng.choice(antigens)])
+            rule_data = {'antigen_pairs': pairs}
+        elif rule_type == 'hetero':
+            antigen_a = target if rng.random() < 0.9 else rng.choice(antigens)
+            rule_data = {'antigen_a': antigen_a, 'antigen_b': rng.choice(antigens), 'required_count': rng.randint(1, 4)}
+        else:
+            rule_data = {'antigens': rng.sample(antigens, rng.randint(1, 3)) + ([target] if rng.random() < 0.8 else [])}
+        rules.append({
+            'id': rule_id,
+            'rule_type': rule_type,
+            'target_antigen': target,
+            'rule_data': rule_data,
+            'description': f'Generated {rule_type} rule',
+            'enabled': rng.random() >= 0.125,
+        })
+    return rules
+
+
+def rule_sets() -> list:
+    """The default rule set and a few generated ones."""
+    return [pytest.param(benchmark_rules(), id='default-rules')] + [
+        pytest.param(generate_rules(seed), id=f'generated-rules-{seed}') for seed in RULE_SET_SEEDS
+    ]
+
+
+def _sorted_cells(cells: List[Dict]) -> List[Dict]:
+    return sorted(cells, key=lambda cell: json.dumps(cell, sort_keys=True, default=str))
+
+
+def canonical(results: Dict) -> Dict:
+    """Results with ruling out cells in a fixed order, as JSON would carry them."""
+    results = json.loads(json.dumps(results, sort_keys=True, default=str))
+    if 'ruled_out_details' in results:
+        results['ruled_out_details'] = {
+            antigen: _sorted_cells(cells) for antigen, cells in results['ruled_out_details'].items()
+        }
+    for entry in results.get('progress', {}).values():
+        entry['ruling_out_cells'] = _sorted_cells(entry['ruling_out_cells'])
+    return results
+
+
+def reference_results(inventory, reaction_manager, rules, include_archived=False) -> Dict:
+    return canonical(reference_abid.identify(inventory, dict(reaction_manager.iter_reactions()), rules,
+                                             include_archived=include_archived))
+
+
+@pytest.fixture(params=SCALES, ids=lambda scale: f'{scale[0]}x{scale[1]}')
+def inventory(request):
+    antigram_count, cell_count, seed = request.param
+    return generate_inventory(antigram_count, cell_count, seed=seed)
+
+
+def patient(inventory, seed: int, panel_antigrams: int = 4) -> PandasPatientReactionManager:
+    """A generated patient panel with a few random reactions changed, so no antigen matches by construction."""
+    reactions = generate_patient_panel(inventory, seed=seed, panel_antigrams=panel_antigrams)
+    rng = random.Random(seed)
+    keys = [key for key, _ in reactions.iter_reactions()]
+    for antigram_id, cell_number in rng.sample(keys, len(keys) // 10):
+        reactions.add_reaction(antigram_id, cell_number, rng.choice(PATIENT_REACTIONS))
+    return reactions
+
+
+@pytest.mark.parametrize('rules', rule_sets())
+def test_full_identification_matches_reference(inventory, rules):
+    for seed in range(3):
+        reactions = patient(inventory, seed)
+        results = EnhancedAntibodyIdentifier(inventory, reactions).identify_antibodies(rules)
+        assert canonical(results) == reference_results(inventory, reactions, rules)
+
+
+@pytest.mark.parametrize('rules', rule_sets())
+def test_historical_identification_matches_reference(inventory, rules):
+    reactions = patient(inventory, seed=4, panel_antigrams=len(inventory.antigram_metadata))
+    expected = reference_results(inventory, reactions, rules, include_archived=True)
+
+    results, _ = IncrementalABIDTracker(inventory, reactions).identify(rules, include_archived=True)
+    assert canonical(results) == expected
+
+    panel = [(antigram_id, cell_number, reaction) for (antigram_id, cell_number), reaction in reactions.iter_reactions()]
+    [result] = EnhancedAntibodyIdentifier(inventory, reactions).identify_batch([panel], rules, include_details=True,
+                                                                              include_archived=True)
+    assert canonical(result) == expected
+
+
+@pytest.mark.parametrize('rules', rule_sets())
+def test_rule_evaluation_matches_reference(inventory, rules):
+    reactions = patient(inventory, seed=7)
+    evaluator = AntibodyRuleEvaluator(inventory, reactions)
+    expected = reference_results(inventory, reactions, rules)
+    suspected = expected['suspected_antibodies']
+
+    results = evaluator.evaluate_all_rules(rules, suspected)
+    assert sorted(results['ruled_out_antigens']) == expected['ruled_out']
+    assert canonical({'ruled_out_details': results['ruling_out_details']})['ruled_out_details'] == expected['ruled_out_details']
+
+    # Single rules, evaluated one at a time, agree with the reference too
+    snapshot = inventory.snapshot()
+    metadata = {antigram_id: snapshot.metadata[antigram_id] for antigram_id in snapshot.active_antigram_ids}
+    expressing, non_expressing = reference_abid.cell_sets(inventory, snapshot.active_antigram_ids)
+    negative = {key for key, reaction in reactions.iter_reactions() if reaction == '0' and key[0] in metadata}
+    for rule in rules:
+        for suspected_antibody in ([None] + suspected if rule['rule_type'] == 'abspecific' else [None]):
+            satisfied, cells = evaluator.evaluate_rule(rule, suspected_antibody)
+            expected_satisfied, expected_cells = reference_abid.evaluate_rule(
+                rule, expressing, non_expressing, negative, metadata, suspected_antibody
+            )
+            assert satisfied == expected_satisfied, rule
+            assert _sorted_cells(cells) == _sorted_cells(expected_cells), rule
+
+
+def test_single_rule_evaluation_keeps_the_plan_cache(inventory):
+    rules = benchmark_rules()
+    reactions = patient(inventory, seed=3)
+    evaluator = AntibodyRuleEvaluator(inventory, reactions)
+    evaluator.evaluate_all_rules(rules, rule_set_version='differential-single-rules')
+    before = plan_cache_stats()
+    for rule in rules:
+        evaluator.evaluate_rule(rule, 'D')
+    evaluator.evaluate_all_rules(rules, rule_set_version='differential-single-rules')
+    after = plan_cache_stats()
+    assert after['misses'] == before['misses']
+
+
+@pytest.mark.parametrize('rules', rule_sets())
+def test_incremental_identification_matches_reference(inventory, rules):
+    rng = random.Random(11)
+    reactions = patient(inventory, seed=5, panel_antigrams=2)
+    tracker = IncrementalABIDTracker(inventory, reactions)
+    results, _ = tracker.identify(rules)
+    assert canonical(results) == reference_results(inventory, reactions, rules)
+
+    antigram_ids = inventory.snapshot().active_antigram_ids
+    previous = reference_results(inventory, reactions, rules)
+    for step in range(60):
+        antigram_id = rng.choice(antigram_ids)
+        cell_number = rng.choice(inventory.cell_numbers(antigram_id))
+        if rng.random() < 0.25:
+            reactions.delete_reaction(antigram_id, cell_number)
+        else:
+            reactions.add_reaction(antigram_id, cell_number, rng.choice(PATIENT_REACTIONS))
+
+        results, delta = tracker.identify(rules, [(antigram_id, cell_number)])
+        expected = reference_results(inventory, reactions, rules)
+        assert canonical(results) == expected, f'after step {step}'
+
+        # The delta lists exactly the antigens whose status changed
+        def statuses(result):
+            status = {}
+            for field, name in (('ruled_out', 'ruled_out'), ('stro', 'stro'), ('matches', 'match')):
+                status.update({antigen: name for antigen in result[field]})
+            return status
+        before, now = statuses(previous), statuses(expected)
+        if previous['progress'] and expected['progress']:
+            assert delta == {antigen: now.get(antigen) for antigen in set(before) | set(now)
+                             if before.get(antigen) != now.get(antigen)}, f'after step {step}'
+        previous = expected
+
+
+@pytest.mark.parametrize('rules', rule_sets())
+@pytest.mark.parametrize('include_details', [False, True], ids=['summary', 'details'])
+def test_batch_identification_matches_reference(inventory, rules, include_details):
+    panel_managers = [patient(inventory, seed) for seed in range(6)]
+    panel_managers.append(PandasPatientReactionManager(cell_order=inventory.cell_numbers))
+    panels = [
+        [(antigram_id, cell_number, reaction) for (antigram_id, cell_number), reaction in manager.iter_reactions()]
+        for manager in panel_managers
+    ]
+
+    identifier = EnhancedAntibodyIdentifier(inventory, panel_managers[0])
+    results = identifier.identify_batch(panels, rules, include_details=include_details)
+    assert len(results) == len(panels)
+    for manager, result in zip(panel_managers, results):
+        expected = reference_results(inventory, manager, rules)
+        if not include_details:
+            expected['progress'], expected['ruled_out_details'] = {}, {}
+        assert canonical(result) == expected